@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# vim: set ai ts=4 sw=4 sts=4 noet fileencoding=utf-8 ft=python
+
+'''
+This Python script benchmarks the workflows of cbhv_control.py
+against simulated CBHV boxes with a controlled latency per command.
+For every workflow and number of boxes the wall clock time, the number of
+commands per second and the time spent waiting is measured; the results
+are appended to a JSON file to keep track of regressions over time.
+'''
+
+import sys
+import os
+import json
+import argparse
+import logging
+import platform
+import subprocess
+import tempfile
+from time import time, perf_counter, strftime
+# import own modules
+import cbhv_control
+from modules.color import print_color, print_error
+from modules.metrics import METRICS
+from modules.cbhv_simulator import SimulatorThread
+from modules.hv_gains import read_gains_file, check_gains
+from modules.session import SessionConfig, DEFAULT_WINDOW
+
+
+def write_gains(path, boxes):
+    """Write a gains file with small correction values for all channels of the given boxes"""
+    with open(path, 'w', newline='') as out:
+        out.write('#CardNo,Channel,Slope,Offset\n')
+        for box in boxes:
+            for card in range(5):
+                for channel in range(8):
+                    out.write('%d,%d,%d,%f,%f\r\n' % (box, card, channel,
+                                                      (channel - 4)*1e-3, card - 2.5))
+
+
+def git_revision():
+    """Return the current git commit of this repository if available"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_workflow(logger, name, n_boxes, host_prefix, sim, settings, tmp_dir, session):
+    """Run a single workflow with the first n_boxes boxes using the SessionConfig session
+    and return the measured values"""
+    boxes = list(range(1, n_boxes + 1))
+    gains_file = os.path.join(tmp_dir, 'HV_gains_offsets.txt')
+    output = os.path.join(tmp_dir, 'box%02d_card%d.txt')
+    v_range = settings['v_range']
+    stepping = settings['stepping']
+    waiting_time = settings['waiting_time']
+    write_gains(gains_file, range(1, 19))
+
+    METRICS.reset()
+    commands = sim.commands
+    start = perf_counter()
+    if name == 'parse':
+        for _ in range(settings['repetitions']):
+            success = check_gains(logger, read_gains_file(logger, gains_file), boxes)
+    elif name == 'set':
+        hv_gains = read_gains_file(logger, gains_file)
+        success = cbhv_control.set_values(logger, host_prefix, hv_gains, False, boxes, 1, session=session)
+    elif name == 'set_parallel':
+        hv_gains = read_gains_file(logger, gains_file)
+        success = cbhv_control.set_values(logger, host_prefix, hv_gains, False, boxes, n_boxes,
+                                          session=session)
+    elif name == 'measure':
+        success = cbhv_control.measure_values(logger, host_prefix, output, stepping, v_range,
+                                              waiting_time, boxes, session=session)
+    elif name == 'sweep':
+        success = cbhv_control.sweep_values(logger, host_prefix, output, stepping, v_range,
+                                            waiting_time, boxes, session=session)
+    else:
+        raise ValueError('Unknown workflow ' + name)
+    wall = perf_counter() - start
+    commands = sim.commands - commands
+    # the waiting times are wall clock times in which any box was waiting, overlapping waits
+    # of pipelined commands and parallel boxes are counted once; the work time is the rest
+    summary = METRICS.summary()
+    connect = METRICS.wait_time('connect')
+    response = METRICS.wait_time('response')
+    settle = METRICS.wait_time('settle')
+    waiting = METRICS.wait_time('connect', 'response', 'settle')
+
+    return {
+        'workflow': name,
+        'boxes': n_boxes,
+        'success': bool(success),
+        'wall_time': round(wall, 4),
+        'commands': commands,
+        'commands_per_second': round(commands/wall, 2) if wall else None,
+        'connect_wait': round(connect, 4),
+        'response_wait': round(response, 4),
+        'settle_wait': round(settle, 4),
+        'work_time': round(max(wall - waiting, 0), 4),
+        'latency_p50': round(summary['latency']['p50'], 6),
+        'latency_p99': round(summary['latency']['p99'], 6),
+        'queued_p50': round(summary['queued']['p50'], 6),
+        'queued_p99': round(summary['queued']['p99'], 6),
+    }
+
+
+def print_results(results):
+    """Print a table with the results of all runs"""
+    print_color('%-14s %5s %10s %9s %7s %12s %13s %12s %10s %9s %9s %11s' % (
+        'workflow', 'boxes', 'wall [s]', 'commands', 'cmd/s', 'connect [s]',
+        'response [s]', 'settle [s]', 'work [s]', 'p50 [ms]', 'p99 [ms]', 'queued [ms]'), 'GREEN')
+    for res in results:
+        line = '%-14s %5d %10.3f %9d %7s %12.3f %13.3f %12.3f %10.3f %9.2f %9.2f %11.2f' % (
+            res['workflow'], res['boxes'], res['wall_time'], res['commands'],
+            res['commands_per_second'], res['connect_wait'], res['response_wait'],
+            res['settle_wait'], res['work_time'], res['latency_p50']*1e3,
+            res['latency_p99']*1e3, res['queued_p50']*1e3)
+        if res['success']:
+            print(line)
+        else:
+            print_error(line + '  FAILED')
+
+
+def store_results(path, entry):
+    """Append the results of this run to the list of runs stored in the JSON file"""
+    runs = []
+    if os.path.isfile(path):
+        with open(path, 'r') as json_file:
+            runs = json.load(json_file)
+    runs.append(entry)
+    with open(path, 'w') as json_file:
+        json.dump(runs, json_file, indent=2)
+
+
+def main():
+    """Main function: start the simulated boxes and run all requested benchmarks"""
+    workflows = ['parse', 'set', 'set_parallel', 'measure', 'sweep']
+    parser = argparse.ArgumentParser(description='Benchmark the CBHV control workflows '
+                                     'using simulated boxes')
+    parser.add_argument('-p', '--prefix', type=str, default='localhost:95%02d',
+                        dest='host_prefix', metavar='"host prefix"',
+                        help='Host and port scheme of the simulated boxes, default "localhost:95%%02d"')
+    parser.add_argument('-n', '--boxes', nargs='+', type=int, default=[1, 6, 18],
+                        metavar='N', help='Numbers of boxes to benchmark, default 1 6 18')
+    parser.add_argument('-w', '--workflows', nargs='+', choices=workflows, default=workflows,
+                        help='Workflows to benchmark, default all')
+    parser.add_argument('-l', '--latency', type=float, default=.005,
+                        help='Latency per command of the simulated boxes in seconds, default 0.005')
+    parser.add_argument('--rtt', type=float, default=0.,
+                        help='Network round trip time of the simulated boxes in seconds, default 0')
+    parser.add_argument('--pipeline', type=int, default=DEFAULT_WINDOW,
+                        help='Number of pipelined commands per box, default %d' % DEFAULT_WINDOW)
+    parser.add_argument('-t', '--time', type=float, default=.1, dest='waiting_time',
+                        help='Waiting time for the measurement in seconds, default 0.1')
+    parser.add_argument('-s', '--stepping', type=int, default=10,
+                        help='Voltage stepping for the measurement, default 10')
+    parser.add_argument('--range', nargs=2, type=int, default=[1400, 1450], metavar=('V_min', 'V_max'),
+                        help='Voltage range for the measurement, default 1400 1450')
+    parser.add_argument('-r', '--repetitions', type=int, default=100,
+                        help='Number of repetitions to parse the gains file, default 100')
+    parser.add_argument('-o', '--output', type=str, default='bench_results.json',
+                        help='JSON file the results are appended to, default bench_results.json')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the output of the workflows')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger('CBHV benchmark')
+    logger.setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    session = SessionConfig(window=args.pipeline)
+    settings = {
+        'latency': args.latency,
+        'rtt': args.rtt,
+        'pipeline': session.window,
+        'waiting_time': args.waiting_time,
+        'stepping': args.stepping,
+        'v_range': args.range,
+        'repetitions': args.repetitions,
+    }
+    results = []
+    print_color('Start simulating %d boxes on %s' % (max(args.boxes), args.host_prefix), 'GREEN')
+    with SimulatorThread(args.host_prefix, range(1, max(args.boxes) + 1), latency=args.latency,
+                         rtt=args.rtt, seed=1) as sim, tempfile.TemporaryDirectory() as tmp_dir:
+        for name in args.workflows:
+            for n_boxes in args.boxes:
+                print('Running %s with %d boxes' % (name, n_boxes))
+                results.append(run_workflow(logger, name, n_boxes, args.host_prefix, sim,
+                                            settings, tmp_dir, session))
+
+    print_results(results)
+    store_results(args.output, {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'timestamp': time(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': results,
+    })
+    print_color('Results appended to ' + args.output, 'GREEN')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('\nCtrl+C detected, terminating program')
+        sys.exit(0)
@@ -14,19 +14,53 @@ import errno
 import argparse
 from os.path import abspath, dirname, join as pjoin
 import logging
-from time import sleep, strftime as time_str
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from time import sleep, perf_counter, strftime as time_str
 # import own modules
 # helper for colored output
 from modules.color import print_color, print_error, ColoredLogger
-# small helper class for telnet connections
-from modules.telnet_manager import TelnetManager
+# default socket of the daemon holding the connections to the boxes
+from modules.cbhv_daemon import DEFAULT_SOCKET
+# reading and validating the HV gains file
+from modules.hv_gains import read_gains_file, check_gains, card_values, card_commands
+# parsing of the EEPROM content of the boxes
+from modules.eemem import parse_eemem, card_mismatches, mismatch_table
+# adaptive detection of settled voltages
+from modules.settling import Settling, wait_settled, parse_adc
+# adaptive choice of the setpoints based on fits during the measurement
+from modules.online_fit import AdaptiveStepping, MeasurementMonitor, channel_name
+# journal of the measured points to resume a measurement
+from modules.journal import Journal, JOURNAL_FILE, open_card_file, sync_file
+# compact binary storage of all measured points of a run
+from modules.columnar import ColumnarWriter
+# fitting of the measured correction values
+from modules.analysis import analyse_measurements, write_gains_file, update_gains_file
+# cache of the rendered plots of the report
+from modules.report import clear_cache
+# location of the recorded sessions with the boxes
+from modules.transcript import transcript_path
+# latency and phase metrics of the communication with the boxes
+from modules.metrics import METRICS
+# fast concurrent health scan of the boxes
+from modules.box_scan import scan_boxes, print_scan
+# settings for opening, recording and replaying the sessions with the boxes
+from modules.session import SessionConfig
+# run tasks for several boxes in parallel
+from modules.box_pool import run_boxes, print_summary, box_logger, close_box_logger, describe_error
 
 
-# check if the installed Python version is at least 3.6
-# the usage of Telnet as a context manager was added in 3.6, which is used in this script
-if sys.hexversion < 0x3060000:
-    print_error('At least Python 3.6 is required to run this script')
+# check if the installed Python version is at least 3.7
+# the asyncio based connections to the boxes rely on features added in 3.7
+if sys.hexversion < 0x3070000:
+    print_error('At least Python 3.7 is required to run this script')
     sys.exit(1)
+# the sweep waits this many seconds for the other boxes once the first box is connected,
+# boxes which are still connecting then are skipped instead of delaying all others
+CONNECT_GRACE = 3.
+# read_config reloads the whole configuration and can take much longer than other commands;
+# it is never sent again without a response since the box may still be reloading
+READ_CONFIG_TIMEOUT = 60.
 
 def check_path(path, create=False, write=True):
     """Check if given path exists and is readable as well as writable if specified;
@@ -130,97 +164,387 @@ def list2str(lst):
     """Convert a list to a comma-separated string representation of the list"""
     return '[%s]' % ', '.join(map(str, lst))
 
-def set_values(logger, host_prefix, hv_gains=None, reset=False, boxes=list(range(1, 19))):
+def read_eemem(logger, tnm, box):
     """
-    This method is used to either reset the HV boxes HV gains to zero
-    or write calibrated values to them, given as a list of lines from a file provided earlier
+    Read the current content of the EEPROM of a box with eemem print; returns the parsed content,
+    False if the box didn't respond and None if the output wasn't recognised, which is only warned about
     """
-    if not hv_gains and not reset:
-        logger.error("No HV gains given and no reset of values specified")
+    ret = tnm.send_command('eemem print', return_response=True)
+    if ret is False:
         return False
+    logger.debug('eemem print returned the following:\n' + ret)
+    content = parse_eemem(ret)
+    if content is None:
+        logger.warning('Unrecognised eemem output of box %d, the stored values can not be compared:\n%s'
+                       % (box, ret))
+    return content
 
-    # start connecting to the boxes
-    logger.debug('Start loop over the following boxes: ' + list2str(boxes))
-    for box in boxes:
-        host = host_prefix % box
-        logger.info('Connecting to box ' + host)
-        with TelnetManager(host, logger=logger) as tnm:
-            if not tnm.send_command('eemem unprotect'):
-                logger.warning('Box %s may be dead, continue with next one' % host)
-                continue
-            logger.info('Start setting correction values, this may take 2 minutes or longer')
-            # loop over cards per box
-            for card in range(5):
-                logger.debug('Handling card %d' % card)
-                m_vals, n_vals = [], []
-                m_cmd, n_cmd = '', ''
-                # loop over channels per card and read the values if they should not be set to 0
-                if not reset:
-                    for channel in range(8):
-                        line = next((i for i in hv_gains if i.startswith("%d,%d,%d" % (box, card, channel))), None)
-                        if not line:
-                            logger.error("No values found for box %d, card %d, channel %d"
-                                         % (box, card, channel))
-                            continue
-                        vals = line.strip().split(',')[-2:]
-                        m_vals.append(vals[0])
-                        n_vals.append(vals[1])
-
-                    if len(m_vals) is not 8 or len(n_vals) is not 8:
-                        logger.error("Card %d problem parsing values!" % card)
-                        continue
-                    m_cmd = "eemem add M%d %s\r\n" % (card, ','.join(m_vals))
-                    n_cmd = "eemem add N%d %s\r\n" % (card, ','.join(n_vals))
-                else:
-                    m_cmd = "eemem add M%d %s\r\n" % (card, ','.join('0'*8))
-                    n_cmd = "eemem add N%d %s\r\n" % (card, ','.join('0'*8))
-
-                if not tnm.send_command(m_cmd):
-                    logger.warning('Box %s may be dead, continue with next one' % host)
-                    continue
-                if not tnm.send_command(n_cmd):
-                    logger.warning('Box %s may be dead, continue with next one' % host)
-                    continue
+def box_mismatches(box, content, hv_gains=None, reset=False, cards=None):
+    """
+    Compare the parsed EEPROM content of a box numerically to the values which should be set for
+    the given cards (default all); returns the list of mismatches as (box, card, row, channel, expected, stored)
+    """
+    mismatches = [(box, card) + mismatch for card in (range(5) if cards is None else cards)
+                  for mismatch in card_mismatches(content, card,
+                                                  *card_values(box, card, None if reset else hv_gains))]
+    reg = 'off' if reset else 'on'
+    if content['REG'] != reg:
+        mismatches.append((box, None, 'REG', None, reg, content['REG']))
+    return mismatches
 
-            if reset:
-                # deactivate correction loop while setting zeros
-                if not tnm.send_command('eemem add REG off'):
-                    logger.warning('Box %s may be dead, continue with next one' % host)
-                    continue
-            else:
-                # activate correction loop
-                if not tnm.send_command('eemem add REG on'):
-                    logger.warning('Box %s may be dead, continue with next one' % host)
-                    continue
+def changed_cards(logger, tnm, box, hv_gains=None, reset=False, cards=None):
+    """
+    Read the current content of the EEPROM of a box and compare it to the values which should be set;
+    returns the list of cards which differ and if the REG state differs, None if the box didn't respond;
+    all cards are considered to differ if the output of eemem print wasn't recognised
+    """
+    content = read_eemem(logger, tnm, box)
+    if content is False:
+        return None
+    if content is None:
+        return sorted(range(5) if cards is None else cards), True
+    mismatches = box_mismatches(box, content, hv_gains, reset, cards)
+    cards = sorted({card for _, card, row, _, _, _ in mismatches if row != 'REG'})
+    reg_differs = any(row == 'REG' for _, _, row, _, _, _ in mismatches)
+    logger.debug('Cards which differ: %s, REG differs: %s' % (list2str(cards), reg_differs))
+    return cards, reg_differs
 
-            # finished setting the values for the different channels per card, now store them
-            if not tnm.send_command('eemem protect'):
+def set_box_values(logger, host, box, hv_gains=None, reset=False, diff=False, verify=True, cards=None,
+                   session=None):
+    """
+    Set the HV gain correction values for a single box, either reset them to zero
+    or write the calibrated values for the given cards (default all) of this box; returns True on success;
+    hv_gains is the dictionary returned by read_gains_file;
+    if diff is True, only the cards whose stored values differ are written and the box
+    is not touched at all if it already contains the values;
+    if verify is True, the values read back from the EEPROM have to match the intended ones;
+    session is the SessionConfig used to connect to the box
+    """
+    logger.info('Connecting to box ' + host)
+    session = session or SessionConfig()
+    with session.open(host, logger) as tnm:
+        cards = range(5) if cards is None else cards
+        if diff:
+            changes = changed_cards(logger, tnm, box, hv_gains, reset, cards)
+            if changes is None:
                 logger.warning('Box %s may be dead, continue with next one' % host)
-                continue
-            if not tnm.send_command('read_config'):
+                return False
+            cards, reg_differs = changes
+            if not cards and not reg_differs:
+                logger.info('Box already contains the correction values, nothing to do')
+                return True
+            logger.info('Cards to be updated: %s' % list2str(cards))
+        logger.info('Start setting correction values, this may take 2 minutes or longer')
+        commands = ['eemem unprotect']
+        # loop over cards per box
+        for card in cards:
+            logger.debug('Handling card %d' % card)
+            commands.extend(card_commands(box, card, None if reset else hv_gains))
+        # deactivate correction loop while setting zeros, otherwise activate it
+        commands.append('eemem add REG off' if reset else 'eemem add REG on')
+        # finished setting the values for the different channels per card, now store them
+        commands.append('eemem protect')
+
+        # all commands are sent pipelined, every single response is still checked
+        with METRICS.phase(host, 'write cards'):
+            responses = tnm.send_commands(commands)
+        for cmd, response in zip(commands, responses):
+            if response is False:
+                logger.warning('No response to %s, box %s may be dead, continue with next one'
+                               % (' '.join(cmd.split()[:3]), host))
+                return False
+        with METRICS.phase(host, 'read_config'):
+            if not tnm.send_command('read_config', timeout=max(READ_CONFIG_TIMEOUT, session.timeout),
+                                    retries=0):
                 logger.warning('Box %s may be dead, continue with next one' % host)
-                continue
+                return False
+        if verify:
+            with METRICS.phase(host, 'verify'):
+                content = read_eemem(logger, tnm, box)
+            if content is False:
+                logger.warning("Box %s didn't respond after sending eemem print, go to next box" % host)
+                return False
+            mismatches = box_mismatches(box, content, hv_gains, reset, cards) if content else []
+            if mismatches:
+                logger.error('The values read back from box %s differ from the intended ones:\n%s'
+                             % (host, mismatch_table(mismatches)))
+                return False
+            if content:
+                logger.info('Verified the values stored on box ' + host)
+        else:
             logger.debug('Send eemem print')
             logger.info('eemem print returned the following:')
             if not tnm.send_command("eemem print", print_info=True):
                 logger.warning("Box %s didn't respond after sending eemem print, go to next box" % host)
-                continue
-            logger.debug('Closing telnet connection to box ' + host)
-        logger.debug('Telnet connection closed')
+                return False
+        logger.debug('Closing telnet connection to box ' + host)
+    logger.debug('Telnet connection closed')
+
+    return True
+
+def set_values(logger, host_prefix, hv_gains=None, reset=False, boxes=list(range(1, 19)),
+               jobs=1, log_dir=None, diff=False, verify=True, cards=None, session=None):
+    """
+    This method is used to either reset the HV boxes HV gains to zero
+    or write calibrated values to them, given as the dictionary read from the gains file earlier;
+    up to jobs boxes are handled in parallel, a summary per box is printed in the end;
+    if cards are given, only these cards of every box are written;
+    if diff is True, only cards with changed values are written;
+    if verify is True, the stored values are read back and compared afterwards;
+    session is the SessionConfig used to connect to the boxes
+    """
+    if not hv_gains and not reset:
+        logger.error("No HV gains given and no reset of values specified")
+        return False
+
+    # start connecting to the boxes
+    logger.debug('Start loop over the following boxes: ' + list2str(boxes))
+    results = run_boxes(logger, host_prefix, boxes,
+                        lambda log, host, box: set_box_values(log, host, box, hv_gains, reset, diff,
+                                                              verify, cards, session),
+                        jobs, log_dir)
 
     logger.info('Done')
 
-    return True
+    return print_summary(logger, host_prefix, results)
+
+def verify_values(logger, host_prefix, hv_gains=None, reset=False, boxes=list(range(1, 19)),
+                  jobs=None, log_dir=None, cards=None, session=None):
+    """
+    Read the EEPROM content of all boxes in parallel and compare it to the values of the gains file,
+    or to zeros and an inactive correction loop if reset is True; only the given cards are compared
+    if cards are given; all mismatches are printed as one table, returns True if all boxes contain
+    the intended values; session is the SessionConfig used to connect to the boxes
+    """
+    if not hv_gains and not reset:
+        logger.error("No HV gains given and no reset of values specified")
+        return False
+
+    # box number -> list of mismatches
+    mismatches = {}
+
+    def verify_box(log, host, box):
+        with (session or SessionConfig()).open(host, log) as tnm:
+            with METRICS.phase(host, 'verify'):
+                content = read_eemem(log, tnm, box)
+        if content is False:
+            log.warning("Box %s didn't respond after sending eemem print" % host)
+            return False
+        # an unrecognised output is only warned about, the box doesn't fail because of it
+        mismatches[box] = box_mismatches(box, content, hv_gains, reset, cards) if content else []
+        return not mismatches[box]
+
+    logger.debug('Verify the values of the following boxes: ' + list2str(boxes))
+    results = run_boxes(logger, host_prefix, boxes, verify_box, jobs or len(boxes), log_dir)
+
+    found = [mismatch for box in sorted(mismatches) for mismatch in mismatches[box]]
+    if found:
+        logger.error('%d values differ from the intended ones:\n%s' % (len(found), mismatch_table(found)))
+    elif all(results.values()):
+        logger.info('All boxes contain the intended values')
+
+    return print_summary(logger, host_prefix, results)
+
+def measurement_header(settling=None):
+    """Header of the measurement files per card, the settling time is added as last column
+    if the adaptive settling detection is used"""
+    header = '#Setpoint,Date,Level,CH0,CH1,CH2,CH3,CH4,CH5,CH6,CH7'
+    if settling:
+        header += ',Settle'
+    return header + '\n'
+
+def program_card(logger, tnm, cards, val, channels=None):
+    """Apply the setpoint val to the given channels (default all) of the given card or list of cards,
+    the SetVpmF commands are sent pipelined; returns the list of (card, channel) which didn't respond"""
+    if isinstance(cards, int):
+        cards = [cards]
+    targets = [(card, channel) for card in cards for channel in (range(8) if channels is None else channels)]
+    responses = tnm.send_commands(['SetVpmF %d %d %d' % (card, channel, val) for card, channel in targets])
+    failed = [target for target, response in zip(targets, responses) if response is False]
+    for card, channel in failed:
+        logger.warning('Channel %d of card %d may be dead, continue with next one' % (channel, card))
+    return failed
+
+def read_cards(logger, tnm, cards, waiting_time, settling=None, start=None):
+    """Read the ADC values of the given cards after the voltages have settled, either after waiting
+    a fixed time or using the adaptive settling detection; start is the time the setpoint
+    was applied; returns a dictionary with the response of read_adc and the time waited
+    for the values to settle per card"""
+    if not settling:
+        # with a given start time the waiting time has already been spent by the caller
+        if start is None:
+            with METRICS.phase(tnm.host, 'settle'):
+                sleep(waiting_time)
+        with METRICS.phase(tnm.host, 'read_adc'):
+            responses = tnm.send_commands(['read_adc csv2L %d' % card for card in cards])
+        return {card: (ret, waiting_time) for card, ret in zip(cards, responses)}
+
+    reads = {card: partial(tnm.send_command, 'read_adc csv2L %d' % card, return_response=True)
+             for card in cards}
+    results = {}
+    # the values are read repeatedly until they are stable, so this includes the reading
+    with METRICS.phase(tnm.host, 'settle'):
+        settled_values = wait_settled(reads, settling, start)
+    for card, (ret, settle_time, settled) in settled_values.items():
+        if ret and not settled:
+            logger.warning('Values of card %d not stable within %g V after %.1f seconds'
+                           % (card, settling.tolerance, settle_time))
+        results[card] = ret, settle_time
+    return results
+
+def measurement_line(val, ret, settle_time, settling=None):
+    """Line for the measurement file of a card, containing the setpoint and the read_adc response"""
+    if settling:
+        return '%d,%s,%.2f\n' % (val, ret, settle_time)
+    return ','.join([str(val), ret + '\n'])
+
+def open_output(output, box, card, settling=None, journal=None):
+    """Open the measurement file of a card and write the header; if a journal is given,
+    the file of a resumed measurement is continued"""
+    if journal:
+        return open_card_file(output % (box, card), measurement_header(settling), journal, box, card)
+    out = open(output % (box, card), 'w')
+    out.write(measurement_header(settling))
+    return out
+
+def store_point(logger, out, journal, columnar, box, card, val, ret, settle_time, settling=None):
+    """Write a measured point to the output file of the card and the optional columnar file,
+    then record it in the journal after the files have been synced to disk"""
+    out.write(measurement_line(val, ret, settle_time, settling))
+    if columnar and not columnar.write(box, card, val, ret, settle_time if settling else None):
+        logger.warning('Too few values of card %d (box %d) at %d V for the columnar file: %s'
+                       % (card, box, val, ret))
+    if journal:
+        sync_file(out)
+        if columnar:
+            columnar.sync()
+        journal.record(box, card, val)
+    else:
+        out.flush()
+
+def journaled_points(output, box, card, journal=None):
+    """Setpoints and ADC values of the points of a card which are recorded in the journal,
+    read from the output file of the card of a resumed measurement"""
+    path = output % (box, card)
+    if not journal or not journal.points or not os.path.isfile(path):
+        return []
+    points = []
+    with open(path, 'r') as card_file:
+        for line in card_file:
+            setpoint, _, response = line.partition(',')
+            if line.startswith('#') or not setpoint.strip().isdigit():
+                continue
+            if journal.done(box, card, int(setpoint)):
+                points.append((int(setpoint), parse_adc(response)))
+    return points
+
+def card_plan(output, box, card, v_range, stepping, adaptive, journal=None, channels=None):
+    """Adaptive stepping of a card with the tolerance adaptive, including the points
+    of a resumed measurement"""
+    plan = AdaptiveStepping(v_range, stepping, adaptive, channels=channels)
+    for setpoint, adc in journaled_points(output, box, card, journal):
+        plan.add(setpoint, adc)
+    return plan
+
+def card_monitor(monitor, output, box, card, journal=None):
+    """Online fit of a card, the points of a resumed measurement are added first"""
+    card_mon = monitor.card(box, card)
+    if not card_mon.points:
+        for setpoint, adc in journaled_points(output, box, card, journal):
+            card_mon.add(setpoint, adc)
+    return card_mon
+
+def measure_point(logger, tnm, card, val, waiting_time, settling=None, channels=None):
+    """Apply a setpoint to the given channels (default all) of a single card and read the values back;
+    returns the channels which didn't respond to SetVpmF, the read_adc response and the time waited"""
+    with METRICS.phase(tnm.host, 'program'):
+        failed = program_card(logger, tnm, card, val, channels)
+    ret, settle_time = read_cards(logger, tnm, [card], waiting_time, settling)[card]
+    return [channel for _, channel in failed], ret, settle_time
+
+def monitor_point(logger, monitor, card_mon, card, val, point, remeasure, live=True):
+    """Check a measured point (failed channels, response, time waited) with the online fit of the card
+    and add it; if the monitor retries, a point with new problems is measured once more with remeasure();
+    the current fit is shown if live is set, otherwise only in the debug output;
+    returns the point to store and False if the measurement of the card should be aborted"""
+    failed, ret, _ = point
+    problems = card_mon.check(val, parse_adc(ret) if ret else None, failed)
+    # channels which are already flagged don't cause retries anymore
+    if monitor.on_problem == 'retry' and any(channel not in card_mon.flagged for channel, _ in problems):
+        logger.warning('Problems with card %d at %d V, measuring the point again' % (card, val))
+        point = remeasure()
+        failed, ret, _ = point
+        problems = card_mon.check(val, parse_adc(ret) if ret else None, failed)
+    if ret:
+        problems += card_mon.add(val, parse_adc(ret))
+    new = card_mon.flag(problems)
+    for channel, reason in new:
+        logger.warning('Card %d, %s: %s' % (card, channel_name(channel), reason))
+    logger.log(logging.INFO if live else logging.DEBUG, 'Card %d at %d V: %s' % (card, val, card_mon.status()))
+    for channel in card_mon.channels:
+        params = card_mon.fit.parameters(channel)
+        if params:
+            logger.debug('Card %d, channel %d: slope %+.5f, offset %+.2f V, residuals %.2f V rms'
+                         % (card, channel, *params, card_mon.fit.rms(channel)))
+    return point, not (new and monitor.on_problem == 'abort')
+
+def write_online_gains(logger, monitor, path, merge=False):
+    """Write the gains file from the online fits of the measured cards;
+    if merge is True, the fitted channels are merged into the existing gains file instead"""
+    keys, slopes, offsets = monitor.results()
+    if not keys:
+        logger.error('No measured points for the online fits')
+        return False
+    failed = [(box, card, channel) for (box, card), card_slopes in zip(keys, slopes)
+              for channel, slope in enumerate(card_slopes)
+              if slope is None and channel in monitor.card(box, card).channels]
+    for box, card, channel in failed:
+        logger.warning('Online fit failed for box %d, card %d, channel %d, no values are written for it'
+                       % (box, card, channel))
+    if merge:
+        replaced = update_gains_file(logger, path, keys, slopes, offsets, monitor.channels)
+        if replaced is None:
+            logger.error('Could not merge the online fits into %s', path)
+            return False
+        logger.info('Updated the online fits of %d channels in %s', replaced, path)
+        return not failed
+    written = write_gains_file(path, keys, slopes, offsets)
+    logger.info('Saved the online fits of %d channels to %s', written, path)
+    return not failed
+
+def report_problems(logger, monitor):
+    """Print all channels flagged during the measurement"""
+    flagged = monitor.flagged()
+    if not flagged:
+        logger.info('No problems found by the online fits')
+        return
+    logger.warning('%d problems are flagged at the end of the measurement:' % len(flagged))
+    for box, card, channel, reason in flagged:
+        logger.warning('  box %2d, card %d, %s: %s' % (box, card, channel_name(channel), reason))
+    for box, card in sorted(monitor.aborted):
+        logger.error('Measurement of box %d, card %d was aborted' % (box, card))
 
-def measure_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes):
+def measure_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes, settling=None,
+                   journal=None, columnar=None, adaptive=None, monitor=None, cards=None, channels=None,
+                   session=None):
     """
     This method performs a measurement of the CB HV correction values
-    and stores the results in a separate file per card
+    and stores the results in a separate file per card;
+    if settling is given, the values are read once they are stable instead of after waiting_time;
+    if a journal is given, every measured point is recorded and points already
+    contained in the journal are skipped;
+    if a ColumnarWriter is given, all points are stored in its file as well;
+    if adaptive is given, the setpoints are chosen with AdaptiveStepping using it as tolerance in V;
+    every point is added to the online fit of its card in the MeasurementMonitor monitor
+    which flags problematic channels and decides if the card is measured further;
+    if cards or channels are given, only these cards and channels are measured;
+    session is the SessionConfig used to connect to the boxes;
+    returns False if any box couldn't be measured, like sweep_values
     """
     if not output:
         logger.error('No output given')
         return False
-    if len(v_range) is not 2:
+    if len(v_range) != 2:
         logger.error('No valid voltage range provided')
         return False
     if not boxes:
@@ -230,43 +554,304 @@ def measure_values(logger, host_prefix, output, stepping, v_range, waiting_time,
     logger.debug('Run correction measurement from %d V to %d V' % tuple(v_range))
     logger.debug('The used stepping is %d V' % stepping)
 
+    setpoints = list(range(v_range[0], v_range[1], stepping))
+    monitor = monitor or MeasurementMonitor(channels=channels)
+    cards = range(5) if cards is None else cards
+    session = session or SessionConfig()
+    # box number -> True if the box could be measured, like the results of sweep_values
+    results = {}
     # start connecting to the boxes
     logger.debug('Start loop over the following boxes: ' + list2str(boxes))
     for box in boxes:
         host = host_prefix % box
+        todo = {card: journal.missing(box, card, setpoints) if journal else setpoints
+                for card in cards}
+        # the setpoints of the adaptive stepping are only known during the measurement
+        if not adaptive and not any(todo.values()):
+            logger.info('All points of box %s have already been measured' % host)
+            results[box] = True
+            continue
         logger.info('Connecting to box ' + host)
-        with TelnetManager(host, logger=logger) as tnm:
+        try:
+            tnm = session.open(host, logger)
+        except Exception as e:
+            logger.error('Failed to connect with %s', describe_error(e))
+            logger.warning('Box %s may be dead, continue with next one' % host)
+            results[box] = False
+            continue
+        # a box fails if none of the requested points got a response
+        requested, responded = False, False
+        with tnm:
             # set the time on the board
             if not tnm.send_command('time ' + time_str('%H %M %S %d %m %Y')):
                 logger.warning('Box %s may be dead, continue with next one' % host)
+                results[box] = False
                 continue
             logger.info('Start measuring correction values, this will take some time')
             # loop over cards per box
-            for card in range(5):
+            for card in cards:
+                plan = None
+                if adaptive:
+                    plan = card_plan(output, box, card, v_range, stepping, adaptive, journal, channels)
+                    todo[card] = plan.next_points()
+                if not todo[card]:
+                    continue
                 logger.debug('Handling card %d' % card)
-                with open(output % (box, card), 'w') as out:
-                    out.write('#Setpoint,Date,Level,CH0,CH1,CH2,CH3,CH4,CH5,CH6,CH7\n')
-                    # run correction measurement loop
-                    for val in range(v_range[0], v_range[1], stepping):
-                        for channel in range(8):
-                            if not tnm.send_command('SetVpmF %d %d %d' % (card, channel, val)):
-                                logger.warning('Channel %d of box %s may be dead, '
-                                               'continue with next one' % (channel, host))
-                                continue
-                        sleep(waiting_time)
-                        ret = tnm.send_command('read_adc csv2L %d' % card, return_response=True)
-                        if not ret:
-                            logger.error('No response from card %d (box %d)' % (card, host))
-                            continue
-                        else:
-                            out.write(','.join([str(val), ret + '\n']))
+                card_mon = card_monitor(monitor, output, box, card, journal)
+                remeasure = partial(measure_point, logger, tnm, card, waiting_time=waiting_time,
+                                    settling=settling, channels=channels)
+                with open_output(output, box, card, settling, journal) as out:
+                    # run correction measurement loop, the adaptive stepping adds setpoints afterwards
+                    while todo[card]:
+                        for val in todo[card]:
+                            point, proceed = monitor_point(logger, monitor, card_mon, card, val,
+                                                           remeasure(val), partial(remeasure, val))
+                            _, ret, settle_time = point
+                            requested = True
+                            if not ret:
+                                logger.error('No response from card %d (box %s)' % (card, host))
+                            else:
+                                responded = True
+                                store_point(logger, out, journal, columnar, box, card, val, ret,
+                                            settle_time, settling)
+                                if plan:
+                                    plan.add(val, parse_adc(ret))
+                            if not proceed:
+                                logger.error('Abort measuring card %d (box %s)' % (card, host))
+                                monitor.aborted.add((box, card))
+                                break
+                        todo[card] = plan.next_points() if plan and (box, card) not in monitor.aborted else []
+                if plan:
+                    logger.info('Card %d measured at %d of %d setpoints'
+                                % (card, len(plan.points), len(plan.grid)))
 
             logger.debug('Closing telnet connection to box ' + host)
         logger.debug('Telnet connection closed')
+        results[box] = responded or not requested
+        if not results[box]:
+            logger.warning('No card of box %s responded' % host)
 
+    report_problems(logger, monitor)
     logger.info('Done')
 
-    return True
+    return print_summary(logger, host_prefix, results)
+
+
+def sweep_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes,
+                 jobs=None, log_dir=None, settling=None, journal=None, columnar=None, adaptive=None,
+                 monitor=None, cards=None, channels=None, session=None):
+    """
+    This method performs a measurement of the CB HV correction values like measure_values,
+    but every setpoint is programmed on all cards of all boxes in parallel before a single
+    settling time is waited for and all cards are read back; the results are stored
+    in the same format with a separate file per card;
+    if settling is given, every card is read once its values are stable instead of after waiting_time;
+    if a journal is given, every measured point is recorded and points already
+    contained in the journal are skipped;
+    if a ColumnarWriter is given, all points are stored in its file as well;
+    if adaptive is given, the setpoints of every card are chosen with AdaptiveStepping using it
+    as tolerance in V; the sweep runs in rounds over the setpoints requested by all cards;
+    every point is added to the online fit of its card in the MeasurementMonitor monitor,
+    a point with problems is measured again on its own if the monitor retries;
+    if cards or channels are given, only these cards and channels are measured;
+    session is the SessionConfig used to connect to the boxes; boxes which are still connecting
+    CONNECT_GRACE seconds after the first box is connected are skipped;
+    returns False if any box couldn't be measured
+    """
+    if not output:
+        logger.error('No output given')
+        return False
+    if len(v_range) != 2:
+        logger.error('No valid voltage range provided')
+        return False
+    if not boxes:
+        logger.error('No boxes provided which should be used')
+        return False
+
+    logger.debug('Run correction measurement sweep from %d V to %d V' % tuple(v_range))
+    logger.debug('The used stepping is %d V' % stepping)
+
+    setpoints = list(range(v_range[0], v_range[1], stepping))
+    monitor = monitor or MeasurementMonitor(channels=channels)
+    cards = range(5) if cards is None else cards
+    if journal and not adaptive:
+        boxes = [box for box in boxes
+                 if any(journal.missing(box, card, setpoints) for card in cards)]
+        if not boxes:
+            logger.info('All points have already been measured')
+            return True
+    # box number -> (box logger, telnet connection, dictionary of the output files per card)
+    sessions = {}
+    # box number -> dictionary of the adaptive stepping per card
+    plans = {}
+    # box number -> list of the setpoints still to be measured in this round per card
+    pending = {}
+    # box number -> list of (card, channel) which didn't respond when applying the current setpoint
+    failed_channels = {}
+
+    def connect_box(box):
+        host = host_prefix % box
+        log = box_logger(logger, host, log_dir)
+        log.info('Connecting to box ' + host)
+        try:
+            tnm = (session or SessionConfig()).open(host, log)
+        except Exception as e:
+            log.error('Failed to connect with %s', describe_error(e))
+            close_box_logger(log)
+            return None
+        # set the time on the board
+        if not tnm.send_command('time ' + time_str('%H %M %S %d %m %Y')):
+            log.warning('Box %s may be dead, it will be skipped' % host)
+            tnm.close()
+            close_box_logger(log)
+            return None
+        return log, tnm
+
+    def prepare_box(box):
+        # the output files are only opened for the boxes used in the sweep
+        files = {card: open_output(output, box, card, settling, journal) for card in cards}
+        if adaptive:
+            plans[box] = {card: card_plan(output, box, card, v_range, stepping, adaptive, journal, channels)
+                          for card in cards}
+        for card in cards:
+            card_monitor(monitor, output, box, card, journal)
+        return files
+
+    def close_late(future):
+        # a box which connects after the sweep started is not used anymore
+        if future.result():
+            log, tnm = future.result()
+            log.warning('Connected too late, the box is skipped')
+            tnm.close()
+            close_box_logger(log)
+
+    def connect_boxes(pool):
+        """Connect to all boxes in parallel, returns once all boxes are connected or failed,
+        but at most CONNECT_GRACE seconds after the first box is connected"""
+        futures = {pool.submit(connect_box, box): box for box in boxes}
+        connecting = set(futures)
+        deadline = None
+        while connecting:
+            timeout = None if deadline is None else max(0., deadline - perf_counter())
+            done, connecting = wait(connecting, timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                results[futures[future]] = future.result() is not None
+                if future.result():
+                    sessions[futures[future]] = future.result()
+            if sessions and deadline is None:
+                deadline = perf_counter() + CONNECT_GRACE
+        for future in connecting:
+            results[futures[future]] = False
+            logger.warning('Box %s is still connecting %g seconds after the first box, it is skipped'
+                           % (host_prefix % futures[future], CONNECT_GRACE))
+            future.add_done_callback(close_late)
+        for box in [box for box in boxes if box in sessions]:
+            sessions[box] = sessions[box] + (prepare_box(box),)
+
+    def next_round(box):
+        if adaptive:
+            return {card: plan.next_points() if (box, card) not in monitor.aborted else []
+                    for card, plan in plans[box].items()}
+        if box in pending:
+            return {card: [] for card in cards}
+        return {card: journal.missing(box, card, setpoints) if journal else setpoints for card in cards}
+
+    def cards_todo(box, val):
+        return [card for card in cards
+                if val in pending[box][card] and (box, card) not in monitor.aborted]
+
+    def program_box(box, val):
+        log, tnm, _ = sessions[box]
+        with METRICS.phase(tnm.host, 'program'):
+            failed_channels[box] = program_card(log, tnm, cards_todo(box, val), val, channels)
+        return True
+
+    def read_box(box, val, start):
+        log, tnm, files = sessions[box]
+        success = False
+        todo = cards_todo(box, val)
+        values = read_cards(log, tnm, todo, waiting_time, settling, start)
+        for card in todo:
+            failed = [channel for failed_card, channel in failed_channels[box] if failed_card == card]
+            point, proceed = monitor_point(log, monitor, monitor.card(box, card), card, val,
+                                           (failed,) + values[card],
+                                           partial(measure_point, log, tnm, card, val, waiting_time,
+                                                   settling, channels), live=False)
+            _, ret, settle_time = point
+            if not proceed:
+                log.error('Abort measuring card %d' % card)
+                monitor.aborted.add((box, card))
+            if not ret:
+                log.error('No response from card %d' % card)
+                continue
+            store_point(log, files[card], journal, columnar, box, card, val, ret, settle_time,
+                        settling)
+            if adaptive:
+                plans[box][card].add(val, parse_adc(ret))
+            success = True
+        if not success:
+            log.warning('No card responded, box will be skipped for the remaining setpoints')
+        return success
+
+    def close_box(box):
+        log, tnm, files = sessions.pop(box)
+        for out in files.values():
+            out.close()
+        log.debug('Closing telnet connection')
+        tnm.close()
+        close_box_logger(log)
+
+    jobs = jobs or len(boxes)
+    logger.debug('Start sweep over the following boxes: ' + list2str(boxes))
+    # box number -> True if the box could be measured
+    results = dict.fromkeys(boxes, False)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        connect_boxes(pool)
+        try:
+            logger.info('Start measuring correction values on %d boxes, this will take some time',
+                        len(sessions))
+            # a single round over all setpoints, the adaptive stepping adds rounds as long as
+            # any card requests more setpoints
+            while sessions:
+                pending.update({box: next_round(box) for box in sessions})
+                round_setpoints = sorted({val for box in sessions for card_setpoints in pending[box].values()
+                                          for val in card_setpoints})
+                if not round_setpoints:
+                    break
+                for step, val in enumerate(round_setpoints, 1):
+                    if not sessions:
+                        logger.error('No box left which responds, stop the measurement')
+                        break
+                    live = [box for box in sessions if cards_todo(box, val)]
+                    if not live:
+                        logger.debug('Setpoint %d V has already been measured' % val)
+                        continue
+                    logger.info('Setpoint %d V (%d of %d)', val, step, len(round_setpoints))
+                    list(pool.map(lambda box: program_box(box, val), live))
+                    start = perf_counter()
+                    if not settling:
+                        # a single settling time for all cards of all boxes
+                        with METRICS.phase('all boxes', 'settle'):
+                            sleep(waiting_time)
+                    for box, success in zip(live, pool.map(lambda box: read_box(box, val, start), live)):
+                        if not success:
+                            results[box] = False
+                            close_box(box)
+            if adaptive:
+                measured = sum(len(plan.points) for box_plans in plans.values() for plan in box_plans.values())
+                logger.info('Measured %d of %d points with the adaptive stepping',
+                            measured, len(setpoints)*len(cards)*len(plans))
+        finally:
+            for box in list(sessions):
+                close_box(box)
+        logger.debug('Telnet connections closed')
+
+    report_problems(logger, monitor)
+    logger.info('Done')
+
+    return print_summary(logger, host_prefix, results)
 
 
 def is_valid_file(parser, arg):
@@ -319,12 +904,104 @@ def main():
                         'which otherwise terminate the program')
     parser.add_argument('-b', '--boxes', nargs='+', type=int, metavar='box-number',
                         help='Space-separated list of boxes which should be used, ints expected')
+    parser.add_argument('--cards', nargs='+', type=int, metavar='card-number',
+                        help='Space-separated list of cards (0-4) of every box which should be used for setting, '
+                        'measuring and analysing values; the results are merged into the existing gains file')
+    parser.add_argument('--channels', nargs='+', type=int, metavar='channel-number',
+                        help='Space-separated list of channels (0-7) of the cards which should be measured and '
+                        'analysed; only their values are replaced in the existing gains file')
     parser.add_argument('-t', '--time', nargs=1, type=int, metavar='wating time',
                         help='Waiting time during calibration routine between applying value and '
                         'reading the result, given in seconds')
+    parser.add_argument('--settle-tol', nargs=1, type=float, metavar='V',
+                        help='Use adaptive settling detection instead of a fixed waiting time: '
+                        'values are read repeatedly until all channels are stable within this tolerance')
+    parser.add_argument('--settle-samples', nargs=1, type=int, metavar='N',
+                        help='Number of consecutive readings which have to be stable, default 3')
+    parser.add_argument('--max-wait', nargs=1, type=float, metavar='seconds',
+                        help='Maximum time to wait for stable values, default 10 seconds')
+    parser.add_argument('--adaptive', nargs=1, type=float, metavar='V',
+                        help='Optional: Measure a coarse set of setpoints first and only add intermediate '
+                        'setpoints where a channel deviates by more than V volts from its linear fit')
+    parser.add_argument('--on-problem', nargs=1, type=str, choices=['warn', 'retry', 'abort'],
+                        help='Action if the online fit flags a channel during the measurement: warn (default), '
+                        'retry the point once more or abort the measurement of the affected card')
+    parser.add_argument('--max-residual', nargs=1, type=float, metavar='V',
+                        help='Flag channels deviating by more than V volts from their online fit, default 5')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted measurement: points recorded in the journal of the '
+                        'output directory are skipped and the existing files are continued')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Measure correction values with a sweep over all boxes in parallel; '
+                        'every setpoint is applied to all cards before waiting once for all of them')
+    parser.add_argument('-d', '--diff', action='store_true',
+                        help='Read the stored values first and only write cards whose values differ, '
+                        'boxes which already contain the values are not changed at all')
+    parser.add_argument('--verify', action='store_true',
+                        help='Only read the values stored on the boxes and compare them to the gains file, '
+                        'or to zeros together with -r/--reset')
+    parser.add_argument('--no-verify', action='store_false', dest='verify_apply',
+                        help='Skip reading back and comparing the values after setting them')
+    parser.add_argument('--scan', action='store_true',
+                        help='Only probe all boxes concurrently with short timeouts and report their reachability, '
+                        'latency, clock and REG state')
+    parser.add_argument('--scan-timeout', nargs=1, type=float, metavar='seconds',
+                        help='Timeout for connecting and for every response during --scan, default 1 second')
+    parser.add_argument('-a', '--analyse', action='store_true',
+                        help='Fit the measured correction values of all cards and write the gains file; '
+                        'if combined with -c/--calibrate or --sweep, the analysis follows the measurement')
+    parser.add_argument('-g', '--gains-output', nargs=1, type=str, metavar='gains_file',
+                        help='Optional: Output file of the analysis, default is HV_gains_offsets.txt '
+                        'in the current directory; if given for a measurement without -a/--analyse, '
+                        'the online fits are written to this file right after the measurement')
+    parser.add_argument('--report', nargs=1, type=str, metavar='html_file',
+                        help='Optional: Write an HTML report with the fit plots of all cards during the analysis, '
+                        'only cards whose measurement or fit changed are rendered again')
+    parser.add_argument('--clear-cache', dest='clear_cache', action='store_true',
+                        help='Remove all cached plots of the report before rendering it')
+    parser.add_argument('--columnar', nargs=1, type=str, metavar='columnar_file',
+                        help='Optional: Additionally store all measured points in this binary columnar file; '
+                        'with -a/--analyse only, the analysis reads the measurement from this file')
+    parser.add_argument('--daemon', nargs='?', type=str, const=DEFAULT_SOCKET, metavar='socket',
+                        help='Access the boxes via a running CBHV daemon instead of connecting directly, '
+                        'optionally the path of its socket can be given, default ' + DEFAULT_SOCKET)
+    parser.add_argument('--pipeline', nargs=1, type=int, metavar='N',
+                        help='Number of commands sent to a box without waiting for the responses, '
+                        'default 8; 1 waits for every response before sending the next command')
+    parser.add_argument('--timeout', nargs=1, type=float, metavar='seconds',
+                        help='Time to wait for the response to a command before reconnecting and sending '
+                        'it again, default 10; read_config is given at least %d seconds and never sent again'
+                        % READ_CONFIG_TIMEOUT)
+    parser.add_argument('--record', nargs=1, type=str, metavar='transcript_directory',
+                        help='Optional: Record all commands, responses and their timing per box to '
+                        '<host>.jsonl.gz in this directory')
+    parser.add_argument('--replay', nargs=1, type=str, metavar='transcript_directory',
+                        help='Replay the sessions recorded with --record instead of connecting to the boxes')
+    parser.add_argument('--replay-speed', nargs=1, type=float, metavar='factor',
+                        help='Speed up the replay by this factor, response times and waiting times are divided '
+                        'by it, default 1')
+    parser.add_argument('-j', '--jobs', nargs=1, type=int, metavar='N',
+                        help='Number of boxes which are handled in parallel, default is 1 '
+                        'when setting values and all boxes for --sweep')
+    parser.add_argument('--log-dir', nargs=1, type=str, metavar='log_directory',
+                        help='Optional: Additionally write a separate log file per box to this directory')
+    parser.add_argument('--metrics-json', nargs=1, type=str, metavar='json_file',
+                        help='Optional: Write the command latencies and phase durations '
+                        'of the run as JSON to this file')
+    parser.add_argument('--metrics-prom', nargs=1, type=str, metavar='prom_file',
+                        help='Optional: Write the metrics in the Prometheus text format to this file, '
+                        'e.g. for the textfile collector of the node exporter')
     parser.set_defaults(reset=False)
     parser.set_defaults(calibrate=False)
+    parser.set_defaults(sweep=False)
+    parser.set_defaults(analyse=False)
+    parser.set_defaults(diff=False)
+    parser.set_defaults(verify=False)
+    parser.set_defaults(scan=False)
+    parser.set_defaults(verify_apply=True)
+    parser.set_defaults(resume=False)
     parser.set_defaults(force=False)
+    parser.set_defaults(clear_cache=False)
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Print additional output')
 
@@ -335,19 +1012,29 @@ def main():
     args = parser.parse_args()
     verbose = args.verbose
     reset = args.reset
-    calibrate = args.calibrate
+    calibrate = args.calibrate or args.sweep
+    analyse = args.analyse
     if verbose:
         logger.setLevel(logging.DEBUG)
     host_prefix = 'cbhv%02d'
     boxes = list(range(1, 19))
     gains_file = 'HV_gains_offsets.txt'
-    hv_gains = []
+    hv_gains = {}
     output = './cbhv_corr_measuremt'
     out_file = 'box%02d_card%d.txt'
     stepping = 10
     v_range = [1300, 1650]
     waiting_time = 1
     force = args.force
+    jobs = None
+    log_dir = None
+    settling = None
+    columnar_file = None
+    report = None
+    adaptive = None
+    monitor = None
+    cards = None
+    channels = None
 
     if args.host_prefix:
         host_prefix = args.host_prefix[0]
@@ -357,7 +1044,84 @@ def main():
         boxes = args.boxes
         logger.info('Custom list of boxes will be used: %s', list2str(boxes))
 
-    if not calibrate:
+    if args.cards:
+        if not all(0 <= card < 5 for card in args.cards):
+            sys.exit('Card numbers have to be between 0 and 4')
+        cards = sorted(set(args.cards))
+        logger.info('Only the following cards will be used: %s', list2str(cards))
+
+    if args.channels:
+        if not all(0 <= channel < 8 for channel in args.channels):
+            sys.exit('Channel numbers have to be between 0 and 7')
+        channels = sorted(set(args.channels))
+        logger.info('Only the following channels will be used: %s', list2str(channels))
+
+    session = SessionConfig()
+    if args.daemon:
+        session.daemon_socket = args.daemon
+        logger.info('The boxes will be accessed via the CBHV daemon listening on %s', session.daemon_socket)
+
+    if args.pipeline:
+        if args.pipeline[0] < 1:
+            sys.exit('The number of pipelined commands has to be at least 1')
+        session.window = args.pipeline[0]
+        logger.info('Up to %d commands will be sent to a box without waiting for the responses', session.window)
+
+    if args.timeout:
+        if args.timeout[0] <= 0:
+            sys.exit('The timeout has to be positive')
+        session.timeout = args.timeout[0]
+        if args.daemon:
+            logger.warning('The timeout of the daemon is set when starting it')
+        logger.info('Waiting up to %g seconds for the response to a command', session.timeout)
+
+    if args.record and args.replay:
+        sys.exit('--record and --replay can not be used together')
+    if args.record:
+        if not check_directory(args.record[0], force, verbose, write=True):
+            sys.exit('The transcript directory %s cannot be used' % args.record[0])
+        session.record_dir = get_path(args.record[0])
+        if args.daemon:
+            logger.warning('Sessions via the daemon are not recorded')
+        # the transcripts of a previous recording of these boxes are replaced
+        for box in boxes:
+            if os.path.isfile(transcript_path(session.record_dir, host_prefix % box)):
+                os.remove(transcript_path(session.record_dir, host_prefix % box))
+        logger.info('The sessions with the boxes will be recorded to %s', session.record_dir)
+    if args.replay:
+        session.replay_dir = get_path(args.replay[0])
+        if args.replay_speed:
+            if args.replay_speed[0] <= 0:
+                sys.exit('The replay speed has to be positive')
+            session.replay_speed = args.replay_speed[0]
+        logger.info('The sessions recorded in %s will be replayed %g times faster',
+                    session.replay_dir, session.replay_speed)
+
+    if args.jobs:
+        if args.jobs[0] < 1:
+            sys.exit('The number of parallel jobs has to be at least 1')
+        jobs = args.jobs[0]
+        logger.info('Up to %d boxes will be handled in parallel', jobs)
+
+    if args.log_dir:
+        if not check_directory(args.log_dir[0], force, verbose, write=True):
+            sys.exit('The log directory %s cannot be used' % args.log_dir[0])
+        log_dir = get_path(args.log_dir[0])
+        logger.info('Log files per box will be written to %s', log_dir)
+
+    if args.scan:
+        if args.daemon:
+            logger.warning('The scan connects to the boxes directly, the daemon is not used')
+        if args.scan_timeout:
+            results = scan_boxes(logger, host_prefix, boxes, args.scan_timeout[0], args.scan_timeout[0])
+        else:
+            results = scan_boxes(logger, host_prefix, boxes)
+        if not print_scan(logger, results):
+            sys.exit(1)
+        print_color('Done!', 'GREEN')
+        return
+
+    if not calibrate and not analyse:
         logger.info('Checking arguments for setting CB HV values . . .')
         if reset and args.corr_file:
             logger.warning('Reset issued and custom correction file given, '
@@ -370,23 +1134,33 @@ def main():
         if not reset:
             # read values from given file
             logger.debug('Try to read file ' + gains_file)
-            with open(gains_file, 'r') as gains:
-                hv_gains = gains.readlines()
+            hv_gains = read_gains_file(logger, gains_file)
             if not hv_gains:
-                logger.error('No lines read from file %s, please check the provided file', gains_file)
+                logger.error('No values read from file %s, please check the provided file', gains_file)
+                sys.exit(1)
+            logger.info('Successfully read values for %d channels from file %s', len(hv_gains), gains_file)
+            # make sure all values are present before connecting to any box
+            if channels:
+                # the values are stored per card, the other channels are written from the file as well
+                logger.warning('The values of all channels of the chosen cards will be written')
+            if not check_gains(logger, hv_gains, boxes, cards):
+                logger.error('The file %s is incomplete or contains invalid values for the '
+                             'chosen boxes', gains_file)
                 sys.exit(1)
-            logger.info('Successfully read %d lines from file %s', len(hv_gains), gains_file)
     else:
-        logger.info('Preparing measurement of CB HV correction values . . .')
-        # check if the output path exists and is writable
+        if calibrate:
+            logger.info('Preparing measurement of CB HV correction values . . .')
+        else:
+            logger.info('Preparing analysis of the measured CB HV correction values . . .')
+        # check if the output path exists and is writable, only reading is needed for the analysis
         if args.output:
-            if not check_directory(args.output[0], force, verbose, write=True):
+            if not check_directory(args.output[0], force, verbose, write=calibrate):
                 sys.exit('The output directory %s cannot be used' % args.output[0])
             output = get_path(args.output[0])
             logger.info('Setting custom output directory: %s', output)
         else:
             logger.info('Default output directory will be used')
-            if not check_directory(output, True, verbose, write=True):
+            if not check_directory(output, calibrate, verbose, write=calibrate):
                 sys.exit('The output directory %s cannot be used' % output)
         if args.out_file:
             out_file = args.out_file[0]
@@ -403,16 +1177,132 @@ def main():
         if args.time:
             waiting_time = args.time[0]
             logger.info('Set waiting time for applying calibration values to %d seconds', waiting_time)
+        if args.settle_tol:
+            settling = Settling(args.settle_tol[0])
+            if args.settle_samples:
+                settling.samples = max(2, args.settle_samples[0])
+            if args.max_wait:
+                settling.max_wait = args.max_wait[0]
+            logger.info('Adaptive settling detection: %d readings within %g V, at most %g seconds',
+                        settling.samples, settling.tolerance, settling.max_wait)
+        if session.replay_dir and session.replay_speed != 1:
+            # the waiting times are shortened like the responses of the replayed boxes
+            waiting_time = waiting_time/session.replay_speed
+            if settling:
+                settling.max_wait /= session.replay_speed
+                settling.interval /= session.replay_speed
+        if args.adaptive:
+            adaptive = args.adaptive[0]
+            logger.info('Adaptive stepping: setpoints are added where a channel deviates by more '
+                        'than %g V from its fit, use -a for the analysis of the non-uniform setpoints',
+                        adaptive)
+        if calibrate:
+            monitor = MeasurementMonitor(args.on_problem[0] if args.on_problem else 'warn', channels=channels)
+            if args.max_residual:
+                monitor.max_residual = args.max_residual[0]
+            logger.info('Online fits flag channels deviating by more than %g V, action: %s',
+                        monitor.max_residual, monitor.on_problem)
+        if args.gains_output:
+            gains_file = args.gains_output[0]
+            logger.info('The results of the analysis will be written to %s', gains_file)
+        if cards or channels:
+            logger.info('The results of the chosen cards and channels will be merged into %s', gains_file)
+        if args.report:
+            report = args.report[0]
+            if not analyse:
+                logger.warning('The report is only written by the analysis, use -a/--analyse')
+            elif args.clear_cache:
+                clear_cache(logger, report)
+        elif args.clear_cache:
+            logger.warning('--clear-cache is only used together with --report')
+        if args.columnar:
+            columnar_file = args.columnar[0]
+            if not calibrate and not os.path.isfile(columnar_file):
+                sys.exit('The columnar file %s does not exist' % columnar_file)
+            logger.info('Columnar measurement file: %s', columnar_file)
 
 
+    if not calibrate and analyse:
+        if not analyse_measurements(logger, output, gains_file, boxes, columnar=columnar_file,
+                                    report=report, jobs=jobs, cards=cards, channels=channels):
+            sys.exit('Failed analysing CB HV correction values')
+        print_color('Done!', 'GREEN')
+        return
+
+    journal = None
+    if calibrate:
+        # every measured point is recorded, this allows to resume an interrupted measurement
+        journal_path = pjoin(dirname(output), JOURNAL_FILE)
+        journal_settings = {'v_range': v_range, 'stepping': stepping}
+        if adaptive:
+            journal_settings['adaptive'] = adaptive
+        if cards:
+            journal_settings['cards'] = cards
+        if channels:
+            journal_settings['channels'] = channels
+        journal = Journal(journal_path, journal_settings, args.resume)
+        if args.resume:
+            logger.info('Resume measurement, %d points have already been measured according to %s',
+                        len(journal.points), journal_path)
+            if journal.settings_changed:
+                logger.warning('The measurement was started with different settings: %s',
+                               journal.previous_settings)
+        else:
+            logger.debug('Measured points will be recorded in ' + journal_path)
+
+    columnar = None
+    if calibrate and columnar_file:
+        columnar = ColumnarWriter(columnar_file, {
+            'host_prefix': host_prefix, 'boxes': boxes, 'v_range': v_range, 'stepping': stepping,
+            'waiting_time': waiting_time, 'settling': bool(settling), 'adaptive': adaptive,
+            'started': time_str('%Y-%m-%d %H:%M:%S')}, args.resume)
+
     print_color('Start connecting to the CBHV boxes', 'GREEN')
 
-    if not calibrate:
-        if not set_values(logger, host_prefix, hv_gains, reset, boxes):
-            sys.exit('Failed setting CB HV values')
+    if args.verify and not calibrate:
+        success = verify_values(logger, host_prefix, hv_gains, reset, boxes, jobs, log_dir, cards, session)
+    elif not calibrate:
+        success = set_values(logger, host_prefix, hv_gains, reset, boxes, jobs or 1, log_dir, args.diff,
+                             args.verify_apply, cards, session)
+    elif args.sweep:
+        success = sweep_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes,
+                               jobs, log_dir, settling, journal, columnar, adaptive, monitor, cards, channels,
+                               session)
     else:
-        if not measure_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes):
+        success = measure_values(logger, host_prefix, output, stepping, v_range, waiting_time, boxes,
+                                 settling, journal, columnar, adaptive, monitor, cards, channels, session)
+
+    if journal:
+        journal.close()
+    if columnar:
+        columnar.close()
+        logger.info('Stored %d points in %s', columnar.records, columnar_file)
+
+    # the metrics are written for failed runs as well, they help finding the cause
+    METRICS.print_summary(logger)
+    if args.metrics_json:
+        METRICS.write_json(args.metrics_json[0])
+        logger.info('Metrics written to %s', args.metrics_json[0])
+    if args.metrics_prom:
+        METRICS.write_prometheus(args.metrics_prom[0])
+        logger.info('Metrics written to %s', args.metrics_prom[0])
+
+    if not success:
+        if calibrate:
             sys.exit('Failed measuring CB HV correction values')
+        if args.verify:
+            sys.exit('Verification of the CB HV values failed')
+        sys.exit('Failed setting CB HV values')
+
+    if calibrate and analyse:
+        print_color('Start analysing the measured correction values', 'GREEN')
+        if not analyse_measurements(logger, output, gains_file, boxes, columnar=columnar_file,
+                                    report=report, jobs=jobs, cards=cards, channels=channels):
+            sys.exit('Failed analysing CB HV correction values')
+    elif calibrate and args.gains_output:
+        # the online fits use the same fit range, so no separate analysis is needed
+        if not write_online_gains(logger, monitor, gains_file, merge=bool(cards or channels)):
+            sys.exit('Failed writing the online fits of the CB HV correction values')
 
     print_color('Done!', 'GREEN')
 
@@ -0,0 +1,198 @@
+"""
+Analysis of the correction value measurements without ROOT:
+all card files are loaded into arrays and the linear fits of
+(ADC - setpoint) vs. setpoint are done for all channels at once,
+which replaces the cbhv_calibrate_boxes.C macro
+"""
+
+import os
+from math import isfinite
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from modules.columnar import load_columnar, measurement_arrays
+from modules.report import write_report
+from modules.hv_gains import read_gains_file, N_CARDS, N_CHANNELS
+
+# fit range used for the linear fits, same as in cbhv_calibrate_boxes.C
+FIT_RANGE = (1400., 1650.)
+
+
+def check_numpy(logger):
+    """Check if NumPy is available, which is needed for the analysis"""
+    if np is None:
+        logger.error('NumPy is needed for the analysis, please install it (e.g. pip install numpy)')
+        return False
+    return True
+
+
+def read_card_file(path):
+    """Read a measurement file of a single card and return the setpoints
+    and the ADC values of all channels as arrays of shape (n) and (n, 8)"""
+    setpoints, adc = [], []
+    with open(path, 'r') as card_file:
+        for line in card_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            # Setpoint,Date,Level,CH0,...,CH7 followed by optional additional fields
+            vals = line.split(',')
+            if len(vals) < 3 + N_CHANNELS:
+                continue
+            try:
+                adc.append([float(val) for val in vals[3:3+N_CHANNELS]])
+                setpoints.append(float(vals[0]))
+            except ValueError:
+                continue
+    return np.array(setpoints, dtype=float), np.array(adc, dtype=float).reshape(-1, N_CHANNELS)
+
+
+def load_measurements(logger, input_format, boxes, cards=None):
+    """Load the measurement files of all cards (or the given cards) of the given boxes; returns the list of
+    (box, card) keys and arrays for setpoints and ADC values with shape (cards, points)
+    and (cards, points, 8), missing points of shorter files are filled with NaN"""
+    keys, data = [], []
+    for box in boxes:
+        for card in (range(N_CARDS) if cards is None else cards):
+            path = input_format % (box, card)
+            if not os.path.isfile(path):
+                logger.warning("File '%s' not found", path)
+                continue
+            setpoints, adc = read_card_file(path)
+            if not setpoints.size:
+                logger.warning("File '%s' contains no measurements", path)
+                continue
+            keys.append((box, card))
+            data.append((setpoints, adc))
+
+    n_points = max((len(setpoints) for setpoints, _ in data), default=0)
+    setpoints = np.full((len(data), n_points), np.nan)
+    adc = np.full((len(data), n_points, N_CHANNELS), np.nan)
+    for i, (card_setpoints, card_adc) in enumerate(data):
+        setpoints[i, :len(card_setpoints)] = card_setpoints
+        adc[i, :len(card_setpoints)] = card_adc
+
+    return keys, setpoints, adc
+
+
+def linear_fit(x, y, weights):
+    """Weighted least squares fit of y = offset + slope*x along the last axis,
+    entries with zero weight are ignored; returns slope and offset arrays,
+    NaN if less than two points can be used"""
+    s = weights.sum(axis=-1)
+    sx = (weights*x).sum(axis=-1)
+    sy = (weights*y).sum(axis=-1)
+    sxx = (weights*x*x).sum(axis=-1)
+    sxy = (weights*x*y).sum(axis=-1)
+    det = s*sxx - sx*sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(det != 0, (s*sxy - sx*sy)/det, np.nan)
+        offset = np.where(det != 0, (sxx*sy - sx*sxy)/det, np.nan)
+    return slope, offset
+
+
+def fit_channels(setpoints, adc, fit_range=FIT_RANGE):
+    """Fit (ADC - setpoint) vs. setpoint for all channels at once using all points
+    within the fit range; returns slope and offset arrays of shape (cards, 8)"""
+    x = np.broadcast_to(setpoints[..., np.newaxis], adc.shape)
+    y = adc - x
+    valid = np.isfinite(y) & (x >= fit_range[0]) & (x <= fit_range[1])
+    weights = valid.astype(float)
+    x = np.where(valid, x, 0.)
+    y = np.where(valid, y, 0.)
+    # move the channel axis in front of the points axis to fit along the last axis
+    return linear_fit(np.moveaxis(x, -1, -2), np.moveaxis(y, -1, -2), np.moveaxis(weights, -1, -2))
+
+
+def fitted(slope, offset):
+    """Check if a channel has a valid fit result, failed fits are NaN or None"""
+    return slope is not None and offset is not None and isfinite(slope) and isfinite(offset)
+
+
+def write_gains_file(path, keys, slopes, offsets):
+    """Write the fit results in the format of cbhv_calibrate_boxes.C, channels without
+    a valid fit are left out; returns the number of written channels"""
+    written = 0
+    with open(path, 'w', newline='') as out:
+        out.write('#CardNo,Channel,Slope,Offset\n')
+        for (box, card), card_slopes, card_offsets in zip(keys, slopes, offsets):
+            for channel in range(N_CHANNELS):
+                if not fitted(card_slopes[channel], card_offsets[channel]):
+                    continue
+                out.write('%d,%d,%d,%f,%f\r\n' % (box, card, channel,
+                                                  card_slopes[channel], card_offsets[channel]))
+                written += 1
+    return written
+
+
+def update_gains_file(logger, path, keys, slopes, offsets, channels=None):
+    """Merge the fit results of the given cards into an existing gains file in place, only the given
+    channels (default all) are replaced and all other lines are kept as they are, as well as the lines of
+    channels without a valid fit; the file is created if it doesn't exist yet;
+    returns the number of replaced channels, None if the file is invalid"""
+    gains = {}
+    if os.path.isfile(path):
+        gains = read_gains_file(logger, path)
+        if gains is None:
+            return None
+    channels = range(N_CHANNELS) if channels is None else channels
+    replaced = 0
+    for (box, card), card_slopes, card_offsets in zip(keys, slopes, offsets):
+        for channel in channels:
+            if not fitted(card_slopes[channel], card_offsets[channel]):
+                continue
+            gains[(box, card, channel)] = ('%f' % card_slopes[channel], '%f' % card_offsets[channel])
+            replaced += 1
+    # written to a temporary file first to not lose the other values if interrupted
+    with open(path + '.tmp', 'w', newline='') as out:
+        out.write('#CardNo,Channel,Slope,Offset\n')
+        for key in sorted(gains):
+            out.write('%d,%d,%d,%s,%s\r\n' % (key + gains[key]))
+    os.replace(path + '.tmp', path)
+    return replaced
+
+
+def analyse_measurements(logger, input_format, output, boxes, fit_range=FIT_RANGE, columnar=None, report=None,
+                         jobs=None, cards=None, channels=None):
+    """Load the measurements of all given boxes, fit all channels and write the gains file;
+    if a columnar file is given, the measurement is read from it instead of the card files;
+    if report is given, an HTML report with the plots of all cards is written to this file
+    using up to jobs processes; if cards or channels are given, only these are analysed
+    and merged into the existing gains file instead of replacing it"""
+    if not check_numpy(logger):
+        return False
+
+    if columnar:
+        _, records = load_columnar(columnar)
+        keys, setpoints, adc = measurement_arrays(records, boxes, cards)
+    else:
+        keys, setpoints, adc = load_measurements(logger, input_format, boxes, cards)
+    if not keys:
+        logger.error('No measurement files found')
+        return False
+    logger.info('Loaded the measurements of %d cards with up to %d setpoints', len(keys), setpoints.shape[1])
+
+    slopes, offsets = fit_channels(setpoints, adc, fit_range)
+    failed = np.argwhere(~np.isfinite(slopes) | ~np.isfinite(offsets))
+    if channels is not None:
+        failed = failed[np.isin(failed[:, 1], channels)]
+    for card_idx, channel in failed:
+        logger.warning('Fit failed for box %d, card %d, channel %d, too few points in range '
+                       '[%g, %g], no values are written for it', *keys[card_idx], channel, *fit_range)
+    if report:
+        write_report(logger, report, keys, setpoints, adc, slopes, offsets, fit_range, jobs)
+
+    if cards is None and channels is None:
+        written = write_gains_file(output, keys, slopes, offsets)
+        logger.info('Saved values of %d channels to %s', written, output)
+    else:
+        replaced = update_gains_file(logger, output, keys, slopes, offsets, channels)
+        if replaced is None:
+            logger.error('Could not merge the values into %s', output)
+            return False
+        logger.info('Updated the values of %d channels in %s', replaced, output)
+
+    return not failed.size
@@ -0,0 +1,91 @@
+"""
+Helper to run a task for several CBHV boxes concurrently;
+every box gets its own log stream and the results are collected
+to print a summary after all boxes have been handled
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as pjoin
+import logging
+
+from modules.color import print_color
+
+
+class BoxLogger(logging.LoggerAdapter):
+    """Logger adapter which prefixes every message with the host name of the box"""
+
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['host'], msg), kwargs
+
+
+def default_logger(name):
+    """Logger used by the connections to the boxes if none is given"""
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                        datefmt='%Y-%m-%d %I:%M:%S', level=logging.INFO)
+    return logging.getLogger(name)
+
+
+def describe_error(exc):
+    """Type and message of an exception for the log; timeouts are raised without a message"""
+    message = str(exc)
+    if not message and isinstance(exc, (TimeoutError, asyncio.TimeoutError)):
+        message = 'timed out'
+    return '%s: %s' % (type(exc).__name__, message or repr(exc))
+
+
+def box_logger(logger, host, log_dir=None):
+    """Create a logger for the given host which passes its records on to logger;
+    if log_dir is given, the records of this box are additionally written to <log_dir>/<host>.log"""
+    log = logging.Logger('%s.%s' % (logger.name, host))
+    log.parent = logger
+    if log_dir:
+        handler = logging.FileHandler(pjoin(log_dir, '%s.log' % host.replace(':', '_')), mode='w')
+        handler.setFormatter(logging.Formatter('[%(asctime)s] [%(levelname)s]  %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S'))
+        log.addHandler(handler)
+    return BoxLogger(log, {'host': host})
+
+
+def close_box_logger(log):
+    """Close the file handlers which may have been attached to a box logger"""
+    for handler in log.logger.handlers[:]:
+        handler.close()
+        log.logger.removeHandler(handler)
+
+
+def run_boxes(logger, host_prefix, boxes, task, jobs=1, log_dir=None):
+    """Run task(log, host, box) for every box with up to jobs boxes handled at the same time;
+    returns a dict containing the result (True or False) of every box"""
+    jobs = max(1, min(jobs, len(boxes)))
+    if jobs > 1:
+        logger.info('Handling %d boxes with up to %d parallel jobs', len(boxes), jobs)
+
+    def handle_box(box):
+        host = host_prefix % box
+        log = box_logger(logger, host, log_dir)
+        try:
+            return bool(task(log, host, box))
+        except Exception as e:
+            log.error('Failed with %s', describe_error(e))
+            return False
+        finally:
+            close_box_logger(log)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = dict(zip(boxes, pool.map(handle_box, boxes)))
+
+    return results
+
+
+def print_summary(logger, host_prefix, results):
+    """Print a summary of the results per box, returns True if all boxes succeeded"""
+    failed = [box for box, success in results.items() if not success]
+    logger.info('Summary for %d boxes:', len(results))
+    for box, success in results.items():
+        print_color('    box %2d  %-12s %s' % (box, host_prefix % box, 'OK' if success else 'FAILED'),
+                    'GREEN' if success else 'RED')
+    if failed:
+        logger.warning('%d of %d boxes failed: %s', len(failed), len(results),
+                       ', '.join(map(str, failed)))
+    return not failed
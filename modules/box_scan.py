@@ -0,0 +1,104 @@
+"""
+Fast health scan of the CBHV boxes: all boxes are probed at the same time with short
+timeouts and without the usual settling time after connecting; for every box the
+reachability, the connect and prompt latencies, the clock of the box and the REG state
+of the EEPROM are reported within a few seconds
+"""
+
+import re
+import asyncio
+from time import perf_counter, time, mktime, strptime
+
+from modules.cbhv_client import CBHVClient
+from modules.box_pool import BoxLogger
+from modules.eemem import parse_eemem
+from modules.color import print_color
+
+CONNECT_TIMEOUT = 1.
+RESPONSE_TIMEOUT = 1.
+# the clock is returned as 'HH:MM:SS dd.mm.YYYY', the order of time and date is not relied on
+TIME_PATTERN = re.compile(r'\b(\d{1,2}:\d{2}:\d{2})\b')
+DATE_PATTERN = re.compile(r'\b(\d{1,2}\.\d{1,2}\.\d{4})\b')
+
+
+def parse_clock(response):
+    """Return the time of the box as timestamp from the response of the time command, None if invalid"""
+    time_match, date_match = TIME_PATTERN.search(response), DATE_PATTERN.search(response)
+    if not time_match or not date_match:
+        return None
+    try:
+        return mktime(strptime('%s %s' % (date_match.group(1), time_match.group(1)), '%d.%m.%Y %H:%M:%S'))
+    except ValueError:
+        return None
+
+
+async def scan_box(host, logger, connect_timeout=CONNECT_TIMEOUT, timeout=RESPONSE_TIMEOUT):
+    """Probe a single box, returns a dict with the results; the time between sending an empty
+    command and receiving the prompt is used as prompt latency"""
+    result = {'host': host, 'reachable': False, 'connect': None, 'latency': None, 'clock': None,
+              'skew': None, 'REG': None, 'error': None}
+    client = CBHVClient(host, logger=BoxLogger(logger, {'host': host}), timeout=timeout,
+                        connect_timeout=connect_timeout, retries=0, settle=0.)
+    try:
+        start = perf_counter()
+        await client.connect()
+        result['connect'] = perf_counter() - start
+        start = perf_counter()
+        if await client.send_command('') is False:
+            result['error'] = 'no prompt'
+            return result
+        result['latency'] = perf_counter() - start
+        result['reachable'] = True
+        clock = await client.send_command('time', return_response=True)
+        if clock is not False:
+            result['clock'] = clock
+            timestamp = parse_clock(clock)
+            if timestamp is not None:
+                result['skew'] = timestamp - time()
+        eemem = await client.send_command('eemem print', return_response=True)
+        if eemem is not False:
+            result['REG'] = parse_eemem(eemem)['REG']
+    except asyncio.TimeoutError:
+        result['error'] = 'timeout'
+    except (EOFError, OSError) as e:
+        result['error'] = str(e) or type(e).__name__
+    finally:
+        await client.close()
+    return result
+
+
+async def scan_hosts(hosts, logger, connect_timeout=CONNECT_TIMEOUT, timeout=RESPONSE_TIMEOUT):
+    return await asyncio.gather(*(scan_box(host, logger, connect_timeout, timeout) for host in hosts))
+
+
+def scan_boxes(logger, host_prefix, boxes, connect_timeout=CONNECT_TIMEOUT, timeout=RESPONSE_TIMEOUT):
+    """Probe all given boxes concurrently, returns a dict with the result of every box"""
+    hosts = [host_prefix % box for box in boxes]
+    start = perf_counter()
+    results = asyncio.run(scan_hosts(hosts, logger, connect_timeout, timeout))
+    logger.info('Scanned %d boxes in %.1f seconds', len(boxes), perf_counter() - start)
+    return dict(zip(boxes, results))
+
+
+def print_scan(logger, results, max_skew=60.):
+    """Print a table of the scan results, returns True if all boxes are reachable;
+    clocks deviating by more than max_skew seconds are highlighted"""
+    print('%5s %-16s %-12s %13s %12s %-20s %9s %4s' % ('box', 'host', 'status', 'connect [ms]',
+                                                     'prompt [ms]', 'clock', 'skew [s]', 'REG'))
+    for box, result in results.items():
+        if not result['reachable']:
+            print_color('%5d %-16s %-12s %s' % (box, result['host'], 'UNREACHABLE', result['error'] or ''), 'RED')
+            continue
+        skew = result['skew']
+        print_color('%5d %-16s %-12s %13.1f %12.1f %-20s %9s %4s' % (
+            box, result['host'], 'OK', result['connect']*1e3, result['latency']*1e3,
+            result['clock'] or '-', '-' if skew is None else '%+.0f' % skew, result['REG'] or '-'),
+            'GREEN' if skew is not None and abs(skew) <= max_skew else 'YELLOW')
+    reachable = [box for box, result in results.items() if result['reachable']]
+    unreachable = [box for box in results if box not in reachable]
+    if unreachable:
+        logger.warning('%d of %d boxes are not reachable: %s', len(unreachable), len(results),
+                       ', '.join(map(str, unreachable)))
+        if reachable:
+            logger.info('Use -b %s to run with the reachable boxes only', ' '.join(map(str, reachable)))
+    return not unreachable
@@ -0,0 +1,245 @@
+"""
+History of the source calibrations stored in cbhv_calibration_files:
+all calibcurves_YYYY_MM.txt files are loaded into a single (campaign x 720 channels) array
+with NaN for channels missing in a file (the holes), which allows to compare the campaigns
+for all channels at once. The array is cached next to the files and only files which
+changed since the last run are read again.
+
+Examples:
+    python3 -m modules.calib_history
+    python3 -m modules.calib_history --changes 2019_06 2022_05 -n 20
+    python3 -m modules.calib_history --drift 30 --reference 2016_06
+    python3 -m modules.calib_history --trend 12 13 14
+"""
+
+import sys
+import os
+import re
+import argparse
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+N_CB_CHANNELS = 720
+CALIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'cbhv_calibration_files')
+FILE_PATTERN = re.compile(r'^calibcurves_(\d{4})_(\d{2})\.txt$')
+CACHE_FILE = '.calib_history_cache.npz'
+
+
+def read_campaign(path):
+    """Read a calibcurves file with lines 'channel<tab>voltage' into an array of 720 voltages,
+    channels which are not contained in the file are NaN"""
+    voltages = np.full(N_CB_CHANNELS, np.nan)
+    with open(path, 'r') as calib_file:
+        for line in calib_file:
+            vals = line.split()
+            if len(vals) != 2:
+                continue
+            try:
+                channel, voltage = int(vals[0]), float(vals[1])
+            except ValueError:
+                continue
+            if 0 <= channel < N_CB_CHANNELS:
+                voltages[channel] = voltage
+    return voltages
+
+
+def write_campaign(path, voltages):
+    """Write the voltages of all channels in the format of the calibcurves files,
+    channels with NaN (holes) are skipped like in CBCalibrationGraphs.C"""
+    with open(path, 'w') as out:
+        for channel, voltage in enumerate(voltages):
+            if np.isfinite(voltage):
+                out.write('%i\t%i\n' % (channel, int(voltage)))
+
+
+def campaign_name(name):
+    """Normalise a campaign given as YYYY_MM, YYYY-MM or file name to YYYY_MM"""
+    match = re.search(r'(\d{4})[_-](\d{2})', name)
+    if not match:
+        raise ValueError('Invalid campaign %s, expected YYYY_MM' % name)
+    return '%s_%s' % match.groups()
+
+
+class CalibHistory:
+    """Voltages of all campaigns: names like '2016_06', the campaign dates as decimal years
+    and the voltages with shape (campaigns, 720)"""
+
+    def __init__(self, names, voltages):
+        self.names = list(names)
+        self.voltages = voltages
+        self.years = np.array([int(name[:4]) + (int(name[5:7]) - 1)/12. for name in self.names])
+
+    def index(self, name):
+        """Index of a campaign; for a date without campaign the last campaign before it is used"""
+        name = campaign_name(name)
+        if name in self.names:
+            return self.names.index(name)
+        earlier = [i for i, campaign in enumerate(self.names) if campaign < name]
+        if not earlier:
+            raise ValueError('No campaign at or before %s' % name)
+        return earlier[-1]
+
+    def campaign(self, name):
+        return self.voltages[self.index(name)]
+
+    def trend(self):
+        """Slope of a linear fit of the voltage vs. time per channel in V/year using all campaigns
+        containing the channel; NaN for channels with less than two campaigns"""
+        valid = np.isfinite(self.voltages)
+        weights = valid.astype(float)
+        x = np.where(valid, self.years[:, np.newaxis], 0.)
+        y = np.where(valid, self.voltages, 0.)
+        s = weights.sum(axis=0)
+        sx, sy = x.sum(axis=0), y.sum(axis=0)
+        det = s*(x*x).sum(axis=0) - sx*sx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(det > 0, (s*(x*y).sum(axis=0) - sx*sy)/det, np.nan)
+
+    def changes(self, first, second):
+        """Voltage difference of all channels between two campaigns, NaN for holes"""
+        return self.campaign(second) - self.campaign(first)
+
+    def largest_changes(self, first, second, count=10):
+        """Channels with the largest absolute change between two campaigns,
+        returns the channels and their changes sorted by the absolute change"""
+        diff = self.changes(first, second)
+        channels = np.argsort(-np.nan_to_num(np.abs(diff), nan=-1.), kind='stable')[:count]
+        channels = channels[np.isfinite(diff[channels])]
+        return channels, diff[channels]
+
+    def drifting(self, threshold, reference=None):
+        """Channels which deviated by more than threshold volts from the reference campaign
+        (default the first one) in any campaign; returns the channels and their maximum deviation"""
+        ref = self.campaign(reference) if reference else self.voltages[0]
+        # fmax ignores NaN, it is only returned for channels which are holes in all campaigns
+        max_deviation = np.fmax.reduce(np.abs(self.voltages - ref), axis=0)
+        with np.errstate(invalid='ignore'):
+            channels = np.flatnonzero(max_deviation > threshold)
+        return channels, max_deviation[channels]
+
+
+def campaign_files(directory):
+    """Sorted list of all calibcurves files in the directory"""
+    return sorted(name for name in os.listdir(directory) if FILE_PATTERN.match(name))
+
+
+def load_history(logger, directory=CALIB_DIR, use_cache=True):
+    """Load all campaigns of the directory; the array is cached in the directory and files
+    are only read again if their modification time or size changed"""
+    files = campaign_files(directory)
+    if not files:
+        logger.error('No calibcurves files found in %s', directory)
+        return None
+    signatures = []
+    for name in files:
+        stat = os.stat(os.path.join(directory, name))
+        signatures.append((stat.st_mtime_ns, stat.st_size))
+
+    cache_path = os.path.join(directory, CACHE_FILE)
+    cached = {}
+    if use_cache and os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                for name, signature, voltages in zip(cache['files'], cache['signatures'], cache['voltages']):
+                    cached[str(name)] = (tuple(int(val) for val in signature), voltages)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Ignoring invalid cache %s: %s', cache_path, e)
+
+    voltages = np.empty((len(files), N_CB_CHANNELS))
+    reread = 0
+    for i, (name, signature) in enumerate(zip(files, signatures)):
+        if name in cached and cached[name][0] == signature:
+            voltages[i] = cached[name][1]
+        else:
+            voltages[i] = read_campaign(os.path.join(directory, name))
+            reread += 1
+    logger.debug('Read %d of %d calibration files, %d from the cache',
+                 reread, len(files), len(files) - reread)
+
+    if use_cache and (reread or len(cached) != len(files)):
+        try:
+            np.savez(cache_path, files=np.array(files), signatures=np.array(signatures, dtype=np.int64),
+                     voltages=voltages)
+        except OSError as e:
+            logger.warning('Could not write the cache %s: %s', cache_path, e)
+
+    return CalibHistory([campaign_name(name) for name in files], voltages)
+
+
+def print_overview(history):
+    """Print the number of channels and the voltage statistics per campaign"""
+    print('%-9s %9s %9s %9s %9s %9s' % ('campaign', 'channels', 'mean [V]', 'std [V]', 'min [V]', 'max [V]'))
+    for name, voltages in zip(history.names, history.voltages):
+        print('%-9s %9d %9.1f %9.1f %9.0f %9.0f' % (name, np.isfinite(voltages).sum(), np.nanmean(voltages),
+                                                    np.nanstd(voltages), np.nanmin(voltages),
+                                                    np.nanmax(voltages)))
+
+
+def main():
+    """Query the history of the source calibrations"""
+    parser = argparse.ArgumentParser(description='Compare the source calibrations of the CBHV values')
+    parser.add_argument('-d', '--directory', type=str, default=CALIB_DIR,
+                        help='Directory containing the calibcurves files, default cbhv_calibration_files')
+    parser.add_argument('--changes', nargs=2, type=str, metavar=('FROM', 'TO'),
+                        help='Print the channels with the largest changes between two campaigns (YYYY_MM)')
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='Number of channels printed for --changes, default 10')
+    parser.add_argument('--drift', type=float, metavar='V',
+                        help='Print the channels which deviated by more than V volts from the reference')
+    parser.add_argument('--reference', type=str, metavar='YYYY_MM',
+                        help='Reference campaign for --drift, default the first one')
+    parser.add_argument('--trend', nargs='*', type=int, metavar='channel',
+                        help='Print the voltages of all campaigns and the trend in V/year of the given '
+                        'channels, or the channels with the steepest trends if none are given')
+    parser.add_argument('--no-cache', action='store_true', help='Read all files again and skip the cache')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print additional output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('CBHV calibration history')
+    if np is None:
+        sys.exit('NumPy is needed for the calibration history, please install it (e.g. pip install numpy)')
+
+    history = load_history(logger, args.directory, not args.no_cache)
+    if history is None:
+        sys.exit(1)
+
+    try:
+        if args.changes:
+            channels, diff = history.largest_changes(*args.changes, count=args.number)
+            first, second = (history.index(name) for name in args.changes)
+            print('Largest changes from %s to %s:' % (history.names[first], history.names[second]))
+            for channel, change in zip(channels, diff):
+                print('%5d %6.0f -> %6.0f  %+6.0f V' % (channel, history.voltages[first, channel],
+                                                        history.voltages[second, channel], change))
+        elif args.drift is not None:
+            channels, deviation = history.drifting(args.drift, args.reference)
+            print('%d channels deviated by more than %g V from %s:' % (
+                len(channels), args.drift, history.names[history.index(args.reference)]
+                if args.reference else history.names[0]))
+            for channel, dev in sorted(zip(channels, deviation), key=lambda item: -item[1]):
+                print('%5d %6.0f V' % (channel, dev))
+        elif args.trend is not None:
+            trend = history.trend()
+            channels = args.trend or np.argsort(-np.nan_to_num(np.abs(trend)))[:args.number]
+            if any(not 0 <= channel < N_CB_CHANNELS for channel in channels):
+                raise ValueError('Channels have to be between 0 and %d' % (N_CB_CHANNELS - 1))
+            print('channel ' + ' '.join('%7s' % name for name in history.names) + '  trend [V/year]')
+            for channel in channels:
+                print('%7d ' % channel + ' '.join('%7.0f' % val for val in history.voltages[:, channel])
+                      + '  %+8.1f' % trend[channel])
+        else:
+            print_overview(history)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()
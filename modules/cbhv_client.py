@@ -0,0 +1,277 @@
+"""
+Asyncio based client for the command protocol of the CBHV boxes:
+commands are terminated with \\r\\n and every response ends with the '>' prompt;
+all reads are guarded by timeouts and failed commands are retried after reconnecting
+"""
+
+import asyncio
+from time import perf_counter
+
+from modules.metrics import METRICS
+from modules.box_pool import default_logger
+
+# telnet protocol bytes needed to refuse the option negotiation of the telnet server
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+
+
+def split_host(hostname, port=23):
+    """Split an optional port given as 'host:port' from the hostname"""
+    if hostname and hostname.count(':') == 1:
+        host, _, port_str = hostname.partition(':')
+        if port_str.isdigit():
+            return host, int(port_str)
+    return hostname, port
+
+
+class TelnetFilter:
+    """Remove telnet commands from the received data and collect the replies
+    which refuse all options requested by the server"""
+
+    def __init__(self):
+        self.pending = b''
+        self.replies = b''
+
+    def feed(self, data):
+        """Return the cooked data, incomplete telnet commands are kept for the next call"""
+        data = self.pending + data
+        self.pending = b''
+        cooked = bytearray()
+        i = 0
+        while i < len(data):
+            c = data[i]
+            if c != IAC:
+                # telnetlib drops NUL and XON characters as well
+                if c not in (0, 0x11):
+                    cooked.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                self.pending = data[i:]
+                break
+            cmd = data[i+1]
+            if cmd == IAC:
+                cooked.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data):
+                    self.pending = data[i:]
+                    break
+                if cmd in (DO, DONT):
+                    self.replies += bytes((IAC, WONT, data[i+2]))
+                else:
+                    self.replies += bytes((IAC, DONT, data[i+2]))
+                i += 3
+            elif cmd == SB:
+                end = data.find(bytes((IAC, SE)), i + 2)
+                if end < 0:
+                    self.pending = data[i:]
+                    break
+                i = end + 2
+            else:
+                i += 2
+        return bytes(cooked)
+
+    def pop_replies(self):
+        replies, self.replies = self.replies, b''
+        return replies
+
+
+class CBHVClient:
+    """Asynchronous connection to a single CBHV box"""
+
+    def __init__(self, hostname, port=23, logger=None, timeout=10., connect_timeout=5.,
+                 retries=2, backoff=.5, settle=1., window=8, recorder=None):
+        self.host, self.port = split_host(hostname, port)
+        self.__hostname = hostname
+        self.__log = logger or default_logger('Telnet Session')
+        self.endline = '\r\n'
+        self.prompt = b'>'
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.settle = settle
+        # maximum number of pipelined commands waiting for their response
+        self.window = max(1, window)
+        # optional TranscriptRecorder which records all commands and responses
+        self.recorder = recorder
+        self.__reader = None
+        self.__writer = None
+        self.__filter = None
+        self.__buffer = b''
+
+    @property
+    def connected(self):
+        return self.__writer is not None
+
+    async def connect(self):
+        """Open the connection and wait for the first prompt of the box"""
+        start = perf_counter()
+        with METRICS.phase(self.__hostname, 'connect'):
+            await self.__connect()
+        if self.recorder:
+            self.recorder.start(perf_counter() - start)
+
+    async def __connect(self):
+        self.__filter = TelnetFilter()
+        self.__buffer = b''
+        self.__reader, self.__writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        # telnet needs some time...
+        if self.settle:
+            await asyncio.sleep(self.settle)
+        try:
+            await self.read(self.connect_timeout + self.timeout)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self):
+        """Close the connection, errors while closing are ignored"""
+        writer, self.__writer, self.__reader = self.__writer, None, None
+        if writer is None:
+            return
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, EOFError):
+            pass
+
+    async def read(self, timeout=None):
+        """Read the response until the next prompt, raise asyncio.TimeoutError
+        if it doesn't arrive in time and EOFError if the connection got closed"""
+        return await asyncio.wait_for(self.__read_until_prompt(), timeout or self.timeout)
+
+    async def __read_until_prompt(self):
+        while self.prompt not in self.__buffer:
+            data = await self.__reader.read(4096)
+            if not data:
+                raise EOFError('Connection closed by ' + self.__hostname)
+            self.__buffer += self.__filter.feed(data)
+            replies = self.__filter.pop_replies()
+            if replies:
+                self.__writer.write(replies)
+        response, _, self.__buffer = self.__buffer.partition(self.prompt)
+        return response + self.prompt
+
+    async def write(self, cmd):
+        """Send a command to the box, the endline is appended if missing"""
+        if not cmd.endswith(self.endline):
+            cmd += self.endline
+        self.__writer.write(cmd.encode('ascii'))
+        await self.__writer.drain()
+
+    async def reconnect(self, attempt):
+        """Close the connection and open it again after an exponential backoff"""
+        await self.close()
+        delay = self.backoff * 2**attempt
+        self.__log.info('Reconnecting to %s in %.1f seconds (retry %d of %d)',
+                        self.__hostname, delay, attempt + 1, self.retries)
+        await asyncio.sleep(delay)
+        await self.connect()
+
+    def print(self, string, print_info=False):
+        """remove telnet prompt from the string and output using logging.DEBUG level"""
+        cleaned = string.rstrip(self.prompt).decode('ascii', 'replace').strip()
+        if not cleaned:
+            cleaned = 'empty'
+        if print_info:
+            self.__log.info('Telnet response:\n' + cleaned)
+        else:
+            self.__log.debug('Telnet response: ' + cleaned)
+
+    async def send_command(self, cmd, print_info=False, return_response=False, timeout=None, retries=None):
+        """send command and wait for the response; on a timeout or a lost connection
+        the command is sent again after reconnecting up to self.retries times;
+        timeout and retries override the defaults of the client for this command,
+        e.g. for slow commands which must not be sent again while still running;
+        returns False if no response could be retrieved"""
+        self.__log.debug('Send ' + cmd.rstrip(self.endline))
+        timeout = timeout or self.timeout
+        retries = self.retries if retries is None else retries
+        start = perf_counter()
+        timeouts = 0
+        for attempt in range(retries + 1):
+            try:
+                if attempt:
+                    await self.reconnect(attempt - 1)
+                elif not self.connected:
+                    await self.connect()
+                await self.write(cmd)
+                response = await self.read(timeout)
+                break
+            except asyncio.TimeoutError:
+                timeouts += 1
+                self.__log.warning('No response from %s within %.1f seconds to command %s'
+                                   % (self.__hostname, timeout, cmd.rstrip(self.endline)))
+            except (EOFError, OSError) as e:
+                self.__log.warning('Connection to %s lost while trying to send command %s: %s'
+                                   % (self.__hostname, cmd.rstrip(self.endline), e))
+        else:
+            await self.close()
+            METRICS.record_command(self.__hostname, cmd, perf_counter() - start,
+                                   bytes_out=(len(cmd) + len(self.endline))*(retries + 1),
+                                   timeouts=timeouts, retries=retries, failed=True)
+            self.__log.error('Telnet connection closed while trying to send command '
+                             + cmd.rstrip(self.endline))
+            if self.recorder:
+                self.recorder.record(cmd.rstrip(self.endline), start, perf_counter() - start, False)
+            return False
+        METRICS.record_command(self.__hostname, cmd, perf_counter() - start,
+                               bytes_out=len(cmd.rstrip(self.endline) + self.endline)*(attempt + 1),
+                               bytes_in=len(response), timeouts=timeouts, retries=attempt)
+        self.print(response, print_info)
+        if self.recorder:
+            self.recorder.record(cmd.rstrip(self.endline), start, perf_counter() - start,
+                                 response.rstrip(self.prompt).decode('ascii', 'replace').strip())
+
+        if return_response:
+            return response.rstrip(self.prompt).decode('ascii', 'replace').strip()
+        return True
+
+    async def send_commands(self, commands, print_info=False):
+        """send several commands back-to-back without waiting for the prompt in between,
+        at most self.window commands are waiting for their response at any time; the box
+        answers the commands in order, so every response is matched to its command;
+        after a timeout or a lost connection the commands without response are sent again
+        one by one using send_command; returns the list of responses with False for a failed
+        command, commands after a failed one are not sent anymore and are False as well"""
+        commands = [cmd.rstrip(self.endline) for cmd in commands]
+        responses = []
+        try:
+            if not self.connected:
+                await self.connect()
+            sent = []
+            # arrival of the previous response, a command sent before it was queued until then
+            previous = None
+            while len(responses) < len(commands):
+                while len(sent) < len(commands) and len(sent) - len(responses) < self.window:
+                    cmd = commands[len(sent)]
+                    self.__log.debug('Send ' + cmd)
+                    self.__writer.write((cmd + self.endline).encode('ascii'))
+                    sent.append(perf_counter())
+                await self.__writer.drain()
+                response = await self.read()
+                cmd = commands[len(responses)]
+                arrival = perf_counter()
+                head = max(sent[len(responses)], previous or 0.)
+                METRICS.record_command(self.__hostname, cmd, arrival - head, bytes_out=len(cmd + self.endline),
+                                       bytes_in=len(response), queued=head - sent[len(responses)])
+                previous = arrival
+                self.print(response, print_info)
+                responses.append(response.rstrip(self.prompt).decode('ascii', 'replace').strip())
+                if self.recorder:
+                    self.recorder.record(cmd, sent[len(responses) - 1],
+                                         perf_counter() - sent[len(responses) - 1], responses[-1])
+        except (asyncio.TimeoutError, EOFError, OSError) as e:
+            self.__log.warning('Pipelined commands to %s interrupted after %d of %d responses: %s'
+                               % (self.__hostname, len(responses), len(commands),
+                                  e or type(e).__name__))
+            # responses of commands already sent could still arrive, start with a new connection
+            await self.close()
+            for cmd in commands[len(responses):]:
+                response = await self.send_command(cmd, print_info, return_response=True)
+                responses.append(response)
+                if response is False:
+                    break
+        return responses + [False]*(len(commands) - len(responses))
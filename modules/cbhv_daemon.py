@@ -0,0 +1,309 @@
+"""
+Daemon which keeps warm, health-checked connections to the CBHV boxes
+and provides them via a local unix socket; commands are sent as JSON lines,
+so repeated or scripted operations don't need to connect to the boxes again.
+Only one session per box is used, clients are served one after another.
+
+Start the daemon:  python3 -m modules.cbhv_daemon -s /tmp/cbhv.sock
+Send commands:     python3 -m modules.cbhv_daemon -s /tmp/cbhv.sock --host cbhv01 --command "eemem print"
+"""
+
+import sys
+import os
+import json
+import socket
+import asyncio
+import argparse
+import logging
+from time import perf_counter
+
+from modules.cbhv_client import CBHVClient
+from modules.box_pool import BoxLogger, default_logger
+from modules.metrics import METRICS
+
+DEFAULT_SOCKET = '/tmp/cbhv_daemon.sock'
+
+
+class BoxSession:
+    """Connection to a single box held by the daemon, the lock guarantees exclusive usage"""
+
+    def __init__(self, host, logger, timeout=10., retries=2):
+        self.host = host
+        self.client = CBHVClient(host, logger=BoxLogger(logger, {'host': host}),
+                                 timeout=timeout, retries=retries)
+        self.lock = asyncio.Lock()
+        self.commands = 0
+
+    async def send(self, commands, print_info=False, timeout=None, retries=None):
+        """Send commands pipelined to the box, connecting first if needed; commands after
+        a failed one are not sent, returns the list of responses with False for failed commands;
+        with a timeout or retries overriding the defaults the commands are sent one by one"""
+        if timeout is None and retries is None:
+            responses = await self.client.send_commands(commands, print_info)
+        else:
+            responses = []
+            for cmd in commands:
+                responses.append(await self.client.send_command(cmd, print_info, True, timeout, retries))
+                if responses[-1] is False:
+                    break
+            responses += [False]*(len(commands) - len(responses))
+        self.commands += len(commands)
+        return responses
+
+    async def check(self):
+        """Health check: an empty command only returns the prompt"""
+        return await self.send(['']) != [False]
+
+
+class CBHVDaemon:
+    """Serve the box sessions via a unix socket"""
+
+    def __init__(self, logger, socket_path=DEFAULT_SOCKET, health_interval=30., timeout=10.):
+        self.__log = logger
+        self.socket_path = socket_path
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.sessions = {}
+
+    def session(self, host):
+        if host not in self.sessions:
+            self.sessions[host] = BoxSession(host, self.__log, self.timeout)
+        return self.sessions[host]
+
+    async def warm_up(self, hosts):
+        """Connect to all given hosts concurrently"""
+        results = await asyncio.gather(*(self.check(self.session(host)) for host in hosts))
+        for host, success in zip(hosts, results):
+            if success:
+                self.__log.info('Connected to %s', host)
+            else:
+                self.__log.warning('Box %s not reachable, retrying with the next health check', host)
+
+    async def check(self, session):
+        async with session.lock:
+            try:
+                return await session.check()
+            except Exception as e:
+                self.__log.error('Health check of %s failed: %s', session.host, e)
+                return False
+
+    async def health_checks(self):
+        """Check all sessions regularly, idle connections are kept alive and lost ones reopened"""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for session in list(self.sessions.values()):
+                # sessions used by a client are obviously fine
+                if not session.lock.locked():
+                    await self.check(session)
+
+    def status(self):
+        return {host: {'connected': session.client.connected, 'busy': session.lock.locked(),
+                       'commands': session.commands}
+                for host, session in self.sessions.items()}
+
+    async def handle(self, reader, writer):
+        """Handle a client connection; every request is a JSON object on a single line:
+        {"host": ..., "commands": [...], "print_info": false} sends commands,
+        optionally with "timeout" and "retries" overriding the defaults of the session,
+        {"action": "acquire"/"release", "host": ...} reserves a box for this client,
+        {"action": "status"} returns the state of all sessions"""
+        acquired = {}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                    reply = await self.process(request, acquired)
+                except Exception as e:
+                    reply = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for session in acquired.values():
+                session.lock.release()
+            writer.close()
+
+    async def process(self, request, acquired):
+        action = request.get('action', 'send')
+        if action == 'status':
+            return {'ok': True, 'status': self.status()}
+        host = request['host']
+        session = self.session(host)
+        if action == 'acquire':
+            if host not in acquired:
+                await session.lock.acquire()
+                acquired[host] = session
+            return {'ok': True}
+        if action == 'release':
+            if host in acquired:
+                acquired.pop(host).lock.release()
+            return {'ok': True}
+        if action != 'send':
+            raise ValueError('Unknown action ' + action)
+
+        commands = request['commands']
+        options = (request.get('print_info', False), request.get('timeout'), request.get('retries'))
+        if host in acquired:
+            responses = await session.send(commands, *options)
+        else:
+            async with session.lock:
+                responses = await session.send(commands, *options)
+        return {'ok': False not in responses, 'responses': responses}
+
+    async def serve(self, hosts=()):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, self.socket_path)
+        self.__log.info('Listening on %s', self.socket_path)
+        await self.warm_up(list(hosts))
+        try:
+            await asyncio.gather(server.serve_forever(), self.health_checks())
+        finally:
+            server.close()
+            for session in self.sessions.values():
+                await session.client.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+class DaemonSession:
+    """Blocking client for a box session of the daemon, it can be used instead of TelnetManager;
+    the box is reserved for this session until it is closed"""
+
+    def __init__(self, hostname, socket_path=DEFAULT_SOCKET, logger=None):
+        self.__host = hostname
+        self.__log = logger or default_logger('Daemon Session')
+        self.endline = '\r\n'
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.connect(socket_path)
+        self.__file = self.__socket.makefile('rwb')
+        if hostname:
+            self.request({'action': 'acquire', 'host': hostname})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def host(self):
+        return self.__host
+
+    def request(self, request):
+        """Send a request to the daemon and return the reply"""
+        self.__file.write((json.dumps(request) + '\n').encode())
+        self.__file.flush()
+        line = self.__file.readline()
+        if not line:
+            raise EOFError('Connection to the CBHV daemon closed')
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            raise RuntimeError('CBHV daemon: ' + reply['error'])
+        return reply
+
+    def close(self):
+        if self.__socket is None:
+            return
+        if self.__host:
+            try:
+                self.request({'action': 'release', 'host': self.__host})
+            except (OSError, EOFError, RuntimeError):
+                pass
+        self.__file.close()
+        self.__socket.close()
+        self.__socket = None
+
+    def send_commands(self, commands, print_info=False, timeout=None, retries=None):
+        """Send several commands at once, returns the list of responses, False for a failed
+        command, following commands are not sent anymore after a failure; timeout and retries
+        override the defaults of the session of the daemon for these commands"""
+        commands = [cmd.rstrip(self.endline) for cmd in commands]
+        start = perf_counter()
+        request = {'host': self.__host, 'commands': commands}
+        if timeout is not None:
+            request['timeout'] = timeout
+        if retries is not None:
+            request['retries'] = retries
+        responses = self.request(request)['responses']
+        # the daemon returns all responses together, the time of the batch is split evenly
+        # and the commands are recorded as answered one after another like by CBHVClient
+        latency = (perf_counter() - start)/max(len(responses), 1)
+        for i, (cmd, response) in enumerate(zip(commands, responses)):
+            METRICS.record_command(self.__host, cmd, latency, bytes_out=len(cmd + self.endline),
+                                   bytes_in=len(response or ''), failed=response is False,
+                                   queued=i*latency)
+            if response is False:
+                self.__log.error('Sending command %s via the daemon failed' % cmd)
+            elif print_info:
+                self.__log.info('Telnet response:\n' + (response or 'empty'))
+            else:
+                self.__log.debug('Telnet response: ' + (response or 'empty'))
+        return responses
+
+    def send_command(self, cmd, print_info=False, return_response=False, timeout=None, retries=None):
+        """send command via the daemon and wait for response"""
+        self.__log.debug('Send ' + cmd.rstrip(self.endline))
+        response = self.send_commands([cmd], print_info, timeout, retries)[0]
+        if response is False:
+            return False
+        if return_response:
+            return response
+        return True
+
+
+def main():
+    """Start the daemon or send commands to a running daemon"""
+    parser = argparse.ArgumentParser(description='Daemon keeping connections to the CBHV boxes')
+    parser.add_argument('-s', '--socket', type=str, default=DEFAULT_SOCKET,
+                        help='Path of the unix socket, default ' + DEFAULT_SOCKET)
+    parser.add_argument('-p', '--prefix', type=str, default='cbhv%02d',
+                        dest='host_prefix', metavar='"host prefix"',
+                        help='Hostname scheme of the CBHV boxes, default "cbhv%%02d"')
+    parser.add_argument('-b', '--boxes', nargs='+', type=int, metavar='box-number',
+                        default=list(range(1, 19)), help='Boxes to connect to at startup')
+    parser.add_argument('--health-interval', type=float, default=30.,
+                        help='Seconds between health checks of the connections, default 30')
+    parser.add_argument('--timeout', type=float, default=10.,
+                        help='Timeout for a response of a box in seconds, default 10')
+    parser.add_argument('--host', type=str,
+                        help='Client mode: send the commands given with --command to this host')
+    parser.add_argument('--command', nargs='+', type=str, default=[],
+                        help='Client mode: commands to send')
+    parser.add_argument('--status', action='store_true',
+                        help='Client mode: print the state of all sessions of the daemon')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print additional output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('CBHV daemon')
+
+    if args.status:
+        with DaemonSession(None, args.socket, logger) as session:
+            print(json.dumps(session.request({'action': 'status'})['status'], indent=2))
+        return
+    if args.host:
+        with DaemonSession(args.host, args.socket, logger) as session:
+            for cmd in args.command:
+                if not session.send_command(cmd, print_info=True):
+                    sys.exit(1)
+        return
+
+    # nothing reads the metrics of the daemon, they would only grow as long as it runs
+    METRICS.enabled = False
+    daemon = CBHVDaemon(logger, args.socket, args.health_interval, args.timeout)
+    try:
+        asyncio.run(daemon.serve(args.host_prefix % box for box in args.boxes))
+    except KeyboardInterrupt:
+        print('\nCtrl+C detected, terminating program')
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Simulator for the CBHV boxes which speaks the same command dialect over telnet;
+every simulated box listens on the host and port given by the host prefix,
+e.g. "localhost:90%02d" lets box 1 listen on port 9001.
+It can be started with: python3 -m modules.cbhv_simulator --prefix "localhost:90%02d"
+"""
+
+import sys
+import asyncio
+import argparse
+import logging
+import random
+import threading
+from math import exp
+from time import time, localtime, mktime, strftime, perf_counter
+
+from modules.cbhv_client import split_host
+from modules.hv_gains import N_CARDS, N_CHANNELS
+
+
+class BoxSimulator:
+    """State and command handling of a single simulated CBHV box"""
+
+    def __init__(self, box, gain=.02, offset=20., noise=.3, latency=0., dead=False,
+                 drop_rate=0., read_config_time=0., tau=0., rtt=0., seed=None):
+        self.box = box
+        self.rng = random.Random(seed if seed is None else seed + box)
+        # real gain and offset deviation of every channel which should be measured
+        self.gain = [[self.rng.uniform(-gain, gain) for _ in range(N_CHANNELS)]
+                     for _ in range(N_CARDS)]
+        self.offset = [[self.rng.uniform(-offset, offset) for _ in range(N_CHANNELS)]
+                       for _ in range(N_CARDS)]
+        self.noise = noise
+        self.latency = latency
+        # network round trip time, unlike the latency it doesn't delay the following commands
+        self.rtt = rtt
+        self.dead = dead
+        self.drop_rate = drop_rate
+        self.read_config_time = read_config_time
+        # time constant of the exponential approach to a new setpoint
+        self.tau = tau
+        self.clock_offset = 0.
+        self.setpoints = [[0]*N_CHANNELS for _ in range(N_CARDS)]
+        # voltage and time when the last setpoint was applied, per channel
+        self.changed = [[(0., 0.)]*N_CHANNELS for _ in range(N_CARDS)]
+        # content of the EEPROM and the configuration which is currently used
+        self.eemem = {'REG': 'off', 'protected': True}
+        for card in range(N_CARDS):
+            self.eemem['M%d' % card] = ['0']*N_CHANNELS
+            self.eemem['N%d' % card] = ['0']*N_CHANNELS
+        self.config = dict(self.eemem)
+        self.commands = 0
+
+    def target(self, card, channel):
+        """Return the voltage a channel approaches for the current setpoint"""
+        setpoint = self.setpoints[card][channel]
+        if not setpoint:
+            return 0.
+        value = setpoint*(1 + self.gain[card][channel]) + self.offset[card][channel]
+        if self.config['REG'] == 'on':
+            value -= float(self.config['M%d' % card][channel])*setpoint \
+                     + float(self.config['N%d' % card][channel])
+        return value
+
+    def settled_voltage(self, card, channel):
+        """Return the current voltage of a channel without noise"""
+        target = self.target(card, channel)
+        start, changed = self.changed[card][channel]
+        if not self.tau:
+            return target
+        return target + (start - target)*exp(-(perf_counter() - changed)/self.tau)
+
+    def voltage(self, card, channel):
+        """Return the current voltage of a channel as measured by the ADC"""
+        if not self.setpoints[card][channel]:
+            return 0.
+        return self.settled_voltage(card, channel) + self.rng.gauss(0, self.noise)
+
+    def clock(self):
+        return localtime(time() + self.clock_offset)
+
+    def read_adc(self, args):
+        if len(args) != 2 or args[0] != 'csv2L' or not args[1].isdigit() \
+                or int(args[1]) >= N_CARDS:
+            return 'ERROR: usage read_adc csv2L <card>'
+        card = int(args[1])
+        values = ','.join('%d' % round(self.voltage(card, channel)) for channel in range(N_CHANNELS))
+        return '%s,1,%s,0' % (strftime('%d.%m.%Y %H:%M:%S', self.clock()), values)
+
+    def set_voltage(self, args):
+        try:
+            card, channel, value = map(int, args)
+        except ValueError:
+            return 'ERROR: usage SetVpmF <card> <channel> <voltage>'
+        if not 0 <= card < N_CARDS or not 0 <= channel < N_CHANNELS:
+            return 'ERROR: invalid card or channel'
+        self.changed[card][channel] = (self.settled_voltage(card, channel), perf_counter())
+        self.setpoints[card][channel] = value
+        return ''
+
+    def set_time(self, args):
+        if not args:
+            return strftime('%H:%M:%S %d.%m.%Y', self.clock())
+        try:
+            hour, minute, second, day, month, year = map(int, args)
+        except ValueError:
+            return 'ERROR: usage time <H> <M> <S> <d> <m> <Y>'
+        self.clock_offset = mktime((year, month, day, hour, minute, second, 0, 0, -1)) - time()
+        return ''
+
+    def eemem_print(self):
+        lines = ['REG %s' % self.eemem['REG']]
+        for row in 'MN':
+            for card in range(N_CARDS):
+                key = '%s%d' % (row, card)
+                lines.append('%s %s' % (key, ','.join(self.eemem[key])))
+        return '\r\n'.join(lines)
+
+    def eemem_command(self, args):
+        if not args:
+            return 'ERROR: usage eemem <print|protect|unprotect|add>'
+        if args[0] == 'print':
+            return self.eemem_print()
+        if args[0] in ('protect', 'unprotect'):
+            self.eemem['protected'] = args[0] == 'protect'
+            return ''
+        if args[0] != 'add' or len(args) != 3:
+            return 'ERROR: usage eemem add <key> <values>'
+        if self.eemem['protected']:
+            return 'ERROR: EEMEM is protected'
+        key, values = args[1], args[2]
+        if key == 'REG' and values in ('on', 'off'):
+            self.eemem['REG'] = values
+            return ''
+        values = values.split(',')
+        if key not in self.eemem or key[0] not in 'MN' or len(values) != N_CHANNELS:
+            return 'ERROR: invalid eemem entry'
+        try:
+            [float(val) for val in values]
+        except ValueError:
+            return 'ERROR: invalid eemem values'
+        self.eemem[key] = values
+        return ''
+
+    async def execute(self, cmd):
+        """Execute a single command and return the response without prompt"""
+        self.commands += 1
+        args = cmd.split()
+        if not args:
+            return ''
+        if args[0] == 'eemem':
+            return self.eemem_command(args[1:])
+        if args[0] == 'read_config':
+            await asyncio.sleep(self.read_config_time)
+            self.config = dict(self.eemem)
+            return ''
+        if args[0] == 'SetVpmF':
+            return self.set_voltage(args[1:])
+        if args[0] == 'read_adc':
+            return self.read_adc(args[1:])
+        if args[0] == 'time':
+            return self.set_time(args[1:])
+        return 'Unknown command: ' + args[0]
+
+    async def handle(self, reader, writer):
+        """Handle a telnet session, every response is followed by the prompt"""
+        try:
+            if self.dead:
+                # a dead box accepts the connection but never answers
+                await reader.read()
+                return
+            writer.write(('CBHV box %d\r\n>' % self.box).encode('ascii'))
+            await writer.drain()
+            buffer = b''
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                buffer += data
+                while b'\n' in buffer:
+                    line, _, buffer = buffer.partition(b'\n')
+                    if self.drop_rate and self.rng.random() < self.drop_rate:
+                        return
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    response = await self.execute(line.decode('ascii', 'replace').strip())
+                    data = ((response + '\r\n' if response else '') + '>').encode('ascii')
+                    if self.rtt:
+                        asyncio.get_running_loop().call_later(self.rtt, writer.write, data)
+                    else:
+                        writer.write(data)
+                        await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+
+async def start_simulators(host_prefix, boxes, dead_boxes=(), **kwargs):
+    """Start a simulated box for every given box number, boxes in dead_boxes never respond;
+    returns a list of the simulators and a list of the servers"""
+    simulators, servers = [], []
+    for box in boxes:
+        host, port = split_host(host_prefix % box)
+        simulator = BoxSimulator(box, dead=box in dead_boxes, **kwargs)
+        servers.append(await asyncio.start_server(simulator.handle, host, port))
+        simulators.append(simulator)
+    return simulators, servers
+
+
+async def run_simulators(logger, host_prefix, boxes, dead_boxes=(), **kwargs):
+    """Run the simulated boxes until the program is stopped"""
+    _, servers = await start_simulators(host_prefix, boxes, dead_boxes, **kwargs)
+    for box in boxes:
+        logger.info('Simulating box %d on %s', box, host_prefix % box)
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+class SimulatorThread:
+    """Run simulated boxes with an event loop in a background thread,
+    used to test or benchmark the control script within the same process"""
+
+    def __init__(self, host_prefix, boxes, dead_boxes=(), **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.simulators, self.servers = asyncio.run_coroutine_threadsafe(
+            start_simulators(host_prefix, boxes, dead_boxes, **kwargs), self.loop).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def commands(self):
+        """Total number of commands handled by all simulated boxes"""
+        return sum(simulator.commands for simulator in self.simulators)
+
+    def stop(self):
+        """Close all servers and stop the event loop"""
+        async def close():
+            for server in self.servers:
+                server.close()
+                await server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def main():
+    """Start the simulated boxes with the given options"""
+    parser = argparse.ArgumentParser(description='Simulator for CBHV boxes')
+    parser.add_argument('-p', '--prefix', type=str, default='localhost:90%02d',
+                        dest='host_prefix', metavar='"host prefix"',
+                        help='Host and port scheme of the simulated boxes, including formatting '
+                        'for digits, default is "localhost:90%%02d"')
+    parser.add_argument('-b', '--boxes', nargs='+', type=int, metavar='box-number',
+                        default=list(range(1, 19)), help='Space-separated list of simulated boxes')
+    parser.add_argument('--gain', type=float, default=.02,
+                        help='Maximum relative gain deviation of the channels, default 0.02')
+    parser.add_argument('--offset', type=float, default=20.,
+                        help='Maximum offset of the channels in V, default 20')
+    parser.add_argument('--noise', type=float, default=.3,
+                        help='Standard deviation of the ADC readings in V, default 0.3')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Additional latency per command in seconds')
+    parser.add_argument('--rtt', type=float, default=0.,
+                        help='Network round trip time in seconds, responses are delayed by it '
+                        'without blocking the following commands')
+    parser.add_argument('--read-config-time', type=float, default=0.,
+                        help='Time needed by read_config in seconds')
+    parser.add_argument('--tau', type=float, default=0.,
+                        help='Time constant in seconds for the voltages to settle after a new setpoint')
+    parser.add_argument('--dead', nargs='+', type=int, default=[], metavar='box-number',
+                        help='Boxes which accept connections but never respond')
+    parser.add_argument('--drop-rate', type=float, default=0.,
+                        help='Probability to drop the connection instead of answering a command')
+    parser.add_argument('--seed', type=int, help='Random seed for reproducible channel properties')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print additional output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('CBHV simulator')
+
+    kwargs = dict(gain=args.gain, offset=args.offset, noise=args.noise, latency=args.latency, rtt=args.rtt,
+                  drop_rate=args.drop_rate, read_config_time=args.read_config_time, tau=args.tau,
+                  seed=args.seed)
+    try:
+        asyncio.run(run_simulators(logger, args.host_prefix, args.boxes, dead_boxes=args.dead, **kwargs))
+    except KeyboardInterrupt:
+        print('\nCtrl+C detected, terminating program')
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
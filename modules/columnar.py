@@ -0,0 +1,324 @@
+"""
+Compact binary storage of a correction measurement: all points of a run are stored
+in a single file as fixed-width records (box, card, setpoint, timestamp, date, level,
+the ADC values of the 8 channels, status and settling time) after a header with the
+run metadata as JSON. The records can be memory mapped with NumPy, so all channels
+are available without parsing anything. Records are only appended, a record which
+was not written completely because of an interruption is ignored when loading.
+
+Convert between this format and the CSV files per card, converting a columnar file
+to CSV and back gives exactly the same records:
+    python3 -m modules.columnar to-csv run.cbhv -o "out/box%02d_card%d.txt"
+    python3 -m modules.columnar from-csv "out/box%02d_card%d.txt" -o run.cbhv
+"""
+
+import sys
+import os
+import json
+import struct
+import argparse
+import logging
+import threading
+from time import mktime, strptime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from modules.hv_gains import N_CARDS, N_CHANNELS
+
+MAGIC = b'CBHVCOL\x01'
+VERSION = 2
+DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+DATE_LENGTH = 19
+# the header is padded to a multiple of this size, the records start aligned
+HEADER_ALIGN = 64
+# little endian without padding, the NumPy dtype below has to describe the same layout
+RECORD_FORMAT = '<BBhd%dsf%dfif' % (DATE_LENGTH, N_CHANNELS)
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_FIELDS = [
+    ('box', '<u1'),
+    ('card', '<u1'),
+    ('setpoint', '<i2'),
+    ('timestamp', '<f8'),
+    ('date', 'S%d' % DATE_LENGTH),
+    ('level', '<f4'),
+    ('adc', '<f4', (N_CHANNELS,)),
+    ('status', '<i4'),
+    ('settle', '<f4'),
+]
+
+
+def record_dtype():
+    dtype = np.dtype(RECORD_FIELDS)
+    assert dtype.itemsize == RECORD_SIZE
+    return dtype
+
+
+# status of a response whose status value is not an integer
+STATUS_INVALID = -1
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def parse_status(value):
+    try:
+        return int(value)
+    except ValueError:
+        return STATUS_INVALID
+
+
+def format_float(value):
+    """Shortest text which gives the same single precision value again, so that
+    the CSV files written from a columnar file can be converted back without loss"""
+    return np.format_float_positional(value, trim='-')
+
+
+def parse_response(response):
+    """Split a read_adc csv2L response 'date,level,CH0,...,CH7,status' into its values;
+    the date is kept as given, its timestamp and values which can not be parsed are NaN,
+    a status which is not an integer is STATUS_INVALID;
+    returns None if the response doesn't contain enough values"""
+    vals = response.strip().split(',')
+    if len(vals) < 2 + N_CHANNELS:
+        return None
+    date = vals[0].strip()
+    try:
+        timestamp = mktime(strptime(date, DATE_FORMAT))
+    except (ValueError, OverflowError):
+        timestamp = float('nan')
+    level = parse_float(vals[1])
+    adc = [parse_float(val) for val in vals[2:2+N_CHANNELS]]
+    status = parse_status(vals[2+N_CHANNELS]) if len(vals) > 2 + N_CHANNELS else 0
+    return date, timestamp, level, adc, status
+
+
+def pack_record(box, card, setpoint, response, settle_time=None):
+    """Create the binary record of a measured point from the read_adc response,
+    returns None if the response doesn't contain enough values"""
+    values = parse_response(response)
+    if values is None:
+        return None
+    date, timestamp, level, adc, status = values
+    settle = float('nan') if settle_time is None else settle_time
+    return struct.pack(RECORD_FORMAT, box, card, setpoint, timestamp,
+                       date.encode('ascii', 'replace')[:DATE_LENGTH], level, *adc, status, settle)
+
+
+def header_bytes(metadata):
+    """Magic, header size and the metadata as JSON padded with spaces"""
+    metadata = dict(metadata, version=VERSION, record_format=RECORD_FORMAT,
+                    fields=[field[0] for field in RECORD_FIELDS])
+    text = json.dumps(metadata, sort_keys=True).encode()
+    size = len(MAGIC) + 4 + len(text)
+    size += -size % HEADER_ALIGN
+    return MAGIC + struct.pack('<I', size) + text.ljust(size - len(MAGIC) - 4)
+
+
+def read_header(columnar_file):
+    """Read the header of an open file, returns the metadata and the offset of the first record"""
+    magic = columnar_file.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('Not a CBHV columnar measurement file')
+    size, = struct.unpack('<I', columnar_file.read(4))
+    metadata = json.loads(columnar_file.read(size - len(MAGIC) - 4).decode())
+    if metadata.get('record_format') != RECORD_FORMAT:
+        raise ValueError('Unsupported record format ' + str(metadata.get('record_format')))
+    return metadata, size
+
+
+class ColumnarWriter:
+    """Append the measured points to a columnar file, thread-safe;
+    with append=True an existing file is continued, e.g. for a resumed measurement"""
+
+    def __init__(self, path, metadata, append=False):
+        self.path = path
+        self.records = 0
+        self.__lock = threading.Lock()
+        if append and os.path.isfile(path):
+            with open(path, 'rb') as columnar_file:
+                _, offset = read_header(columnar_file)
+            size = os.path.getsize(path)
+            # drop an incomplete record written right before an interruption
+            self.records = (size - offset)//RECORD_SIZE
+            with open(path, 'r+b') as columnar_file:
+                columnar_file.truncate(offset + self.records*RECORD_SIZE)
+            self.__file = open(path, 'ab')
+        else:
+            self.__file = open(path, 'wb')
+            self.__file.write(header_bytes(metadata))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, box, card, setpoint, response, settle_time=None):
+        """Append a measured point, returns False if the response doesn't contain enough values"""
+        record = pack_record(box, card, setpoint, response, settle_time)
+        if record is None:
+            return False
+        with self.__lock:
+            self.__file.write(record)
+            self.__file.flush()
+            self.records += 1
+        return True
+
+    def sync(self):
+        with self.__lock:
+            os.fsync(self.__file.fileno())
+
+    def close(self):
+        self.__file.close()
+
+
+def load_columnar(path):
+    """Memory map the records of a columnar file; returns the metadata and a NumPy
+    record array with the fields box, card, setpoint, timestamp (NaN if the date of the box
+    couldn't be parsed), date, level, adc (8 channels), status and settle (NaN if the adaptive
+    settling detection wasn't used)"""
+    with open(path, 'rb') as columnar_file:
+        metadata, offset = read_header(columnar_file)
+    count = (os.path.getsize(path) - offset)//RECORD_SIZE
+    if not count:
+        return metadata, np.zeros(0, dtype=record_dtype())
+    return metadata, np.memmap(path, dtype=record_dtype(), mode='r', offset=offset, shape=(count,))
+
+
+def measurement_arrays(records, boxes=None, cards=None):
+    """Arrange the records per card like analysis.load_measurements, optionally only the records
+    of the given boxes and cards; returns the list of
+    (box, card) keys and arrays for setpoints and ADC values with shape (cards, points)
+    and (cards, points, 8) filled with NaN; if a point was recorded several times the last one is used"""
+    if boxes is not None:
+        records = records[np.isin(records['box'], boxes)]
+    if cards is not None:
+        records = records[np.isin(records['card'], cards)]
+    card_ids = records['box'].astype(int)*N_CARDS + records['card']
+    # keep the last record of every (box, card, setpoint)
+    point_ids = card_ids*100000 + records['setpoint'].astype(int)
+    _, last = np.unique(point_ids[::-1], return_index=True)
+    records = records[np.sort(len(records) - 1 - last)]
+    card_ids = records['box'].astype(int)*N_CARDS + records['card']
+
+    ids, index, counts = np.unique(card_ids, return_inverse=True, return_counts=True)
+    keys = [(int(card_id)//N_CARDS, int(card_id) % N_CARDS) for card_id in ids]
+    n_points = counts.max() if counts.size else 0
+    # position of every record within the points of its card, in the order they were measured
+    order = np.argsort(index, kind='stable')
+    position = np.empty(len(records), dtype=int)
+    position[order] = np.arange(len(records)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    setpoints = np.full((len(keys), n_points), np.nan)
+    adc = np.full((len(keys), n_points, N_CHANNELS), np.nan)
+    setpoints[index, position] = records['setpoint']
+    adc[index, position] = records['adc']
+    return keys, setpoints, adc
+
+
+def csv_line(record, settling=False):
+    """Line of the CSV measurement file of a card for a single record"""
+    line = '%d,%s,%s,%s,%d' % (record['setpoint'], record['date'].decode('ascii', 'replace'),
+                               format_float(record['level']), ','.join(map(format_float, record['adc'])),
+                               record['status'])
+    if settling:
+        line += ',' + format_float(record['settle'])
+    return line + '\n'
+
+
+def to_csv(logger, path, output_format):
+    """Write the CSV measurement files per card from a columnar file"""
+    metadata, records = load_columnar(path)
+    settling = bool(metadata.get('settling'))
+    header = '#Setpoint,Date,Level,CH0,CH1,CH2,CH3,CH4,CH5,CH6,CH7'
+    if settling:
+        header += ',Settle'
+    cards = sorted(set(zip(records['box'].tolist(), records['card'].tolist())))
+    for box, card in cards:
+        card_records = records[(records['box'] == box) & (records['card'] == card)]
+        with open(output_format % (box, card), 'w') as out:
+            out.write(header + '\n')
+            for record in card_records:
+                out.write(csv_line(record, settling))
+    logger.info('Wrote %d points of %d cards', len(records), len(cards))
+    return True
+
+
+def from_csv(logger, input_format, path, boxes, metadata=None):
+    """Collect the CSV measurement files per card of the given boxes into a columnar file"""
+    files = [(box, card, input_format % (box, card)) for box in boxes for card in range(N_CARDS)
+             if os.path.isfile(input_format % (box, card))]
+    if not files:
+        logger.error('No measurement files found')
+        return False
+    # the settling column is only written back if it is present in the CSV files
+    settling = False
+    for _, _, card_path in files:
+        with open(card_path, 'r') as card_file:
+            settling |= card_file.readline().strip().endswith(',Settle')
+    metadata = dict(metadata or {}, settling=settling)
+
+    points = 0
+    with ColumnarWriter(path, metadata) as writer:
+        for box, card, card_path in files:
+            with open(card_path, 'r') as card_file:
+                for line in card_file:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    setpoint, _, response = line.partition(',')
+                    settle_time = None
+                    if settling:
+                        response, _, settle_time = response.rpartition(',')
+                    try:
+                        setpoint = int(setpoint)
+                        settle_time = float(settle_time) if settle_time else None
+                    except ValueError:
+                        setpoint = None
+                    if setpoint is None or not writer.write(box, card, setpoint, response, settle_time):
+                        logger.warning("Skipping invalid line in '%s': %s", card_path, line)
+                        continue
+                    points += 1
+    logger.info('Stored %d points of %d cards in %s', points, len(files), path)
+    return bool(points)
+
+
+def main():
+    """Convert between columnar files and the CSV measurement files per card"""
+    parser = argparse.ArgumentParser(description='Convert CBHV measurements between the CSV files '
+                                     'per card and the columnar binary format')
+    parser.add_argument('direction', choices=['to-csv', 'from-csv'],
+                        help='to-csv: write CSV files from a columnar file, '
+                        'from-csv: collect CSV files into a columnar file')
+    parser.add_argument('input', type=str,
+                        help='Columnar file (to-csv) or naming scheme of the CSV files (from-csv), '
+                        'e.g. "cbhv_corr_measuremt/box%%02d_card%%d.txt"')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Naming scheme of the CSV files (to-csv) or columnar file (from-csv)')
+    parser.add_argument('-b', '--boxes', nargs='+', type=int, metavar='box-number',
+                        default=list(range(1, 19)), help='Boxes to convert (from-csv), default all')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    logger = logging.getLogger('CBHV columnar')
+
+    if args.direction == 'to-csv':
+        if np is None:
+            sys.exit('NumPy is needed to read columnar files, please install it (e.g. pip install numpy)')
+        success = to_csv(logger, args.input, args.output)
+    else:
+        success = from_csv(logger, args.input, args.output, args.boxes)
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Parse the output of the eemem print command of the CBHV boxes into structured data
+and compare it with the values which should be stored on the box
+"""
+
+import re
+
+from modules.hv_gains import N_CARDS, N_CHANNELS
+
+# values are written with 6 decimals, allow for rounding on the box
+TOLERANCE = 1e-5
+
+# rows like "M0 0.001,-0.002,..." with an optional colon or equal sign after the key
+ROW_PATTERN = re.compile(r'^\s*([MN])(\d)\s*[:=]?\s*([-+0-9.eE,\s]+)$')
+REG_PATTERN = re.compile(r'^\s*REG\s*[:=]?\s*(on|off)\b', re.IGNORECASE)
+
+
+def parse_eemem(text):
+    """Parse the response of eemem print into a dictionary
+    {'REG': 'on', 'off' or None, 'M': {card: [values]}, 'N': {card: [values]}},
+    rows which can not be parsed are skipped; returns None if neither the REG state
+    nor any row was recognised, e.g. for an error message or an unknown format"""
+    content = {'REG': None, 'M': {}, 'N': {}}
+    recognised = False
+    for line in text.splitlines():
+        match = REG_PATTERN.match(line)
+        if match:
+            content['REG'] = match.group(1).lower()
+            recognised = True
+            continue
+        match = ROW_PATTERN.match(line)
+        if not match:
+            continue
+        row, card = match.group(1), int(match.group(2))
+        try:
+            values = [float(val) for val in match.group(3).replace(' ', '').split(',') if val]
+        except ValueError:
+            continue
+        if card < N_CARDS and len(values) == N_CHANNELS:
+            content[row][card] = values
+            recognised = True
+    return content if recognised else None
+
+
+def card_mismatches(content, card, m_vals, n_vals, tolerance=TOLERANCE):
+    """Compare the stored M and N values of a card with the given ones, returns a list of
+    (row, channel, expected, stored) for every differing value; stored is None
+    for the channels of a row which is missing in the parsed content"""
+    mismatches = []
+    for row, vals in (('M', m_vals), ('N', n_vals)):
+        stored = content[row].get(card)
+        for channel, val in enumerate(vals):
+            if stored is None:
+                mismatches.append((row, channel, float(val), None))
+            elif abs(float(val) - stored[channel]) > tolerance:
+                mismatches.append((row, channel, float(val), stored[channel]))
+    return mismatches
+
+
+def channel_ranges(channels):
+    """Compact representation of a sorted list of channels, e.g. '0-3,6'"""
+    ranges = []
+    for channel in channels:
+        if ranges and channel == ranges[-1][1] + 1:
+            ranges[-1][1] = channel
+        else:
+            ranges.append([channel, channel])
+    return ','.join('%d' % low if low == high else '%d-%d' % (low, high) for low, high in ranges)
+
+
+def mismatch_table(mismatches):
+    """Compact table of the mismatches given as list of (box, card, row, channel, expected, stored)
+    with one line per row of a card; card and row are None for a wrong REG state"""
+    lines = ['%5s %5s %4s %9s %12s %12s %12s' % ('box', 'card', 'row', 'channels', 'max diff',
+                                                   'expected', 'stored')]
+    rows = {}
+    for box, card, row, channel, expected, stored in mismatches:
+        rows.setdefault((box, card, row), []).append((channel, expected, stored))
+    for (box, card, row), values in sorted(rows.items(), key=lambda item: (item[0][0], str(item[0][1:]))):
+        if row == 'REG':
+            _, expected, stored = values[0]
+            lines.append('%5d %5s %4s %9s %12s %12s %12s' % (box, '-', 'REG', '-', '-', expected,
+                                                             stored or 'missing'))
+            continue
+        if any(stored is None for _, _, stored in values):
+            lines.append('%5d %5d %4s %9s %12s %12s %12s' % (box, card, row, 'all', '-', '-', 'missing'))
+            continue
+        # show the values of the channel with the largest deviation
+        channel, expected, stored = max(values, key=lambda val: abs(val[1] - val[2]))
+        lines.append('%5d %5d %4s %9s %12g %12g %12g' % (
+            box, card, row, channel_ranges([val[0] for val in values]), abs(expected - stored),
+            expected, stored))
+    return '\n'.join(lines)
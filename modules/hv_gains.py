@@ -0,0 +1,89 @@
+"""
+Functions to read the file with the HV gains and offsets of all channels,
+validate its content and create the eemem commands to store the values per card
+"""
+
+N_CARDS = 5      # number of cards per box
+N_CHANNELS = 8   # number of channels per card
+# allowed ranges for the slope and offset values, everything outside is most likely a failed fit
+SLOPE_RANGE = (-1., 1.)
+OFFSET_RANGE = (-1000., 1000.)
+
+
+def read_gains_file(logger, path):
+    """Read the gains file with lines 'box,card,channel,slope,offset' into a dictionary
+    {(box, card, channel): (slope, offset)}, the values are kept as strings like given in the file;
+    returns None if the file contains invalid lines"""
+    gains = {}
+    errors = 0
+    with open(path, 'r') as gains_file:
+        for number, line in enumerate(gains_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            vals = [val.strip() for val in line.split(',')]
+            try:
+                if len(vals) != 5:
+                    raise ValueError('expected 5 values, got %d' % len(vals))
+                key = tuple(int(val) for val in vals[:3])
+                slope, offset = float(vals[3]), float(vals[4])
+            except ValueError as e:
+                logger.error('Line %d of %s can not be parsed (%s): %s', number, path, e, line)
+                errors += 1
+                continue
+            if slope != slope or offset != offset:
+                logger.error('Line %d of %s contains NaN values: %s', number, path, line)
+                errors += 1
+                continue
+            if key in gains:
+                logger.error('Line %d of %s: duplicate entry for box %d, card %d, channel %d',
+                             number, path, *key)
+                errors += 1
+                continue
+            gains[key] = (vals[3], vals[4])
+
+    if errors:
+        logger.error('Found %d invalid lines in %s', errors, path)
+        return None
+    return gains
+
+
+def check_gains(logger, gains, boxes, cards=None):
+    """Check if the gains contain values for all channels of the given boxes (and cards, default all)
+    and if all of them are within the allowed ranges; returns False otherwise"""
+    missing, invalid = [], []
+    for box in boxes:
+        for card in (range(N_CARDS) if cards is None else cards):
+            for channel in range(N_CHANNELS):
+                key = (box, card, channel)
+                if key not in gains:
+                    missing.append(key)
+                    continue
+                slope, offset = map(float, gains[key])
+                if not SLOPE_RANGE[0] <= slope <= SLOPE_RANGE[1] \
+                        or not OFFSET_RANGE[0] <= offset <= OFFSET_RANGE[1]:
+                    invalid.append(key)
+    for key in missing:
+        logger.error('No values found for box %d, card %d, channel %d' % key)
+    for key in invalid:
+        logger.error('Values for box %d, card %d, channel %d out of range: slope %s, offset %s'
+                     % (key + gains[key]))
+    return not missing and not invalid
+
+
+def card_values(box, card, gains=None):
+    """Return the lists of slope (M) and offset (N) strings of all channels for a card,
+    all values are zero if no gains are given"""
+    if gains is None:
+        return ['0']*N_CHANNELS, ['0']*N_CHANNELS
+    vals = [gains[(box, card, channel)] for channel in range(N_CHANNELS)]
+    return [val[0] for val in vals], [val[1] for val in vals]
+
+
+def card_commands(box, card, gains=None):
+    """Create the eemem add commands for the M and N values of a card,
+    the values are set to zero if no gains are given"""
+    m_vals, n_vals = card_values(box, card, gains)
+    m_cmd = "eemem add M%d %s\r\n" % (card, ','.join(m_vals))
+    n_cmd = "eemem add N%d %s\r\n" % (card, ','.join(n_vals))
+    return m_cmd, n_cmd
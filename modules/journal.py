@@ -0,0 +1,118 @@
+"""
+Journal of the completed points of a correction measurement,
+every measured (box, card, setpoint) is recorded durably in the order it was taken
+which allows to resume an interrupted measurement without measuring anything twice
+"""
+
+import os
+import json
+import threading
+from time import time
+
+JOURNAL_FILE = 'cbhv_measurement.journal'
+
+
+class Journal:
+    """Append-only journal file; the first line contains the settings of the measurement
+    as JSON, every following line a completed point as 'box,card,setpoint,timestamp'"""
+
+    def __init__(self, path, settings, resume=False):
+        self.path = path
+        self.settings = settings
+        self.previous_settings = None
+        self.points = set()
+        self.__lock = threading.Lock()
+        if resume and os.path.isfile(path):
+            self.__read()
+            self.__file = open(path, 'a')
+        else:
+            self.__file = open(path, 'w')
+            self.__file.write('# %s\n' % json.dumps(settings, sort_keys=True))
+            self.__sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __read(self):
+        with open(self.path, 'r') as journal:
+            for line in journal:
+                if line.startswith('#'):
+                    try:
+                        self.previous_settings = json.loads(line[1:])
+                    except ValueError:
+                        pass
+                    continue
+                vals = line.strip().split(',')
+                # an incomplete last line from an interruption is ignored
+                if len(vals) != 4:
+                    continue
+                try:
+                    self.points.add(tuple(int(val) for val in vals[:3]))
+                except ValueError:
+                    continue
+
+    def __sync(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    @property
+    def settings_changed(self):
+        """True if a resumed journal was started with different settings"""
+        return self.previous_settings is not None and self.previous_settings != self.settings
+
+    def done(self, box, card, setpoint):
+        """Check if a point has already been measured"""
+        return (box, card, setpoint) in self.points
+
+    def missing(self, box, card, setpoints):
+        """Return the setpoints of a card which have not been measured yet"""
+        return [val for val in setpoints if (box, card, val) not in self.points]
+
+    def record(self, box, card, setpoint):
+        """Record a completed point, the measurement file of the card has to be synced before"""
+        with self.__lock:
+            self.__file.write('%d,%d,%d,%.3f\n' % (box, card, setpoint, time()))
+            self.__sync()
+            self.points.add((box, card, setpoint))
+
+    def close(self):
+        self.__file.close()
+
+
+def sync_file(out):
+    """Make sure everything written to the file is stored on disk"""
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def open_card_file(path, header, journal, box, card):
+    """Open the measurement file of a card; for a resumed measurement the existing file
+    is kept and only lines of points recorded in the journal are retained, which removes
+    a point written right before an interruption but not journaled anymore"""
+    if not journal.points or not os.path.isfile(path):
+        out = open(path, 'w')
+        out.write(header)
+        return out
+
+    with open(path, 'r') as card_file:
+        lines = card_file.readlines()
+    kept = []
+    for line in lines:
+        if line.startswith('#'):
+            kept.append(line)
+            continue
+        try:
+            setpoint = int(line.split(',', 1)[0])
+        except ValueError:
+            continue
+        if line.endswith('\n') and journal.done(box, card, setpoint):
+            kept.append(line)
+    if not kept or not kept[0].startswith('#'):
+        kept.insert(0, header)
+    if kept != lines:
+        with open(path, 'w') as card_file:
+            card_file.writelines(kept)
+    return open(path, 'a')
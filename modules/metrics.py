@@ -0,0 +1,250 @@
+"""
+Instrumentation of the communication with the CBHV boxes:
+the round trip latency, transferred bytes, timeouts and retries of every command
+are recorded per host and command verb, as well as the durations of the different
+phases of a run; a summary with percentiles can be printed and the metrics can be
+exported as JSON or in the Prometheus text format.
+
+The latency of a command is the time from sending it (or from the response of the previous
+command, if it was queued behind it in the pipeline) until its response arrived, the time spent
+queued is recorded separately. Additionally the wall clock time spent waiting for responses,
+connections and settling voltages is tracked as union of the waiting intervals of all hosts,
+so overlapping waits of pipelined commands and parallel boxes are only counted once.
+"""
+
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter, time
+
+
+def percentile(values, fraction):
+    """Return the percentile of the sorted list of values using linear interpolation"""
+    if not values:
+        return 0.
+    pos = (len(values) - 1)*fraction
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low])*(pos - low)
+
+
+def command_verb(cmd):
+    """Return the verb of a command used to group the metrics, e.g. 'eemem add' or 'SetVpmF'"""
+    words = cmd.split()
+    if not words:
+        return '<empty>'
+    if words[0] in ('eemem', 'read_adc') and len(words) > 1:
+        return ' '.join(words[:2])
+    return words[0]
+
+
+# phases which only wait for the boxes, their wall clock time is tracked like the responses
+WAIT_PHASES = ('connect', 'settle')
+
+
+def add_interval(starts, ends, start, end):
+    """Add [start, end] to the sorted disjoint intervals given by starts and ends, overlapping
+    intervals are merged"""
+    first = bisect_left(ends, start)
+    last = bisect_right(starts, end)
+    if first < last:
+        start, end = min(start, starts[first]), max(end, ends[last - 1])
+    starts[first:last] = [start]
+    ends[first:last] = [end]
+
+
+def union_length(intervals):
+    """Total length covered by several lists of disjoint intervals given as (starts, ends)"""
+    starts, ends = [], []
+    for kind_starts, kind_ends in intervals:
+        for start, end in zip(kind_starts, kind_ends):
+            add_interval(starts, ends, start, end)
+    return sum(end - start for start, end in zip(starts, ends))
+
+
+class Metrics:
+    """Thread-safe collection of the command and phase metrics"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # long running processes like the daemon never read the metrics, they switch off recording
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.start = time()
+            # (host, verb) -> list of latencies and counters
+            self.latencies = defaultdict(list)
+            self.queued = defaultdict(list)
+            self.counters = defaultdict(lambda: defaultdict(int))
+            # (host, phase) -> list of durations
+            self.phases = defaultdict(list)
+            # kind of waiting -> disjoint waiting intervals of all hosts as (starts, ends)
+            self.waits = defaultdict(lambda: ([], []))
+
+    def record_command(self, host, cmd, latency, bytes_out=0, bytes_in=0, timeouts=0, retries=0,
+                       failed=False, queued=0.):
+        """Record a single command sent to a host whose response just arrived, queued is the time
+        the command waited in the pipeline for the responses of the previous commands"""
+        if not self.enabled:
+            return
+        key = (host, command_verb(cmd))
+        end = perf_counter()
+        with self.__lock:
+            add_interval(*self.waits['response'], end - latency - queued, end)
+            self.latencies[key].append(latency)
+            self.queued[key].append(queued)
+            counters = self.counters[key]
+            counters['commands'] += 1
+            counters['bytes_out'] += bytes_out
+            counters['bytes_in'] += bytes_in
+            counters['timeouts'] += timeouts
+            counters['retries'] += retries
+            counters['failures'] += int(failed)
+
+    def record_phase(self, host, phase, duration):
+        """Record the duration of a phase of the run like connect or read_config"""
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.phases[(host, phase)].append(duration)
+            if phase in WAIT_PHASES:
+                end = perf_counter()
+                add_interval(*self.waits[phase], end - duration, end)
+
+    def wait_time(self, *kinds):
+        """Wall clock time in which any host was waiting for one of the given kinds
+        ('response' or one of WAIT_PHASES)"""
+        with self.__lock:
+            return union_length([self.waits[kind] for kind in kinds if kind in self.waits])
+
+    @contextmanager
+    def phase(self, host, phase):
+        """Context manager which records the time spent within as phase"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(host, phase, perf_counter() - start)
+
+    @staticmethod
+    def __stats(values):
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'sum': sum(values),
+            'mean': sum(values)/len(values) if values else 0.,
+            'p50': percentile(values, .5),
+            'p90': percentile(values, .9),
+            'p99': percentile(values, .99),
+            'max': values[-1] if values else 0.,
+        }
+
+    def __grouped(self, data, index):
+        grouped = defaultdict(list)
+        for key, values in data.items():
+            grouped[key[index]].extend(values)
+        return grouped
+
+    def summary(self):
+        """Return all metrics aggregated per host and verb, per verb and per phase as dictionary"""
+        with self.__lock:
+            commands = []
+            for (host, verb), latencies in sorted(self.latencies.items()):
+                entry = {'host': host, 'verb': verb}
+                entry.update(self.counters[(host, verb)])
+                entry['latency'] = self.__stats(latencies)
+                entry['queued'] = self.__stats(self.queued[(host, verb)])
+                commands.append(entry)
+            verbs = {verb: self.__stats(latencies)
+                     for verb, latencies in sorted(self.__grouped(self.latencies, 1).items())}
+            phases = [{'host': host, 'phase': phase, 'duration': self.__stats(durations)}
+                      for (host, phase), durations in sorted(self.phases.items())]
+            phase_totals = {phase: self.__stats(durations)
+                            for phase, durations in sorted(self.__grouped(self.phases, 1).items())}
+            waits = {kind: union_length([intervals]) for kind, intervals in sorted(self.waits.items())}
+            return {
+                'start': self.start,
+                'duration': time() - self.start,
+                'commands': commands,
+                'verbs': verbs,
+                'phases': phases,
+                'phase_totals': phase_totals,
+                'latency': self.__stats([val for values in self.latencies.values() for val in values]),
+                'queued': self.__stats([val for values in self.queued.values() for val in values]),
+                'waits': waits,
+            }
+
+    def print_summary(self, logger):
+        """Log a summary with the latency percentiles per command verb and the phase durations"""
+        summary = self.summary()
+        if not summary['verbs'] and not summary['phase_totals']:
+            return
+        lines = ['%-18s %8s %10s %10s %10s %10s %10s' % (
+            'command', 'count', 'total [s]', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]')]
+        for verb, stats in summary['verbs'].items():
+            lines.append('%-18s %8d %10.2f %10.1f %10.1f %10.1f %10.1f' % (
+                verb, stats['count'], stats['sum'], stats['p50']*1e3, stats['p90']*1e3,
+                stats['p99']*1e3, stats['max']*1e3))
+        lines.append('%-18s %8s %10s %10s %10s %10s %10s' % (
+            'phase', 'count', 'total [s]', 'p50 [s]', 'p90 [s]', 'p99 [s]', 'max [s]'))
+        for phase, stats in summary['phase_totals'].items():
+            lines.append('%-18s %8d %10.2f %10.2f %10.2f %10.2f %10.2f' % (
+                phase, stats['count'], stats['sum'], stats['p50'], stats['p90'],
+                stats['p99'], stats['max']))
+        timeouts = sum(entry['timeouts'] for entry in summary['commands'])
+        retries = sum(entry['retries'] for entry in summary['commands'])
+        failures = sum(entry['failures'] for entry in summary['commands'])
+        lines.append('timeouts: %d, retries: %d, failed commands: %d' % (timeouts, retries, failures))
+        logger.info('Command and phase statistics:\n' + '\n'.join(lines))
+
+    def write_json(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.summary(), out, indent=2)
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = []
+
+        def label(**labels):
+            return ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                            for key, val in labels.items())
+
+        lines.append('# HELP cbhv_command_latency_seconds Round trip latency of commands sent to the boxes')
+        lines.append('# TYPE cbhv_command_latency_seconds summary')
+        for entry in summary['commands']:
+            labels = label(host=entry['host'], verb=entry['verb'])
+            for quantile, key in ((.5, 'p50'), (.9, 'p90'), (.99, 'p99')):
+                lines.append('cbhv_command_latency_seconds{%s,quantile="%g"} %g' % (
+                    labels, quantile, entry['latency'][key]))
+            lines.append('cbhv_command_latency_seconds_sum{%s} %g' % (labels, entry['latency']['sum']))
+            lines.append('cbhv_command_latency_seconds_count{%s} %d' % (labels, entry['latency']['count']))
+        for counter, description in (('bytes_out', 'Bytes sent to the boxes'),
+                                     ('bytes_in', 'Bytes received from the boxes'),
+                                     ('timeouts', 'Commands which timed out'),
+                                     ('retries', 'Commands which were retried'),
+                                     ('failures', 'Commands which failed')):
+            lines.append('# HELP cbhv_command_%s_total %s' % (counter, description))
+            lines.append('# TYPE cbhv_command_%s_total counter' % counter)
+            for entry in summary['commands']:
+                lines.append('cbhv_command_%s_total{%s} %d' % (
+                    counter, label(host=entry['host'], verb=entry['verb']), entry[counter]))
+        lines.append('# HELP cbhv_phase_duration_seconds Duration of the phases of a run')
+        lines.append('# TYPE cbhv_phase_duration_seconds summary')
+        for entry in summary['phases']:
+            labels = label(host=entry['host'], phase=entry['phase'])
+            lines.append('cbhv_phase_duration_seconds_sum{%s} %g' % (labels, entry['duration']['sum']))
+            lines.append('cbhv_phase_duration_seconds_count{%s} %d' % (labels, entry['duration']['count']))
+        lines.append('# HELP cbhv_run_duration_seconds Duration of the run')
+        lines.append('# TYPE cbhv_run_duration_seconds gauge')
+        lines.append('cbhv_run_duration_seconds %g' % summary['duration'])
+        with open(path, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+
+
+# metrics of the current run used by all connections
+METRICS = Metrics()
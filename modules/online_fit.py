@@ -0,0 +1,264 @@
+"""
+Fits of the correction measurement while it is running:
+RunningFit updates the linear fits of (ADC - setpoint) vs. setpoint of all channels
+of a card with every measured point, AdaptiveStepping uses them to measure a coarse
+set of setpoints first and only adds intermediate setpoints where the channels
+deviate from the linear fit; CardMonitor uses them to flag dead, flat or deviating channels
+as soon as they show up and provides the gains right after the measurement
+"""
+
+from math import sqrt
+
+from modules.analysis import FIT_RANGE
+from modules.hv_gains import N_CHANNELS
+
+# the coarse setpoints use this multiple of the stepping
+COARSE_FACTOR = 5
+# limits of the online checks: deviation of a point from the fit in V, absolute slope of
+# (ADC - setpoint) vs. setpoint, points needed before checking and the fraction of the setpoint
+# below which a channel is considered to have no voltage
+MAX_RESIDUAL = 5.
+MAX_SLOPE = .2
+MIN_POINTS = 3
+DEAD_FRACTION = .5
+# problems of a single point which are cleared once the channel is read successfully again
+READ_FAILURES = ('SetVpmF failed', 'no valid reading')
+
+
+def channel_name(channel):
+    """Name of a flagged channel for the log, None stands for the whole card"""
+    return 'all channels' if channel is None else 'channel %d' % channel
+
+
+class RunningFit:
+    """Least squares fit y = offset + slope*x of several channels which is updated
+    with every point, only the sums are stored"""
+
+    def __init__(self, channels=N_CHANNELS):
+        self.n = [0]*channels
+        self.sx = [0.]*channels
+        self.sy = [0.]*channels
+        self.sxx = [0.]*channels
+        self.sxy = [0.]*channels
+        self.syy = [0.]*channels
+
+    def add(self, x, values):
+        """Add a point for all channels, values which are None are skipped"""
+        for channel, y in enumerate(values):
+            if y is None:
+                continue
+            self.n[channel] += 1
+            self.sx[channel] += x
+            self.sy[channel] += y
+            self.sxx[channel] += x*x
+            self.sxy[channel] += x*y
+            self.syy[channel] += y*y
+
+    def parameters(self, channel):
+        """Return slope and offset of a channel, None if it has less than two different points"""
+        n, sx, sy = self.n[channel], self.sx[channel], self.sy[channel]
+        det = n*self.sxx[channel] - sx*sx
+        # relative check, the sums are large compared to the spread of the setpoints
+        if n < 2 or det <= 1e-9*n*self.sxx[channel]:
+            return None
+        slope = (n*self.sxy[channel] - sx*sy)/det
+        return slope, (sy - slope*sx)/n
+
+    def residual(self, channel, x, y):
+        """Deviation of a point from the fit of the channel, None without valid fit"""
+        params = self.parameters(channel)
+        if params is None:
+            return None
+        slope, offset = params
+        return y - (offset + slope*x)
+
+    def rms(self, channel):
+        """RMS of the residuals of all points of a channel, None without valid fit"""
+        params = self.parameters(channel)
+        if params is None:
+            return None
+        slope, offset = params
+        # sum of the squared residuals of the least squares fit, rounding can make it slightly negative
+        squares = self.syy[channel] - offset*self.sy[channel] - slope*self.sxy[channel]
+        return sqrt(max(squares, 0.)/self.n[channel])
+
+
+class AdaptiveStepping:
+    """Setpoints of a card for the adaptive measurement: all setpoints are taken from the regular
+    grid range(v_range[0], v_range[1], stepping); first every COARSE_FACTOR-th setpoint and the last
+    one are measured, then the midpoint of every interval within the fit range is added if any
+    channel deviates by more than tolerance volts from the linear fit at one of its ends;
+    if channels are given, only the deviations of these channels are considered"""
+
+    def __init__(self, v_range, stepping, tolerance, fit_range=FIT_RANGE, coarse=COARSE_FACTOR, channels=None):
+        self.channels = list(range(N_CHANNELS)) if channels is None else list(channels)
+        self.grid = list(range(v_range[0], v_range[1], stepping))
+        self.tolerance = tolerance
+        self.fit_range = fit_range
+        self.coarse = sorted(set(self.grid[::coarse] + self.grid[-1:]))
+        self.requested = set()
+        # setpoint -> ADC values of the channels
+        self.points = {}
+        self.fit = RunningFit()
+
+    def in_fit_range(self, setpoint):
+        return self.fit_range[0] <= setpoint <= self.fit_range[1]
+
+    def add(self, setpoint, adc):
+        """Add a measured point with the ADC values of all channels"""
+        self.requested.add(setpoint)
+        if setpoint in self.points or adc is None:
+            return
+        self.points[setpoint] = adc
+        if self.in_fit_range(setpoint):
+            self.fit.add(setpoint, [val - setpoint for val in adc])
+
+    def deviation(self, setpoint):
+        """Largest deviation of the channels from their fits at a measured setpoint"""
+        adc = self.points[setpoint]
+        residuals = [self.fit.residual(channel, setpoint, val - setpoint)
+                     for channel, val in enumerate(adc) if channel in self.channels]
+        return max((abs(res) for res in residuals if res is not None), default=0.)
+
+    def next_points(self):
+        """Return the setpoints to measure next, an empty list once the card is done;
+        setpoints which have been requested before are never returned again"""
+        if not self.requested.issuperset(self.coarse):
+            points = [val for val in self.coarse if val not in self.requested]
+        else:
+            measured = sorted(val for val in self.points if self.in_fit_range(val))
+            deviations = {val: self.deviation(val) for val in measured}
+            points = []
+            for low, high in zip(measured, measured[1:]):
+                if max(deviations[low], deviations[high]) <= self.tolerance:
+                    continue
+                inner = [val for val in self.grid if low < val < high and val not in self.requested]
+                if inner:
+                    points.append(min(inner, key=lambda val: abs(val - (low + high)/2.)))
+        self.requested.update(points)
+        return points
+
+
+class CardMonitor:
+    """Streaming fits of the channels of a card during the measurement, problems like
+    dead channels, flat responses or outliers are flagged as soon as they show up;
+    the fits within the fit range give the final gains right after the measurement"""
+
+    def __init__(self, max_residual=MAX_RESIDUAL, max_slope=MAX_SLOPE, min_points=MIN_POINTS,
+                 fit_range=FIT_RANGE, channels=None):
+        # only the given channels are measured, the values of the other ones are ignored
+        self.channels = list(range(N_CHANNELS)) if channels is None else list(channels)
+        self.max_residual = max_residual
+        self.max_slope = max_slope
+        self.min_points = min_points
+        self.fit_range = fit_range
+        # fit of all points to detect problems and of the points within the fit range for the gains
+        self.fit = RunningFit()
+        self.gains = RunningFit()
+        self.points = 0
+        # channel -> reason of the first problem found, channel None stands for the whole card
+        self.flagged = {}
+
+    def check(self, setpoint, adc, failed=()):
+        """Check a new point before it is added, failed contains the channels whose SetVpmF failed;
+        returns a list of (channel, reason) for the problems of this point, channel is None
+        if the card couldn't be read"""
+        problems = [(channel, 'SetVpmF failed') for channel in failed]
+        if adc is None:
+            return problems + [(None, 'no valid reading')]
+        for channel, val in enumerate(adc):
+            if channel in failed or channel not in self.channels:
+                continue
+            if val < DEAD_FRACTION*setpoint:
+                problems.append((channel, 'no voltage, read %g V at %d V' % (val, setpoint)))
+                continue
+            if self.fit.n[channel] < self.min_points:
+                continue
+            residual = self.fit.residual(channel, setpoint, val - setpoint)
+            if residual is not None and abs(residual) > self.max_residual:
+                problems.append((channel, 'residual %+.1f V at %d V' % (residual, setpoint)))
+        return problems
+
+    def add(self, setpoint, adc):
+        """Add a point to the fits, returns a list of (channel, reason) for channels whose slope
+        is out of tolerance now; channels without voltage are not added"""
+        if adc is None:
+            return []
+        self.points += 1
+        values = [val - setpoint if val >= DEAD_FRACTION*setpoint and channel in self.channels else None
+                  for channel, val in enumerate(adc)]
+        self.fit.add(setpoint, values)
+        if self.fit_range[0] <= setpoint <= self.fit_range[1]:
+            self.gains.add(setpoint, values)
+        problems = []
+        for channel in range(N_CHANNELS):
+            params = self.fit.parameters(channel)
+            if params and self.fit.n[channel] >= self.min_points and abs(params[0]) > self.max_slope:
+                problems.append((channel, 'slope %+.3f out of tolerance, flat or broken response'
+                                 % params[0]))
+        return problems
+
+    def flag(self, problems):
+        """Remember the problems of a point, returns the ones of channels which were not flagged before;
+        failed commands and readings stay flagged only until the channel is read successfully again"""
+        current = {channel for channel, _ in problems}
+        if None not in current:
+            for channel in [channel for channel, reason in self.flagged.items()
+                            if reason in READ_FAILURES and channel not in current]:
+                del self.flagged[channel]
+        new = [(channel, reason) for channel, reason in problems if channel not in self.flagged]
+        for channel, reason in new:
+            self.flagged[channel] = reason
+        return new
+
+    def status(self):
+        """Short summary of the current fits of all channels including the largest RMS residual"""
+        params = [self.fit.parameters(channel) for channel in range(N_CHANNELS)]
+        params = [param for param in params if param]
+        if not params:
+            return 'no fit yet'
+        slopes = [slope for slope, _ in params]
+        offsets = [offset for _, offset in params]
+        residuals = [rms for rms in map(self.fit.rms, range(N_CHANNELS)) if rms is not None]
+        return 'slopes %+.4f..%+.4f, offsets %+.1f..%+.1f V, residuals up to %.2f V rms, %d channels flagged' % (
+            min(slopes), max(slopes), min(offsets), max(offsets), max(residuals), len(self.flagged))
+
+    def results(self):
+        """Slope and offset of all channels from the points within the fit range,
+        None for channels without valid fit"""
+        return [self.gains.parameters(channel) for channel in range(N_CHANNELS)]
+
+
+class MeasurementMonitor:
+    """CardMonitor of every card of a measurement; on_problem decides what happens with a card
+    once a problem is found: 'warn' only reports it, 'retry' measures a point with problems
+    once more before it is accepted and 'abort' stops the measurement of the card"""
+
+    def __init__(self, on_problem='warn', max_residual=MAX_RESIDUAL, max_slope=MAX_SLOPE, channels=None):
+        self.on_problem = on_problem
+        self.channels = channels
+        self.max_residual = max_residual
+        self.max_slope = max_slope
+        # (box, card) -> CardMonitor
+        self.cards = {}
+        self.aborted = set()
+
+    def card(self, box, card):
+        if (box, card) not in self.cards:
+            self.cards[box, card] = CardMonitor(self.max_residual, self.max_slope, channels=self.channels)
+        return self.cards[box, card]
+
+    def flagged(self):
+        """List of (box, card, channel, reason) of all flagged channels, channel None for a whole card"""
+        return [(box, card, channel, reason) for (box, card), monitor in sorted(self.cards.items())
+                for channel, reason in sorted(monitor.flagged.items(),
+                                              key=lambda item: -1 if item[0] is None else item[0])]
+
+    def results(self):
+        """Keys, slopes and offsets of all cards with points like analysis.fit_channels,
+        channels without valid fit or which were not measured are None"""
+        keys = sorted(key for key, monitor in self.cards.items() if monitor.points)
+        params = [self.cards[key].results() for key in keys]
+        slopes = [[param[0] if param else None for param in card] for card in params]
+        offsets = [[param[1] if param else None for param in card] for card in params]
+        return keys, slopes, offsets
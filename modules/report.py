@@ -0,0 +1,191 @@
+"""
+Report of the analysis with the fit plots of all cards, replacing the canvases saved per card
+by cbhv_calibrate_boxes.C: every card is rendered as SVG with one panel per channel showing
+ADC - setpoint vs. setpoint and the fitted line. The plots are rendered in a process pool and
+cached by a hash of the measured points and the fit parameters of the card, so only cards whose
+measurement or fit changed are rendered again; all plots are combined into a single HTML file.
+Plots which were not used for a while or beyond the most recently used ones are removed from the cache.
+"""
+
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from time import strftime, time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from modules.hv_gains import N_CHANNELS
+
+CACHE_DIR = '.cbhv_report_cache'
+# increase if the rendering changes, cached plots of older versions are not used anymore
+RENDER_VERSION = 1
+# cached plots are kept if they belong to the most recently used ones and were used within the maximum age,
+# which is about ten reports of all 18 boxes
+CACHE_MAX_PLOTS = 1000
+CACHE_MAX_AGE = 30*24*3600
+# size of the panel of a channel in the 3x3 grid of a card
+PANEL_WIDTH, PANEL_HEIGHT = 300, 200
+MARGIN_LEFT, MARGIN_RIGHT, MARGIN_TOP, MARGIN_BOTTOM = 45, 10, 22, 28
+
+
+def card_hash(box, card, setpoints, adc, slopes, offsets, fit_range):
+    """Hash of everything which is shown in the plot of a card"""
+    digest = hashlib.sha256()
+    digest.update(('%d %d %d %r' % (RENDER_VERSION, box, card, tuple(fit_range))).encode())
+    for array in (setpoints, adc, slopes, offsets):
+        digest.update(np.ascontiguousarray(array, dtype='<f8').tobytes())
+    return digest.hexdigest()
+
+
+def scale(value, low, high, start, length):
+    return start + (value - low)/(high - low)*length if high > low else start + length/2.
+
+
+def render_panel(channel, x, y, slope, offset, fit_range):
+    """SVG elements of the panel of a single channel at the origin"""
+    width = PANEL_WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+    height = PANEL_HEIGHT - MARGIN_TOP - MARGIN_BOTTOM
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    fitted = np.isfinite(slope) and np.isfinite(offset)
+    title = 'channel %d: ' % channel + ('slope %.5f, offset %.2f V' % (slope, offset) if fitted
+                                        else 'fit failed')
+    elements = ['<text x="%d" y="15" font-size="12">%s</text>' % (MARGIN_LEFT, title),
+                '<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="black"/>'
+                % (MARGIN_LEFT, MARGIN_TOP, width, height)]
+    if not x.size:
+        return elements
+    x_low, x_high = x.min() - 5., x.max() + 5.
+    line_x = np.array([max(fit_range[0], x_low), min(fit_range[1], x_high)])
+    line_y = offset + slope*line_x if fitted else np.array([])
+    y_values = np.concatenate([y, line_y])
+    y_low, y_high = y_values.min(), y_values.max()
+    padding = max((y_high - y_low)*.1, 1.)
+    y_low, y_high = y_low - padding, y_high + padding
+
+    def px(val):
+        return scale(val, x_low, x_high, MARGIN_LEFT, width)
+
+    def py(val):
+        return scale(val, y_low, y_high, MARGIN_TOP + height, -height)
+
+    for val, anchor in ((x_low, 'start'), (x_high, 'end')):
+        elements.append('<text x="%.1f" y="%d" font-size="10" text-anchor="%s">%.0f</text>'
+                        % (px(val), PANEL_HEIGHT - 14, anchor, val))
+    for val in (y_low, y_high):
+        elements.append('<text x="%d" y="%.1f" font-size="10" text-anchor="end">%.1f</text>'
+                        % (MARGIN_LEFT - 3, py(val) + 4, val))
+    elements.append('<text x="%d" y="%d" font-size="10" text-anchor="middle">setpoint [V]</text>'
+                    % (MARGIN_LEFT + width//2, PANEL_HEIGHT - 4))
+    # crosses like the markers of the ROOT macro
+    path = ''.join('M%.1f %.1fh6M%.1f %.1fv6' % (px(xi) - 3, py(yi), px(xi), py(yi) - 3) for xi, yi in zip(x, y))
+    elements.append('<path d="%s" stroke="red" stroke-width="1"/>' % path)
+    if fitted and line_x[1] > line_x[0]:
+        elements.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="blue" stroke-width="1.5"/>'
+                        % (px(line_x[0]), py(line_y[0]), px(line_x[1]), py(line_y[1])))
+    return elements
+
+
+def render_card(task):
+    """Render the SVG plot of a card, task is (box, card, setpoints, adc, slopes, offsets, fit_range);
+    runs in the worker processes"""
+    box, card, setpoints, adc, slopes, offsets, fit_range = task
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="sans-serif">'
+           % (3*PANEL_WIDTH, 3*PANEL_HEIGHT)]
+    for channel in range(N_CHANNELS):
+        svg.append('<g transform="translate(%d,%d)">' % (channel % 3*PANEL_WIDTH, channel//3*PANEL_HEIGHT))
+        svg.extend(render_panel(channel, setpoints, adc[:, channel] - setpoints, slopes[channel],
+                                offsets[channel], fit_range))
+        svg.append('</g>')
+    svg.append('<text x="%d" y="%d" font-size="16">Box%02d Board%d</text>'
+               % (2*PANEL_WIDTH + MARGIN_LEFT, 2*PANEL_HEIGHT + PANEL_HEIGHT//2, box, card))
+    svg.append('</svg>')
+    return '\n'.join(svg) + '\n'
+
+
+def cache_directory(path):
+    """Plot cache of the report written to path"""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+
+
+def clear_cache(logger, path):
+    """Remove all cached plots of the report written to path"""
+    cache_dir = cache_directory(path)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+        logger.info('Removed the plot cache %s', cache_dir)
+
+
+def prune_cache(logger, cache_dir, used, max_plots=CACHE_MAX_PLOTS, max_age=CACHE_MAX_AGE):
+    """Remove the cached plots which are not in used if they are older than max_age seconds or not
+    among the max_plots most recently used ones; the modification time of a plot is the time of its last use"""
+    plots = []
+    for name in os.listdir(cache_dir):
+        plot = os.path.join(cache_dir, name)
+        try:
+            plots.append((os.path.getmtime(plot), plot))
+        except OSError:
+            continue
+    plots.sort(reverse=True)
+    now = time()
+    removed = 0
+    for rank, (mtime, plot) in enumerate(plots):
+        if plot in used or (rank < max_plots and now - mtime <= max_age):
+            continue
+        try:
+            os.remove(plot)
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logger.info('Removed %d old plots from the cache', removed)
+    return removed
+
+
+def write_report(logger, path, keys, setpoints, adc, slopes, offsets, fit_range, jobs=None):
+    """Write the HTML report with the plots of all cards; keys are the (box, card) of the cards and the arrays
+    are those of the analysis with shapes (cards, points), (cards, points, 8) and (cards, 8)"""
+    cache_dir = cache_directory(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_plots = []
+    tasks = []
+    for i, (box, card) in enumerate(keys):
+        valid = np.isfinite(setpoints[i])
+        task = (box, card, setpoints[i, valid], adc[i, valid], slopes[i], offsets[i], tuple(fit_range))
+        plot = os.path.join(cache_dir, card_hash(*task) + '.svg')
+        cached_plots.append(plot)
+        if os.path.isfile(plot):
+            # the modification time marks the last use for pruning the cache
+            os.utime(plot)
+        else:
+            tasks.append((plot, task))
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for (plot, _), svg in zip(tasks, pool.map(render_card, [task for _, task in tasks], chunksize=4)):
+                # rename to not leave incomplete plots in the cache if interrupted
+                with open(plot + '.tmp', 'w') as out:
+                    out.write(svg)
+                os.replace(plot + '.tmp', plot)
+    logger.info('Rendered the plots of %d cards, %d taken from the cache', len(tasks), len(keys) - len(tasks))
+
+    # the plots are copied one after another into the report instead of collecting them in memory
+    with open(path, 'w') as report:
+        report.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>CBHV correction values</title>'
+                     '</head>\n<body style="font-family: sans-serif">\n')
+        report.write('<h1>CBHV correction values</h1>\n<p>%d cards, fit range %g V to %g V, created %s</p>\n'
+                     % (len(keys), fit_range[0], fit_range[1], strftime('%Y-%m-%d %H:%M:%S')))
+        report.write('<p>%s</p>\n' % ' '.join('<a href="#box%02d_card%d">%d/%d</a>' % (box, card, box, card)
+                                              for box, card in keys))
+        for (box, card), plot in zip(keys, cached_plots):
+            report.write('<h2 id="box%02d_card%d">Box %d, card %d</h2>\n' % (box, card, box, card))
+            with open(plot, 'r') as svg:
+                report.write(svg.read())
+        report.write('</body>\n</html>\n')
+    logger.info('Saved the report to %s', path)
+    prune_cache(logger, cache_dir, set(cached_plots))
+    return True
@@ -0,0 +1,43 @@
+"""
+Settings for opening the sessions with the CBHV boxes: they are created once from the
+command line options and passed to all functions which connect to the boxes
+"""
+
+from modules.telnet_manager import TelnetManager
+from modules.cbhv_daemon import DaemonSession
+from modules.transcript import TranscriptRecorder, ReplaySession, transcript_path
+
+# maximum number of commands sent to a box without waiting for their responses
+DEFAULT_WINDOW = 8
+# default time in seconds to wait for the response to a command
+DEFAULT_TIMEOUT = 10.
+
+
+class SessionConfig:
+    """How the sessions with the boxes are opened: directly or, if daemon_socket is given,
+    via the CBHV daemon listening on this unix socket; window is the number of pipelined commands
+    and timeout the default time in seconds to wait for a response of a direct session.
+    The direct sessions are recorded to record_dir if given, while with replay_dir the recorded
+    sessions are replayed replay_speed times faster instead of connecting to the boxes"""
+
+    def __init__(self, daemon_socket=None, window=DEFAULT_WINDOW, record_dir=None, replay_dir=None,
+                 replay_speed=1., timeout=DEFAULT_TIMEOUT):
+        self.daemon_socket = daemon_socket
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.replay_speed = replay_speed
+
+    def open(self, host, logger):
+        """Open a session to the box host, it has to be closed or used as a context manager"""
+        if self.replay_dir:
+            return ReplaySession(host, transcript_path(self.replay_dir, host), self.replay_speed,
+                                 logger, self.window)
+        if self.daemon_socket:
+            return DaemonSession(host, self.daemon_socket, logger=logger)
+        recorder = None
+        if self.record_dir:
+            recorder = TranscriptRecorder(transcript_path(self.record_dir, host), host)
+        return TelnetManager(host, logger=logger, timeout=self.timeout, window=self.window,
+                             recorder=recorder)
@@ -0,0 +1,69 @@
+"""
+Adaptive settling detection for the correction measurement:
+instead of waiting a fixed time after applying a setpoint, the ADC values
+of a card are read repeatedly until all channels are stable
+"""
+
+from time import sleep, perf_counter
+
+from modules.hv_gains import N_CHANNELS
+
+
+class Settling:
+    """Settings for the adaptive settling detection: a reading is accepted once the values
+    of all channels of the last samples readings differ by at most tolerance (in V);
+    after max_wait seconds the last reading is used even if it is not stable"""
+
+    def __init__(self, tolerance, samples=3, max_wait=10., interval=.2):
+        self.tolerance = tolerance
+        self.samples = max(2, samples)
+        self.max_wait = max_wait
+        self.interval = interval
+
+
+def parse_adc(response):
+    """Return the channel values of a read_adc csv2L response as a list of floats,
+    None if the response can not be parsed"""
+    vals = response.split(',')
+    if len(vals) < 2 + N_CHANNELS:
+        return None
+    try:
+        return [float(val) for val in vals[2:2+N_CHANNELS]]
+    except ValueError:
+        return None
+
+
+def is_stable(readings, tolerance):
+    """Check if all channels differ by at most tolerance in the given readings"""
+    return all(max(channel) - min(channel) <= tolerance for channel in zip(*readings))
+
+
+def wait_settled(reads, settling, start=None):
+    """Poll the read functions given as dictionary {card: read} until the returned read_adc
+    responses of every card are stable as defined by settling, the cards are polled together;
+    start is the time the setpoint was applied, default is now; returns a dictionary
+    {card: (last response or False if reading failed, time since start, settled)}"""
+    if start is None:
+        start = perf_counter()
+    readings = {card: [] for card in reads}
+    results = {}
+    while True:
+        for card, read in reads.items():
+            if card in results:
+                continue
+            response = read()
+            if not response:
+                results[card] = response, perf_counter() - start, False
+                continue
+            values = parse_adc(response)
+            if values is not None:
+                readings[card] = readings[card][-(settling.samples - 1):] + [values]
+                if len(readings[card]) == settling.samples \
+                        and is_stable(readings[card], settling.tolerance):
+                    results[card] = response, perf_counter() - start, True
+                    continue
+            if perf_counter() - start + settling.interval > settling.max_wait:
+                results[card] = response, perf_counter() - start, False
+        if len(results) == len(reads):
+            return results
+        sleep(settling.interval)
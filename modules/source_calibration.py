@@ -0,0 +1,189 @@
+"""
+Python port of CBCalibrationGraphs.C without ROOT: the peak positions of the source measurement
+at all set voltages are loaded into a single (voltages x 720 channels) array and the gain curves
+(peak position vs. voltage) of all channels are fitted at once; the voltage at which every channel
+reaches the target ADC channel is written as a new calibcurves file. Like the macro, the voltages
+are limited to [1275, 1625] V and channels with less than two peaks get the average voltage.
+The plots of the macro are not produced.
+
+Example, run in the directory with the Peakpositionenliste_HV<voltage>.txt files:
+    python3 -m modules.source_calibration -o calibcurves_2023_04.txt
+    python3 -m modules.source_calibration --read-voltages read_voltages.txt --target 60
+"""
+
+import sys
+import os
+import argparse
+import logging
+from time import strftime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from modules.calib_history import N_CB_CHANNELS, write_campaign
+
+# the voltages set for the source data collection
+SET_VOLTAGES = [1600, 1570, 1530, 1500, 1425, 1350]
+PEAK_FILE = 'Peakpositionenliste_HV%d.txt'
+# ADC channel of the peak position the voltages are calibrated to
+TARGET_CHANNEL = 60
+VOLTAGE_LIMITS = (1275, 1625)
+# range of the histograms of the macro with 1 V bins, the fit uses the bin centers
+HIST_RANGE = (1250, 1650)
+HOLES = [26, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 40, 311, 315, 316, 318, 319, 353, 354, 355,
+         356, 357, 358, 359, 360, 361, 362, 363, 364, 365, 366, 400, 401, 402, 405, 408, 679, 681,
+         682, 683, 684, 685, 686, 687, 688, 689, 691, 692]
+
+
+def read_voltages(set_voltages=SET_VOLTAGES, overrides=None):
+    """Voltages of all channels per set voltage with shape (voltages, 720); overrides is a list of
+    (set voltage, channel, read voltage) for channels whose read voltage deviates (SetReadVoltages)"""
+    volts = np.repeat(np.array(set_voltages)[:, np.newaxis], N_CB_CHANNELS, axis=1)
+    for set_voltage, channel, voltage in overrides or []:
+        volts[set_voltages.index(set_voltage), channel] = voltage
+    return volts
+
+
+def read_overrides(path):
+    """Read the overrides of the read voltages from a file with lines 'set_voltage channel read_voltage'"""
+    overrides = []
+    with open(path, 'r') as override_file:
+        for line in override_file:
+            line = line.split('#')[0].strip()
+            if line:
+                set_voltage, channel, voltage = (int(val) for val in line.split())
+                overrides.append((set_voltage, channel, voltage))
+    return overrides
+
+
+def load_peaks(logger, directory='.', set_voltages=SET_VOLTAGES):
+    """Load the peak position lists of all set voltages, lines contain the channel, the peak position
+    and four further values; returns an array with shape (voltages, 720), NaN for missing channels;
+    if a channel is listed several times in a file, only its first line is used like in the macro"""
+    peaks = np.full((len(set_voltages), N_CB_CHANNELS), np.nan)
+    for i, set_voltage in enumerate(set_voltages):
+        path = os.path.join(directory, PEAK_FILE % set_voltage)
+        if not os.path.isfile(path):
+            logger.warning('File %s not found', path)
+            continue
+        logger.info('Reading %s', path)
+        values = np.loadtxt(path, usecols=(0, 1), ndmin=2)
+        channels = values[:, 0].astype(int)
+        valid = (channels >= 0) & (channels < N_CB_CHANNELS)
+        channels, positions = channels[valid], values[valid, 1]
+        _, first = np.unique(channels, return_index=True)
+        if len(first) < len(channels):
+            logger.info('%d channels are listed more than once in %s, using the first line',
+                        len(channels) - len(first), path)
+        peaks[i, channels[first]] = positions[first]
+    return peaks
+
+
+def remove_duplicates(logger, peaks, volts):
+    """Peaks of a channel at a voltage which is already filled by an earlier file are dropped,
+    e.g. if an override maps two set voltages to the same read voltage; as the macro uses histograms,
+    non-positive peaks and voltages outside of their range are not used either"""
+    peaks = np.where((peaks > 0) & (volts >= HIST_RANGE[0]) & (volts < HIST_RANGE[1]), peaks, np.nan)
+    for i in range(1, len(peaks)):
+        duplicate = np.isfinite(peaks[i]) & \
+            ((volts[:i] == volts[i]) & np.isfinite(peaks[:i])).any(axis=0)
+        for channel in np.flatnonzero(duplicate):
+            logger.info('HV%d, ch%d is already set', volts[i, channel], channel)
+        peaks[i, duplicate] = np.nan
+    return peaks
+
+
+def fit_gain_curves(peaks, volts):
+    """Fit peak = intercept + slope*voltage for all channels at once; the bin centers of the macro's
+    histograms are used as voltages and every peak is weighted with 1/peak as the bin errors are sqrt(peak),
+    with two points this is the line through both; returns slopes, intercepts and the number of peaks
+    per channel, NaN for channels with less than two peaks"""
+    valid = np.isfinite(peaks)
+    weights = np.where(valid, 1./np.where(valid, peaks, 1.), 0.)
+    x = np.where(valid, volts + .5, 0.)
+    y = np.where(valid, peaks, 0.)
+    s, sx, sy = weights.sum(axis=0), (weights*x).sum(axis=0), (weights*y).sum(axis=0)
+    det = s*(weights*x*x).sum(axis=0) - sx*sx
+    counts = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = np.where(counts >= 2, (s*(weights*x*y).sum(axis=0) - sx*sy)/det, np.nan)
+        intercepts = np.where(counts >= 2, (sy - slopes*sx)/s, np.nan)
+    return slopes, intercepts, counts
+
+
+def calibration_voltages(logger, slopes, intercepts, counts, target=TARGET_CHANNEL, limits=VOLTAGE_LIMITS):
+    """Voltages at which the channels reach the target ADC channel, limited to the given range;
+    channels with less than two peaks get the average voltage of all other channels"""
+    fitted = counts >= 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wanted = (target - intercepts)/slopes
+    outside = fitted & ((wanted < limits[0]) | (wanted > limits[1]) | ~np.isfinite(wanted))
+    for channel in np.flatnonzero(outside):
+        logger.info('Channel %d wanted %g', channel, wanted[channel])
+    voltages = np.clip(np.nan_to_num(wanted, nan=limits[1]), *limits)
+    average = voltages[fitted].mean() if fitted.any() else np.nan
+    logger.info('Average HV from all %d channels with 2 or more peaks = %g', fitted.sum(), average)
+    return np.where(fitted, voltages, average)
+
+
+def source_calibration(logger, directory='.', output=None, target=TARGET_CHANNEL, overrides=None, holes=HOLES):
+    """Create the calibcurves file from the peak position lists in the directory"""
+    volts = read_voltages(SET_VOLTAGES, overrides)
+    peaks = remove_duplicates(logger, load_peaks(logger, directory), volts)
+    if not np.isfinite(peaks).any():
+        logger.error('No peak positions found in %s', directory)
+        return False
+    slopes, intercepts, counts = fit_gain_curves(peaks, volts)
+    voltages = calibration_voltages(logger, slopes, intercepts, counts, target)
+
+    is_hole = np.zeros(N_CB_CHANNELS, dtype=bool)
+    is_hole[list(holes)] = True
+    write_campaign(output, np.where(is_hole, np.nan, voltages))
+    logger.info('Wrote the voltages of %d channels to %s', (~is_hole).sum(), output)
+
+    logger.info('The following channels had only one data point: %s',
+                ', '.join(str(ch) for ch in np.flatnonzero(~is_hole & (counts == 1))))
+    logger.info('The following non-hole channels had no data points: %s',
+                ', '.join(str(ch) for ch in np.flatnonzero(~is_hole & (counts == 0))))
+    return True
+
+
+def main():
+    """Calculate the CBHV voltages from the peak positions of a source calibration"""
+    parser = argparse.ArgumentParser(description='Calculate the voltages of all CB channels from the '
+                                     'peak positions of a source calibration (port of CBCalibrationGraphs.C)')
+    parser.add_argument('-d', '--directory', type=str, default='.',
+                        help='Directory containing the Peakpositionenliste_HV<voltage>.txt files, default .')
+    parser.add_argument('-o', '--output', type=str, default='calibcurves_%s.txt' % strftime('%Y_%m'),
+                        help='Output file, default calibcurves_YYYY_MM.txt with the current month')
+    parser.add_argument('-t', '--target', type=float, default=TARGET_CHANNEL,
+                        help='ADC channel of the peak position to calibrate to, default %d' % TARGET_CHANNEL)
+    parser.add_argument('--read-voltages', type=str, metavar='file',
+                        help='File with lines "set_voltage channel read_voltage" for channels whose '
+                        'read voltage deviates from the set voltage')
+    parser.add_argument('--holes', nargs='*', type=int, metavar='channel',
+                        help='Channels without crystal which are not written, default the holes of the CB')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print additional output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]  %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('CBHV source calibration')
+    if np is None:
+        sys.exit('NumPy is needed for the source calibration, please install it (e.g. pip install numpy)')
+
+    try:
+        overrides = read_overrides(args.read_voltages) if args.read_voltages else None
+        holes = HOLES if args.holes is None else args.holes
+        success = source_calibration(logger, args.directory, args.output, args.target, overrides, holes)
+    except (OSError, ValueError, IndexError) as e:
+        sys.exit(str(e))
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,62 +3,73 @@ Helper class to manage telnet connections and provide
 some useful commands to interact with telnet sessions
 """
 
-from telnetlib import Telnet
-from time import sleep
-import logging
+import asyncio
 
+from modules.cbhv_client import CBHVClient
 
-class TelnetManager(Telnet):
-    """Class to manage the telnet connection which provides some useful additional methods"""
 
-    def __init__(self, hostname=None, port=23, logger=None):
-        Telnet.__init__(self, host=hostname, port=port)
-        self.__host = hostname
-        self.__log = logger
-        if not self.__log:
-            logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
-                                datefmt='%Y-%m-%d %I:%M:%S', level=logging.INFO)
-            self.__log = logging.getLogger('Telnet Session')
+class TelnetManager:
+    """Class to manage the telnet connection which provides some useful additional methods;
+    it is a blocking wrapper around the asyncio based CBHVClient with its own event loop"""
+
+    def __init__(self, hostname=None, port=23, logger=None, timeout=10., retries=2, settle=1., window=8,
+                 recorder=None):
         self.__host = hostname
-        self.endline = '\r\n'
-        self.prompt = b'>'
-        # telnet needs some time...
-        sleep(1)
-        self.read()
+        self.__loop = asyncio.new_event_loop()
+        # with a TranscriptRecorder all commands and responses are recorded for a later replay
+        self.__recorder = recorder
+        self.__client = CBHVClient(hostname, port, logger=logger, timeout=timeout,
+                                   retries=retries, settle=settle, window=window, recorder=recorder)
+        self.endline = self.__client.endline
+        self.prompt = self.__client.prompt
+        try:
+            self.__run(self.__client.connect())
+        except BaseException:
+            self.__loop.close()
+            if recorder:
+                recorder.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
         self.close()
-        self.__log = None
 
+    def __run(self, coroutine):
+        return self.__loop.run_until_complete(coroutine)
+
+    @property
+    def host(self):
+        return self.__host
+
+    def close(self):
+        """Close the connection and the event loop used for it"""
+        loop = getattr(self, '_TelnetManager__loop', None)
+        if loop is None or loop.is_closed():
+            return
+        self.__run(self.__client.close())
+        loop.close()
+        if self.__recorder:
+            self.__recorder.close()
 
     def read(self):
         """Read telnet response until next prompt"""
-        self.read_until(self.prompt)
+        return self.__run(self.__client.read())
 
     def print(self, string, print_info=False):
         """remove telnet prompt from the string and output using logging.DEBUG level"""
-        cleaned = string.rstrip(self.prompt).decode('ascii').strip()
-        if not cleaned:
-            cleaned = 'empty'
-        if print_info:
-            self.__log.info('Telnet response:\n' + cleaned)
-        else:
-            self.__log.debug('Telnet response: ' + cleaned)
+        self.__client.print(string, print_info)
 
-    def send_command(self, cmd, print_info=False, return_response=False):
-        """send telnet command and wait for response"""
-        self.__log.debug('Send ' + cmd.rstrip(self.endline))
-        if not cmd.endswith(self.endline):
-            cmd += self.endline
-        self.write(cmd.encode('ascii'))
-        try:
-            response = super().read_until(self.prompt)
-        except EOFError:
-            self.__log.error('Telnet connection closed while trying to send command '
-                             + cmd.rstrip(self.endline))
-            return False
-        self.print(response, print_info)
+    def send_command(self, cmd, print_info=False, return_response=False, timeout=None, retries=None):
+        """send telnet command and wait for response, timeout and retries override
+        the defaults of the connection for this command"""
+        return self.__run(self.__client.send_command(cmd, print_info, return_response, timeout, retries))
 
-        if return_response:
-            return response.rstrip(self.prompt).decode('ascii').strip()
-        return True
+    def send_commands(self, commands, print_info=False):
+        """send several telnet commands without waiting for every single response,
+        returns the list of responses, False for failed commands"""
+        return self.__run(self.__client.send_commands(commands, print_info))
@@ -0,0 +1,166 @@
+"""
+Recording and replay of the sessions with the CBHV boxes:
+TranscriptRecorder writes every command sent to a box with its response, the time it was sent
+and the time until the response arrived as gzipped JSON lines, one transcript file per box;
+ReplaySession serves the recorded responses back instead of a box, optionally faster than
+recorded, so complete runs can be repeated without hardware to compare changes of the command flow.
+
+The first line of every session is a header {"host": ..., "started": ..., "connect": seconds},
+the following lines are {"t": seconds since the start, "cmd": ..., "latency": seconds, "response": ...}
+with the response false for failed commands.
+"""
+
+import os
+import gzip
+import json
+import threading
+from collections import defaultdict, deque
+from time import perf_counter, sleep, strftime
+
+from modules.metrics import METRICS
+from modules.box_pool import default_logger
+
+VERSION = 1
+
+
+def transcript_path(directory, host):
+    """Transcript file of a host in the given directory"""
+    return os.path.join(directory, '%s.jsonl.gz' % host.replace(':', '_'))
+
+
+def command_key(cmd):
+    """Commands are matched by their text, except setting the clock which contains the current time"""
+    cmd = cmd.strip()
+    if cmd.startswith('time '):
+        return 'time *'
+    return cmd
+
+
+class TranscriptRecorder:
+    """Append the commands of a session with a box to its transcript file, thread-safe;
+    several sessions with the same box are appended to the same file"""
+
+    def __init__(self, path, host):
+        self.path = path
+        self.host = host
+        self.__lock = threading.Lock()
+        self.__start = None
+        self.__file = gzip.open(path, 'at', encoding='utf-8')
+
+    def __write(self, entry):
+        self.__file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def start(self, connect_time):
+        """Start a new session, called after connecting"""
+        with self.__lock:
+            self.__start = perf_counter()
+            self.__write({'host': self.host, 'started': strftime('%Y-%m-%d %H:%M:%S'),
+                          'connect': round(connect_time, 6), 'version': VERSION})
+
+    def record(self, cmd, sent, latency, response):
+        """Record a command sent at the perf_counter time sent and its response, False if it failed"""
+        with self.__lock:
+            if self.__start is None:
+                self.__start = sent
+            self.__write({'t': round(sent - self.__start, 6), 'cmd': cmd, 'latency': round(latency, 6),
+                          'response': response})
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+def load_transcript(path):
+    """Read a transcript, returns the list of session headers and the list of command entries"""
+    sessions, entries = [], []
+    with gzip.open(path, 'rt', encoding='utf-8') as transcript:
+        for line in transcript:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if the recording was interrupted
+                continue
+            if 'cmd' in entry:
+                entries.append(entry)
+            else:
+                sessions.append(entry)
+    return sessions, entries
+
+
+class ReplaySession:
+    """Replay the transcript of a box instead of connecting to it, it can be used instead of TelnetManager;
+    every command gets the next recorded response of the same command after its recorded latency
+    divided by speed; commands sent more often than recorded get the last recorded response again"""
+
+    def __init__(self, hostname, path, speed=1., logger=None, window=8):
+        self.__host = hostname
+        self.__log = logger or default_logger('Replay Session')
+        self.endline = '\r\n'
+        self.speed = speed
+        self.window = max(1, window)
+        sessions, entries = load_transcript(path)
+        self.__responses = defaultdict(deque)
+        self.__last = {}
+        for entry in entries:
+            self.__responses[command_key(entry['cmd'])].append(entry)
+        connect = sum(session.get('connect', 0.) for session in sessions[:1])
+        with METRICS.phase(hostname, 'connect'):
+            sleep(connect/speed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def host(self):
+        return self.__host
+
+    def close(self):
+        pass
+
+    def __next_entry(self, cmd):
+        key = command_key(cmd)
+        if self.__responses[key]:
+            self.__last[key] = self.__responses[key].popleft()
+        elif key in self.__last:
+            self.__log.debug('No further response recorded for %s, using the last one' % cmd)
+        else:
+            return {'cmd': cmd, 'latency': 0., 'response': False}
+        return self.__last[key]
+
+    def send_commands(self, commands, print_info=False):
+        """Replay several commands, up to self.window commands are waiting for their responses
+        at the same time, so every chunk of commands takes as long as its slowest command"""
+        commands = [cmd.rstrip(self.endline) for cmd in commands]
+        responses = []
+        for first in range(0, len(commands), self.window):
+            chunk = [self.__next_entry(cmd) for cmd in commands[first:first + self.window]]
+            delay = max(entry['latency'] for entry in chunk)/self.speed
+            sleep(delay)
+            for cmd, entry in zip(commands[first:first + self.window], chunk):
+                response = entry['response']
+                METRICS.record_command(self.__host, cmd, delay, bytes_out=len(cmd + self.endline),
+                                       bytes_in=len(response or ''), failed=response is False)
+                if response is False:
+                    self.__log.error('No recorded response to command %s' % cmd)
+                    return responses + [False]*(len(commands) - len(responses))
+                if print_info:
+                    self.__log.info('Telnet response:\n' + (response or 'empty'))
+                else:
+                    self.__log.debug('Telnet response: ' + (response or 'empty'))
+                responses.append(response)
+        return responses
+
+    def send_command(self, cmd, print_info=False, return_response=False, timeout=None, retries=None):
+        """replay a single command, timeout and retries are accepted like by TelnetManager
+        but have no effect on a recorded response"""
+        self.__log.debug('Send ' + cmd.rstrip(self.endline))
+        response = self.send_commands([cmd], print_info)[0]
+        if response is False:
+            return False
+        if return_response:
+            return response
+        return True
@@ -0,0 +1,38 @@
+"""
+The modules are imported as in the scripts, with the repository root on the path;
+the simulator fixture runs a simulated box on a free port of localhost
+"""
+
+import sys
+import socket
+import logging
+from os.path import abspath, dirname
+
+import pytest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from modules.cbhv_simulator import SimulatorThread
+
+
+def free_box():
+    """Host prefix and box number of a free port, the last two digits of the port are the box number"""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        if port % 100:
+            return 'localhost:%d%%02d' % (port//100), port % 100
+
+
+@pytest.fixture
+def simulator():
+    """Yield the host prefix, the box number and the SimulatorThread of a simulated box"""
+    host_prefix, box = free_box()
+    with SimulatorThread(host_prefix, [box], seed=1) as sim:
+        yield host_prefix, box, sim
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('tests')
@@ -0,0 +1,51 @@
+"""
+Linear fits of the analysis and writing of the gains files
+"""
+
+import logging
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from modules.analysis import linear_fit, fit_channels, write_gains_file, update_gains_file
+from modules.hv_gains import read_gains_file, N_CHANNELS
+
+
+def test_linear_fit():
+    x = np.array([[1., 2., 3., 4.], [1., 2., 3., 4.]])
+    y = np.array([[3., 5., 7., 100.], [1., 1., 1., 1.]])
+    weights = np.array([[1., 1., 1., 0.], [0., 0., 1., 0.]])
+    slope, offset = linear_fit(x, y, weights)
+    assert slope[0] == pytest.approx(2.) and offset[0] == pytest.approx(1.)
+    # a single point can not be fitted
+    assert np.isnan(slope[1]) and np.isnan(offset[1])
+
+
+def test_fit_channels():
+    setpoints = np.array([[1300., 1400., 1500., 1600., np.nan]])
+    gains = np.arange(N_CHANNELS)*.001
+    adc = setpoints[..., np.newaxis]*(1 + gains) - 10.
+    # outside of the fit range and a missing channel
+    adc[0, 0] = 0.
+    adc[0, 1:, 7] = np.nan
+    slopes, offsets = fit_channels(setpoints, adc)
+    assert slopes[0, :7] == pytest.approx(gains[:7])
+    assert offsets[0, :7] == pytest.approx([-10.]*7)
+    assert np.isnan(slopes[0, 7])
+
+
+def test_failed_fits_are_not_written(tmp_path):
+    logger = logging.getLogger('tests')
+    path = str(tmp_path/'gains.txt')
+    slopes = np.full((1, N_CHANNELS), .01)
+    offsets = np.full((1, N_CHANNELS), -5.)
+    assert write_gains_file(path, [(1, 2)], slopes, offsets) == N_CHANNELS
+    slopes[0, 3] = np.nan
+    offsets[:] = 5.
+    assert update_gains_file(logger, path, [(1, 2)], slopes, offsets) == N_CHANNELS - 1
+    gains = read_gains_file(logger, path)
+    assert gains[(1, 2, 3)] == ('0.010000', '-5.000000')
+    assert gains[(1, 2, 4)] == ('0.010000', '5.000000')
+    assert write_gains_file(path, [(1, 2)], slopes, offsets) == N_CHANNELS - 1
+    assert (1, 2, 3) not in read_gains_file(logger, path)
@@ -0,0 +1,50 @@
+"""
+Conversion between the columnar file and the CSV files per card
+"""
+
+import logging
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from modules.columnar import ColumnarWriter, load_columnar, to_csv, from_csv
+
+RESPONSES = [
+    '18.10.2026 08:00:00,1.5,1390.2534,1402,1399.1,1388,1401.7534,1395,0.1,1e-07,0',
+    '18.10.2026 08:00:05,0.333,1490.25,1502,1499.5,1488,-1501.75,1495,1510,1480.5,16777217',
+    # a date and values which can not be parsed are kept as given or NaN
+    'bad date,1.5,1590,1602,1599,1588,1601,1595,1610,n/a,status',
+]
+
+
+def test_round_trip(tmp_path):
+    logger = logging.getLogger('tests')
+    path = str(tmp_path/'run.cbhv')
+    output_format = str(tmp_path/'box%02d_card%d.txt')
+    with ColumnarWriter(path, {'settling': True}) as writer:
+        for setpoint, response in zip([1400, 1500, 1600], RESPONSES):
+            assert writer.write(3, 1, setpoint, response, settle_time=1.2345678)
+        assert writer.write(3, 4, 1400, RESPONSES[0], settle_time=.5)
+        assert not writer.write(3, 4, 1500, 'ERROR')
+
+    assert to_csv(logger, path, output_format)
+    assert from_csv(logger, output_format, str(tmp_path/'copy.cbhv'), [3])
+    _, records = load_columnar(path)
+    _, copy = load_columnar(str(tmp_path/'copy.cbhv'))
+    assert len(records) == len(copy) == 4
+    for field in ('box', 'card', 'setpoint', 'date', 'status'):
+        assert copy[field].dtype == records[field].dtype
+        assert np.array_equal(records[field], copy[field]), field
+    for field in ('timestamp', 'level', 'adc', 'settle'):
+        assert np.array_equal(records[field], copy[field], equal_nan=True), field
+    assert copy['date'][2] == b'bad date'
+    assert copy['status'].tolist() == [0, 16777217, -1, 0]
+
+    # the CSV files written from the copy are the same again
+    with open(output_format % (3, 1)) as card_file:
+        csv = card_file.read()
+    assert to_csv(logger, str(tmp_path/'copy.cbhv'), output_format)
+    with open(output_format % (3, 1)) as card_file:
+        assert card_file.read() == csv
+    assert '1390.2534,' in csv and ',0.1,0.0000001,' in csv
@@ -0,0 +1,38 @@
+"""
+Parsing of the eemem print output and comparison with the intended values
+"""
+
+from os.path import abspath, dirname, join as pjoin
+
+from modules.eemem import parse_eemem, card_mismatches
+
+FIXTURES = pjoin(dirname(abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(pjoin(FIXTURES, name), newline='') as fixture:
+        return fixture.read()
+
+
+def test_parse_eemem_print():
+    content = parse_eemem(read_fixture('eemem_print.txt'))
+    assert content['REG'] == 'on'
+    assert sorted(content['M']) == sorted(content['N']) == list(range(5))
+    assert content['M'][0][0] == 0.009195
+    assert content['N'][4][7] == 3.118067
+
+
+def test_card_mismatches():
+    content = parse_eemem(read_fixture('eemem_print.txt'))
+    m_vals = ['%f' % val for val in content['M'][2]]
+    n_vals = ['%f' % val for val in content['N'][2]]
+    assert card_mismatches(content, 2, m_vals, n_vals) == []
+    m_vals[3] = '0.5'
+    assert card_mismatches(content, 2, m_vals, n_vals) == [('M', 3, .5, content['M'][2][3])]
+    del content['N'][2]
+    assert len(card_mismatches(content, 2, m_vals, n_vals)) == 1 + 8
+
+
+def test_parse_eemem_unrecognised():
+    assert parse_eemem('ERROR: unknown command eemem\r\nT0') is None
+    assert parse_eemem('') is None
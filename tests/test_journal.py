@@ -0,0 +1,39 @@
+"""
+Resuming a measurement from its journal
+"""
+
+from modules.journal import Journal, open_card_file
+
+HEADER = '#Setpoint,Date,Level,CH0,CH1,CH2,CH3,CH4,CH5,CH6,CH7\n'
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path/'cbhv_measurement.journal')
+    settings = {'v_range': [1400, 1700], 'stepping': 100}
+    with Journal(path, settings) as journal:
+        journal.record(1, 0, 1400)
+        journal.record(1, 0, 1500)
+    # an incomplete line written right before an interruption
+    with open(path, 'a') as journal_file:
+        journal_file.write('1,0,16')
+
+    with Journal(path, settings, resume=True) as journal:
+        assert not journal.settings_changed
+        assert journal.done(1, 0, 1500)
+        assert journal.missing(1, 0, [1400, 1500, 1600]) == [1600]
+        assert journal.missing(1, 1, [1400]) == [1400]
+    with Journal(path, dict(settings, stepping=50), resume=True) as journal:
+        assert journal.settings_changed
+
+
+def test_card_file_keeps_journaled_points(tmp_path):
+    path = str(tmp_path/'box01_card0.txt')
+    with open(path, 'w') as card_file:
+        card_file.write(HEADER + '1400,a\n1500,b\n1600,c\n1700,d')
+    with Journal(str(tmp_path/'journal'), {}) as journal:
+        journal.record(1, 0, 1400)
+        journal.record(1, 0, 1500)
+        with open_card_file(path, HEADER, journal, 1, 0) as out:
+            out.write('1600,e\n')
+    with open(path) as card_file:
+        assert card_file.read() == HEADER + '1400,a\n1500,b\n1600,e\n'
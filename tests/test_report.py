@@ -0,0 +1,26 @@
+"""
+Pruning of the plot cache of the report
+"""
+
+import os
+import logging
+
+from modules.report import prune_cache, clear_cache, cache_directory
+
+
+def test_prune_cache(tmp_path):
+    logger = logging.getLogger('tests')
+    cache_dir = cache_directory(str(tmp_path/'report.html'))
+    os.makedirs(cache_dir)
+    plots = [os.path.join(cache_dir, '%d.svg' % i) for i in range(6)]
+    for age, plot in enumerate(plots):
+        with open(plot, 'w') as svg:
+            svg.write('<svg/>')
+        mtime = os.path.getmtime(plot) - 10*age
+        os.utime(plot, (mtime, mtime))
+    # the oldest plot is used by the current report, 2 and 3 are too old, 4 is beyond the limit
+    assert prune_cache(logger, cache_dir, {plots[5]}, max_plots=5, max_age=15) == 3
+    assert sorted(os.listdir(cache_dir)) == ['0.svg', '1.svg', '5.svg']
+
+    clear_cache(logger, str(tmp_path/'report.html'))
+    assert not os.path.exists(cache_dir)
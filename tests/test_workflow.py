@@ -0,0 +1,37 @@
+"""
+Set, verify and measure the correction values of a simulated box
+"""
+
+import os
+
+import cbhv_control
+from modules.hv_gains import N_CARDS, N_CHANNELS
+from modules.session import SessionConfig
+
+
+def gains(box):
+    return {(box, card, channel): ('%f' % (.001*channel), '%f' % (card - 10.))
+            for card in range(N_CARDS) for channel in range(N_CHANNELS)}
+
+
+def test_set_and_verify(logger, simulator):
+    host_prefix, box, sim = simulator
+    hv_gains = gains(box)
+    assert cbhv_control.set_values(logger, host_prefix, hv_gains, False, [box], session=SessionConfig())
+    assert sim.simulators[0].eemem['REG'] == 'on'
+    assert cbhv_control.verify_values(logger, host_prefix, hv_gains, False, [box])
+    hv_gains[(box, 3, 5)] = ('0.5', '0')
+    assert not cbhv_control.verify_values(logger, host_prefix, hv_gains, False, [box])
+
+
+def test_measure(logger, simulator, tmp_path):
+    host_prefix, box, _ = simulator
+    output = str(tmp_path/'box%02d_card%d.txt')
+    assert cbhv_control.measure_values(logger, host_prefix, output, 100, [1400, 1700], 0, [box],
+                                       cards=[0, 4], session=SessionConfig(window=4))
+    assert sorted(os.listdir(str(tmp_path))) == ['box%02d_card0.txt' % box, 'box%02d_card4.txt' % box]
+    with open(output % (box, 4)) as card_file:
+        lines = card_file.read().splitlines()
+    assert lines[0].startswith('#Setpoint')
+    assert [int(line.split(',')[0]) for line in lines[1:]] == [1400, 1500, 1600]
+    assert all(len(line.split(',')) == 3 + N_CHANNELS + 1 for line in lines[1:])